@@ -0,0 +1,100 @@
+import math
+
+from typing import Callable, Dict, Optional, TypeVar
+
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.core import admission
+from app.core.config import settings
+
+
+F = TypeVar("F", bound=Callable)
+
+# Endpoint class of every limited endpoint function
+_endpoint_classes: Dict[Callable, str] = {}
+
+
+def limit(endpoint_class: str) -> Callable[[F], F]:
+    """Put the decorated endpoint under the admission control of its class."""
+    if endpoint_class not in admission.ENDPOINT_CLASSES:
+        raise ValueError(f"Unknown endpoint class {endpoint_class}")
+
+    def decorator(endpoint: F) -> F:
+        _endpoint_classes[endpoint] = endpoint_class
+        return endpoint
+
+    return decorator
+
+
+def rejection_status(exc: admission.Rejected) -> int:
+    return 429 if isinstance(exc, admission.RateLimited) else 503
+
+
+def rejection_headers(exc: admission.Rejected) -> Dict[str, str]:
+    return {"retry-after": str(max(1, math.ceil(exc.retry_after)))}
+
+
+class AdmissionMiddleware:
+    """Rate limit and admit requests to endpoints marked with `limit`.
+
+    Runs before the request body is read, so a refused upload costs next to
+    nothing. Rate limited clients get a 429, requests finding their class
+    overloaded a 503, both with Retry-After. The slot is held until the
+    response is sent.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        endpoint_class = (
+            self._endpoint_class(scope) if scope["type"] == "http" else None
+        )
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = admission.limiters[endpoint_class]
+        try:
+            admission.rate_limiters[endpoint_class].check(self._client(scope))
+            await limiter.acquire()
+        except admission.Rejected as exc:
+            response = JSONResponse(
+                {"detail": exc.message},
+                status_code=rejection_status(exc),
+                headers=rejection_headers(exc),
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+    def _endpoint_class(self, scope: Scope) -> Optional[str]:
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                endpoint = getattr(route, "endpoint", None)
+                return _endpoint_classes.get(endpoint) if endpoint else None
+        return None
+
+    def _client(self, scope: Scope) -> str:
+        hops = settings.RATE_LIMIT_TRUSTED_HOPS
+        if settings.RATE_LIMIT_CLIENT_HEADER and hops > 0:
+            name = settings.RATE_LIMIT_CLIENT_HEADER.lower().encode()
+            addresses = [
+                address.strip()
+                for key, value in scope["headers"]
+                if key == name
+                for address in value.decode("latin-1").split(",")
+            ]
+            # Clients can send any X-Forwarded-For, only the addresses our own
+            # proxies appended to it can be trusted
+            if len(addresses) >= hops:
+                return addresses[-hops]
+        client = scope.get("client")
+        return client[0] if client else "unknown"
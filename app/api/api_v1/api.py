@@ -1,7 +1,8 @@
 from fastapi import APIRouter
 
-from app.api.api_v1.endpoints import images
+from app.api.api_v1.endpoints import images, jobs
 
 api_router = APIRouter()
 
 api_router.include_router(images.router, prefix="/images", tags=["images"])
+api_router.include_router(jobs.router, prefix="/jobs", tags=["jobs"])
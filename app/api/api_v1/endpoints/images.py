@@ -1,39 +1,128 @@
+import functools
+import os
 import uuid
-from typing import Optional, Annotated
+from typing import Dict, List, Optional, Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, Form, Response
-from sqlalchemy.orm import Session
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    UploadFile,
+    Form,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app import schemas, crud
-from app.api import deps
+from app import models, schemas, crud
+from app.api import admission, deps
+from app.api.responses import RangeFileResponse, RangeStreamResponse, etag_matches
+from app.core.admission import Rejected
+from app.core.config import settings
+from app.core.executor import run_io
+from app.core.single_flight import SingleFlight
+from app.core.storage import get_storage
+from app.worker import worker
 
 
 router = APIRouter()
 
+# `async` is a keyword, the query parameter is read through an alias
+RunAsync = Query(default=False, alias="async")
+
+# Identical reads arriving together share one lookup, see SINGLE_FLIGHT_GROUPS
+image_flight = SingleFlight("get_image")
+diff_flight = SingleFlight("get_image_diff")
 
-@router.post("/upload", response_model=schemas.Image)
+
+async def _enqueue(
+    db: AsyncSession,
+    kind: schemas.JobKind,
+    payload: dict,
+    image_id: Optional[str] = None,
+) -> JSONResponse:
+    job: models.Job = await crud.job.create_job(db, kind, payload, image_id=image_id)
+    worker.notify()
+    return JSONResponse(
+        status_code=202, content=jsonable_encoder(schemas.Job.from_orm(job))
+    )
+
+
+@router.post(
+    "/upload", response_model=schemas.Image, responses={202: {"model": schemas.Job}}
+)
+@admission.limit("ingest")
 async def upload_image(
     file: UploadFile,
     name: Annotated[str, Form()],
     description: Annotated[Optional[str], Form()],
-    db: Session = Depends(deps.get_db),
-) -> schemas.Image:
+    run_async: bool = RunAsync,
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.Image | JSONResponse:
     try:
         fileImage = schemas.ImageUpload(file=file, name=name, description=description)
-        return crud.image.create_image(db, image_url=None, image_upload=fileImage)
+        if run_async:
+            blob = await crud.image.stage_upload(db, fileImage)
+            try:
+                return await _enqueue(
+                    db,
+                    schemas.JobKind.upload,
+                    {**blob._asdict(), "name": name, "description": description},
+                )
+            except Exception:
+                await crud.image.unstage_upload(db, blob)
+                raise
+        return await crud.image.create_image(db, image_url=None, image_upload=fileImage)
     except crud.CRUDBadRequestError as exc:
         raise HTTPException(status_code=400, detail=f"{exc.message}")
     except crud.CRUDInternalError as exc:
         raise HTTPException(status_code=500, detail=f"{exc.message}")
 
 
-@router.post("/", response_model=schemas.Image)
+@router.get("/", response_model=schemas.ImagePage)
+@admission.limit("read")
+async def list_images(
+    cursor: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=settings.LIST_MAX_LIMIT),
+    name_prefix: Optional[str] = Query(default=None, min_length=1),
+    image_hash: Optional[str] = Query(default=None, alias="hash", min_length=1),
+    hash_prefix: Optional[str] = Query(default=None, min_length=1),
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImagePage:
+    try:
+        images, next_cursor = await crud.image.list_images(
+            db,
+            limit,
+            cursor=cursor,
+            name_prefix=name_prefix,
+            image_hash=image_hash,
+            hash_prefix=hash_prefix,
+        )
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+    except crud.CRUDInternalError as exc:
+        raise HTTPException(status_code=500, detail=f"{exc.message}")
+
+    return schemas.ImagePage(
+        images=[schemas.Image.from_orm(image) for image in images],
+        next_cursor=next_cursor,
+    )
+
+
+@router.post("/", response_model=schemas.Image, responses={202: {"model": schemas.Job}})
+@admission.limit("ingest")
 async def create_image(
     image: schemas.ImageUrl,
-    db: Session = Depends(deps.get_db),
-) -> schemas.Image:
+    run_async: bool = RunAsync,
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.Image | JSONResponse:
     try:
-        return crud.image.create_image(db, image_url=image, image_upload=None)
+        if run_async:
+            return await _enqueue(db, schemas.JobKind.url, jsonable_encoder(image))
+        return await crud.image.create_image(db, image_url=image, image_upload=None)
     except crud.CRUDBadRequestError as exc:
         raise HTTPException(status_code=400, detail=f"{exc.message}")
     except crud.CRUDInternalError as exc:
@@ -43,37 +132,213 @@ async def create_image(
 @router.get(
     "/{source_image_id}/diff/{target_image_id}", response_model=schemas.ImageDiff
 )
+@admission.limit("read")
 async def get_image_diff(
     source_image_id: uuid.UUID,
     target_image_id: uuid.UUID,
-    db: Session = Depends(deps.get_db),
+    method: schemas.HashMethod = schemas.HashMethod.phash,
+    db: AsyncSession = Depends(deps.get_db),
 ) -> schemas.ImageDiff:
-    try:
-        source_image = crud.image.get_image(db, image_id=source_image_id)
-        target_image = crud.image.get_image(db, image_id=target_image_id)
+    async def image_diff() -> Optional[float]:
+        images = await crud.image.get_images(db, [source_image_id, target_image_id])
+        source_image = images.get(str(source_image_id))
+        target_image = images.get(str(target_image_id))
         if not source_image or not target_image:
-            raise HTTPException(status_code=404, detail="Image not found")
+            return None
+        return await crud.image.image_diff(db, source_image, target_image, method)
 
-        diff = crud.image.image_diff(source_image, target_image)
+    try:
+        diff = await diff_flight.run(
+            (source_image_id, target_image_id, method), image_diff
+        )
     except crud.CRUDBadRequestError as exc:
         raise HTTPException(status_code=400, detail=f"{exc.message}")
     except crud.CRUDInternalError as exc:
         raise HTTPException(status_code=500, detail=f"{exc.message}")
 
+    if diff is None:
+        raise HTTPException(status_code=404, detail="Image not found")
     return schemas.ImageDiff(
-        source_image_id=source_image.id,
-        target_image_id=target_image.id,
+        source_image_id=source_image_id,
+        target_image_id=target_image_id,
         diff=diff,
     )
 
 
+@router.post("/lookup", response_model=schemas.ImageLookupResult)
+@admission.limit("read")
+async def lookup_images(
+    lookup: schemas.ImageLookup,
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImageLookupResult:
+    try:
+        images, missing = await crud.image.lookup_images(db, lookup.ids)
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+    except crud.CRUDInternalError as exc:
+        raise HTTPException(status_code=500, detail=f"{exc.message}")
+
+    return schemas.ImageLookupResult(
+        images=[schemas.Image.from_orm(image) for image in images], missing=missing
+    )
+
+
+@router.post("/diff-matrix", response_model=schemas.ImageDiffMatrix)
+@admission.limit("read")
+async def diff_matrix(
+    query: schemas.ImageDiffMatrixQuery,
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImageDiffMatrix:
+    try:
+        images, missing = await crud.image.lookup_images(
+            db, query.source_ids + query.target_ids
+        )
+        if missing:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        sources = images[: len(query.source_ids)]
+        targets = images[len(query.source_ids) :]
+        diffs = await crud.image.diff_matrix(db, sources, targets, query.method)
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+    except crud.CRUDInternalError as exc:
+        raise HTTPException(status_code=500, detail=f"{exc.message}")
+
+    return schemas.ImageDiffMatrix(
+        source_ids=query.source_ids, target_ids=query.target_ids, diffs=diffs.tolist()
+    )
+
+
+@router.get("/{image_id}/similar", response_model=schemas.ImageSimilar)
+@admission.limit("read")
+async def get_similar_images(
+    image_id: uuid.UUID,
+    max_distance: int = Query(default=10, ge=0, le=64),
+    limit: int = Query(default=10, ge=1, le=1000),
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImageSimilar:
+    try:
+        image = await crud.image.get_image(db, image_id=image_id)
+        if not image:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        matches = await crud.image.similar_images(image, max_distance, limit)
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+    except crud.CRUDInternalError as exc:
+        raise HTTPException(status_code=500, detail=f"{exc.message}")
+
+    return schemas.ImageSimilar(
+        source_image_id=image.id,
+        images=[
+            schemas.ImageMatch(image_id=match_id, diff=distance)
+            for match_id, distance in matches
+        ],
+    )
+
+
+@router.get("/{image_id}/render", response_class=FileResponse)
+@admission.limit("read")
+async def render_image(
+    image_id: uuid.UUID,
+    w: int = Query(ge=1, le=settings.RENDER_MAX_DIMENSION),
+    h: int = Query(ge=1, le=settings.RENDER_MAX_DIMENSION),
+    mode: schemas.RenderMode = schemas.RenderMode.crop,
+    image_format: Optional[schemas.RenderFormat] = Query(None, alias="format"),
+    db: AsyncSession = Depends(deps.get_db),
+) -> FileResponse:
+    try:
+        image = await crud.image.get_image(db, image_id=image_id)
+        if not image:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        # Cached renditions are plain reads, only renders take a crop slot
+        path, media_type = await crud.image.render_image(
+            db, image, w, h, mode, image_format
+        )
+    except Rejected as exc:
+        raise HTTPException(
+            status_code=admission.rejection_status(exc),
+            detail=exc.message,
+            headers=admission.rejection_headers(exc),
+        )
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+    except crud.CRUDInternalError as exc:
+        raise HTTPException(status_code=500, detail=f"{exc.message}")
+
+    return FileResponse(path, media_type=media_type)
+
+
+def _content_headers(etag: str) -> Dict[str, str]:
+    return {
+        "etag": etag,
+        "cache-control": f"public, max-age={settings.CONTENT_CACHE_MAX_AGE}",
+    }
+
+
+@router.get("/{image_id}/content", response_class=RangeFileResponse)
+@admission.limit("read")
+async def get_image_content(
+    image_id: uuid.UUID,
+    request: Request,
+    db: AsyncSession = Depends(deps.get_db),
+) -> Response:
+    if_none_match = request.headers.get("if-none-match")
+    try:
+        image = await crud.image.get_image(db, image_id=image_id)
+        if not image:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        # Blobs are tagged by their digest, revalidating them needs no storage
+        if image.blob_digest and if_none_match:
+            etag = f'"{image.blob_digest}"'
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=_content_headers(etag))
+
+        image, key, size, media_type = await crud.image.get_content(db, image)
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+    except crud.CRUDInternalError as exc:
+        raise HTTPException(status_code=500, detail=f"{exc.message}")
+
+    # Legacy images are rewritten as blobs when cropped, hash and size suffice
+    etag = f'"{image.blob_digest or f"{image.hash}-{size:x}"}"'
+    headers = _content_headers(etag)
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag:
+        range_header = None
+
+    storage = get_storage()
+    path = storage.local_path(key)
+    if path is not None:
+        stat_result = await run_io(os.stat, path)
+        return RangeFileResponse(
+            path, stat_result, media_type, range_header=range_header, headers=headers
+        )
+    return RangeStreamResponse(
+        functools.partial(storage.stream, key),
+        size,
+        media_type,
+        range_header=range_header,
+        headers=headers,
+    )
+
+
 @router.get("/{image_id}", response_model=schemas.Image)
+@admission.limit("read")
 async def get_image(
     image_id: uuid.UUID,
-    db: Session = Depends(deps.get_db),
-) -> schemas.Image:
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImageInDB:
     try:
-        image = crud.image.get_image(db, image_id=image_id)
+        image = await image_flight.run(
+            image_id, functools.partial(crud.image.get_image, db, image_id=image_id)
+        )
     except crud.CRUDBadRequestError as exc:
         raise HTTPException(status_code=400, detail=f"{exc.message}")
     except crud.CRUDInternalError as exc:
@@ -84,21 +349,103 @@ async def get_image(
     return image
 
 
-@router.put("/{image_id}", response_class=Response)
+@router.put(
+    "/{image_id}", response_class=Response, responses={202: {"model": schemas.Job}}
+)
+@admission.limit("crop")
 async def crop_image(
     image_id: uuid.UUID,
     width: int = 0,
     height: int = 0,
-    db: Session = Depends(deps.get_db),
+    run_async: bool = RunAsync,
+    db: AsyncSession = Depends(deps.get_db),
 ) -> Response:
     try:
-        image = crud.image.get_image(db, image_id=image_id)
+        image = await crud.image.get_image(db, image_id=image_id)
         if not image:
             raise HTTPException(status_code=404, detail="Images not found")
-        _ = crud.image.crop_image(db, image, width, height)
+        if run_async:
+            return await _enqueue(
+                db,
+                schemas.JobKind.crop,
+                {"image_id": str(image_id), "width": width, "height": height},
+                image_id=str(image_id),
+            )
+        _ = await crud.image.crop_image(db, image, width, height)
     except crud.CRUDBadRequestError as exc:
         raise HTTPException(status_code=400, detail=f"{exc.message}")
     except crud.CRUDInternalError as exc:
         raise HTTPException(status_code=500, detail=f"{exc.message}")
 
     return Response(status_code=204)
+
+
+def _batch_response(results: List[crud.BatchResult]) -> schemas.ImageBatch:
+    items = []
+    for index, result in enumerate(results):
+        if isinstance(result, (crud.CRUDBadRequestError, crud.CRUDInternalError)):
+            items.append(
+                schemas.ImageBatchItem(
+                    index=index,
+                    status=schemas.ImageBatchStatus.failed,
+                    detail=result.message,
+                )
+            )
+        else:
+            items.append(
+                schemas.ImageBatchItem(
+                    index=index,
+                    status=schemas.ImageBatchStatus.created,
+                    image=schemas.Image.from_orm(result),
+                )
+            )
+    return schemas.ImageBatch(items=items)
+
+
+@router.post("/batch", response_model=schemas.ImageBatch)
+@admission.limit("ingest")
+async def create_images(
+    batch: schemas.ImageUrlBatch,
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImageBatch:
+    try:
+        results = await crud.image.create_images(
+            db, image_urls=batch.images, image_uploads=None
+        )
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+
+    return _batch_response(results)
+
+
+@router.post("/batch/upload", response_model=schemas.ImageBatch)
+@admission.limit("ingest")
+async def upload_images(
+    files: List[UploadFile],
+    names: Optional[List[str]] = Form(None),
+    descriptions: Optional[List[str]] = Form(None),
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.ImageBatch:
+    if (names and len(names) != len(files)) or (
+        descriptions and len(descriptions) != len(files)
+    ):
+        raise HTTPException(
+            status_code=400, detail="Names and descriptions must match the files"
+        )
+
+    try:
+        uploads = [
+            schemas.ImageUpload(
+                file=file,
+                name=names[index] if names else file.filename or "",
+                description=descriptions[index] if descriptions else None,
+            )
+            for index, file in enumerate(files)
+        ]
+        results = await crud.image.create_images(
+            db, image_urls=None, image_uploads=uploads
+        )
+    except crud.CRUDBadRequestError as exc:
+        raise HTTPException(status_code=400, detail=f"{exc.message}")
+
+    return _batch_response(results)
@@ -0,0 +1,22 @@
+import uuid
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import schemas, crud
+from app.api import admission, deps
+
+
+router = APIRouter()
+
+
+@router.get("/{job_id}", response_model=schemas.Job)
+@admission.limit("read")
+async def get_job(
+    job_id: uuid.UUID,
+    db: AsyncSession = Depends(deps.get_db),
+) -> schemas.Job:
+    job = await crud.job.get_job(db, job_id=job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -1,11 +1,10 @@
-from typing import Generator
+from typing import AsyncGenerator
 
-from app.db.session import SessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.db.session import AsyncSessionLocal
 
-def get_db() -> Generator:
-    try:
-        db = SessionLocal()
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,176 @@
+import os
+import re
+
+from typing import AsyncIterator, Callable, Mapping, Optional, Tuple
+
+import anyio
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) of a single byte range header.
+
+    Returns None when the header is not a single well formed range, in which
+    case the whole file is served. Raises ValueError when the range can not
+    be satisfied.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag."""
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in (tag.removeprefix("W/") for tag in candidates)
+
+
+class _RangeResponse(Response):
+    """Status and headers of a response to an optional single range request."""
+
+    def __init__(
+        self,
+        size: int,
+        media_type: str,
+        range_header: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+
+        self.offset, self.count = 0, size
+        self.status_code = 200
+        self.headers["accept-ranges"] = "bytes"
+        try:
+            byte_range = parse_range(range_header, size) if range_header else None
+        except ValueError:
+            self.status_code, self.count = 416, 0
+            self.headers["content-range"] = f"bytes */{size}"
+        else:
+            if byte_range is not None:
+                start, end = byte_range
+                self.status_code = 206
+                self.offset, self.count = start, end - start + 1
+                self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        self.headers["content-length"] = str(self.count)
+
+    async def _start(self, send: Send) -> bool:
+        """Send the response start, False when there is no body to follow."""
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if self.count == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return False
+        return True
+
+
+class RangeFileResponse(_RangeResponse):
+    """Serve a file, or a single byte range of it, without buffering it.
+
+    When the server implements the ASGI zero copy send extension the bytes go
+    from the file descriptor to the socket with sendfile, otherwise they are
+    read in chunks on a worker thread.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        stat_result: os.stat_result,
+        media_type: str,
+        range_header: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        self.path = path
+        super().__init__(stat_result.st_size, media_type, range_header, headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not await self._start(send):
+            return
+
+        with open(self.path, "rb") as file:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": self.offset,
+                        "count": self.count,
+                    }
+                )
+                return
+
+            offset, remaining = self.offset, self.count
+            while remaining > 0:
+                chunk = await anyio.to_thread.run_sync(
+                    os.pread, file.fileno(), min(self.chunk_size, remaining), offset
+                )
+                if not chunk:
+                    break
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": remaining > 0,
+                    }
+                )
+            if remaining > 0:
+                # File shrank under us, close the body anyway
+                await send({"type": "http.response.body", "body": b""})
+
+
+class RangeStreamResponse(_RangeResponse):
+    """Serve an object, or a single byte range of it, from a chunk stream.
+
+    `stream(start, end)` yields the bytes of the inclusive range, it is only
+    called once the range is known.
+    """
+
+    def __init__(
+        self,
+        stream: Callable[[int, int], AsyncIterator[bytes]],
+        size: int,
+        media_type: str,
+        range_header: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        self.stream = stream
+        super().__init__(size, media_type, range_header, headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not await self._start(send):
+            return
+
+        remaining = self.count
+        async for chunk in self.stream(self.offset, self.offset + self.count - 1):
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if remaining <= 0:
+                break
+        await send({"type": "http.response.body", "body": b""})
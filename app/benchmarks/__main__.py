@@ -0,0 +1,154 @@
+"""Benchmark the image pipeline.
+
+    python -m app.benchmarks run -o results.json
+    python -m app.benchmarks run -o results.json --baseline baseline.json
+    python -m app.benchmarks compare baseline.json results.json
+
+`run` works in a temporary directory with its own SQLite database, so it
+never touches the configured one. `compare` exits with status 1 when a
+benchmark regressed past the thresholds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from typing import Any, Dict, List, Tuple
+
+from app.benchmarks import corpus, report
+
+
+def _resolution(value: str) -> Tuple[int, int]:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def _threshold(value: str) -> Tuple[str, float]:
+    name, threshold = value.rsplit("=", 1)
+    return name, float(threshold)
+
+
+def _check(baseline_path: str, current: Dict[str, Any], args: Any) -> int:
+    with open(baseline_path) as handler:
+        baseline = json.load(handler)
+    regressions = report.compare(
+        baseline,
+        current,
+        latency_threshold=args.max_latency_regression,
+        throughput_threshold=args.max_throughput_regression,
+        latency_metric=args.latency_metric,
+        thresholds=dict(args.threshold),
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+def run(args: Any) -> int:
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    # Settings are read on import, point them at the sandbox first
+    os.environ.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{workdir}/benchmark.db",
+        IMAGE_UPLOAD_DIR=f"{workdir}/images",
+        RENDER_CACHE_DIR=f"{workdir}/renders",
+        HASH_INDEX_PATH=f"{workdir}/hash_index.bin",
+        STORAGE_BACKEND="local",
+        JOB_WORKERS="0",
+    )
+    os.makedirs(f"{workdir}/images")
+    from app.benchmarks import suite
+    from app.core.config import settings
+
+    images = corpus.generate(args.count, args.formats, args.resolutions, seed=args.seed)
+    results = asyncio.run(suite.run(images, args.concurrency))
+
+    output = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "cpu_pool_workers": settings.CPU_POOL_WORKERS,
+            "io_pool_workers": settings.IO_POOL_WORKERS,
+            "seed": args.seed,
+            "count": args.count,
+            "concurrency": args.concurrency,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as handler:
+        json.dump(output, handler, indent=2)
+    print(report.format_results(results))
+
+    if args.baseline:
+        return _check(args.baseline, output, args)
+    return 0
+
+
+def compare(args: Any) -> int:
+    with open(args.current) as handler:
+        return _check(args.baseline, json.load(handler), args)
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    thresholds = argparse.ArgumentParser(add_help=False)
+    thresholds.add_argument(
+        "--max-latency-regression",
+        type=float,
+        default=0.2,
+        help="allowed latency increase, as a fraction of the baseline",
+    )
+    thresholds.add_argument(
+        "--max-throughput-regression",
+        type=float,
+        default=0.2,
+        help="allowed throughput decrease, as a fraction of the baseline",
+    )
+    thresholds.add_argument("--latency-metric", default="p95_ms")
+    thresholds.add_argument(
+        "--threshold",
+        type=_threshold,
+        action="append",
+        default=[],
+        metavar="NAME=FRACTION",
+        help="both thresholds for a single benchmark, may be repeated",
+    )
+
+    run_parser = commands.add_parser("run", parents=[thresholds])
+    run_parser.add_argument("-o", "--output", default="benchmark.json")
+    run_parser.add_argument("--baseline", help="compare the run against this file")
+    run_parser.add_argument(
+        "--count", type=int, default=20, help="images per format and resolution"
+    )
+    run_parser.add_argument(
+        "--formats", nargs="+", choices=list(corpus.FORMATS), default=["jpeg", "png"]
+    )
+    run_parser.add_argument(
+        "--resolutions",
+        nargs="+",
+        type=_resolution,
+        default=corpus.RESOLUTIONS,
+        metavar="WxH",
+    )
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", parents=[thresholds])
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
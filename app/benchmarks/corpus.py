@@ -0,0 +1,97 @@
+import io
+
+from typing import Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+
+from PIL import Image as PILImage
+
+
+FORMATS = {"jpeg": "JPEG", "png": "PNG", "gif": "GIF", "webp": "WEBP"}
+# Formats encoded as animations, of this many 100 ms frames
+ANIMATED_FORMATS = {"gif", "webp"}
+ANIMATION_FRAMES = 24
+RESOLUTIONS = [(320, 240), (1024, 768), (1920, 1080)]
+
+
+class CorpusImage(NamedTuple):
+    group: str
+    name: str
+    content: bytes
+    width: int
+    height: int
+
+
+def synthetic_image(
+    rng: np.random.Generator, width: int, height: int
+) -> PILImage.Image:
+    """Smooth gradients with a few shapes and some noise, RGB pixels.
+
+    Closer to a photo than uniform noise, so encoders and hashes do the
+    amount of work they would on real uploads.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        fx, fy, phase = rng.uniform(0.5, 4, 2).tolist() + [rng.uniform(0, np.pi)]
+        pixels[..., channel] = 127 + 100 * np.sin(
+            fx * np.pi * x / width + fy * np.pi * y / height + phase
+        )
+    for _ in range(8):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        radius = rng.integers(min(width, height) // 20, min(width, height) // 4)
+        mask = (x - cx) ** 2 + (y - cy) ** 2 < radius**2
+        pixels[mask] = rng.integers(0, 256, 3)
+    pixels += rng.normal(0, 8, pixels.shape)
+    return PILImage.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def synthetic_animation(
+    rng: np.random.Generator, width: int, height: int
+) -> List[PILImage.Image]:
+    """A synthetic image panning across the frame, a keyframe every few frames."""
+    pixels = np.asarray(synthetic_image(rng, width, height))
+    step = max(width // ANIMATION_FRAMES, 1)
+    return [
+        PILImage.fromarray(np.roll(pixels, i * step, axis=1))
+        for i in range(ANIMATION_FRAMES)
+    ]
+
+
+def generate(
+    count: int,
+    formats: Iterable[str] = FORMATS,
+    resolutions: Iterable[Tuple[int, int]] = RESOLUTIONS,
+    seed: int = 0,
+) -> List[CorpusImage]:
+    """`count` distinct images for every format and resolution.
+
+    The same seed always gives the same bytes, so runs are comparable.
+    """
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for width, height in resolutions:
+        for fmt in formats:
+            group = f"{fmt}-{width}x{height}"
+            for i in range(count):
+                buffer = io.BytesIO()
+                if fmt in ANIMATED_FORMATS:
+                    first, *frames = synthetic_animation(rng, width, height)
+                    first.save(
+                        buffer,
+                        format=FORMATS[fmt],
+                        save_all=True,
+                        append_images=frames,
+                        duration=100,
+                        loop=0,
+                    )
+                else:
+                    synthetic_image(rng, width, height).save(
+                        buffer, format=FORMATS[fmt]
+                    )
+                corpus.append(
+                    CorpusImage(
+                        group, f"{group}-{i}.{fmt}", buffer.getvalue(), width, height
+                    )
+                )
+    return corpus
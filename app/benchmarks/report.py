@@ -0,0 +1,71 @@
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+
+Result = Dict[str, float]
+
+
+def summarize(latencies: Sequence[float], elapsed: float) -> Result:
+    """Latency percentiles in milliseconds and operations per second."""
+    millis = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(millis, [50, 95, 99]).tolist()
+    return {
+        "count": len(latencies),
+        "mean_ms": float(millis.mean()),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def compare(
+    baseline: Dict[str, Any],
+    current: Dict[str, Any],
+    latency_threshold: float = 0.2,
+    throughput_threshold: float = 0.2,
+    latency_metric: str = "p95_ms",
+    thresholds: Dict[str, float] | None = None,
+) -> List[str]:
+    """Regressions of `current` against `baseline`, empty when there are none.
+
+    A benchmark regresses when its latency grew, or its throughput dropped,
+    by more than the threshold (a fraction of the baseline). `thresholds`
+    overrides both for the benchmarks it names. Benchmarks missing from
+    either run are skipped.
+    """
+    thresholds = thresholds or {}
+    regressions = []
+    for name, before in sorted(baseline["results"].items()):
+        after = current["results"].get(name)
+        if after is None:
+            continue
+        slower = thresholds.get(name, latency_threshold)
+        fewer = thresholds.get(name, throughput_threshold)
+
+        if after[latency_metric] > before[latency_metric] * (1 + slower):
+            regressions.append(
+                f"{name}: {latency_metric} {before[latency_metric]:.2f} -> "
+                f"{after[latency_metric]:.2f}"
+            )
+        if after["per_second"] < before["per_second"] * (1 - fewer):
+            regressions.append(
+                f"{name}: per_second {before['per_second']:.2f} -> "
+                f"{after['per_second']:.2f}"
+            )
+    return regressions
+
+
+def format_results(results: Dict[str, Result]) -> str:
+    lines = [
+        f"{'benchmark':<40} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'ops/s':>9}"
+    ]
+    for name, result in results.items():
+        lines.append(
+            f"{name:<40} {result['count']:>5} {result['p50_ms']:>9.2f} "
+            f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+            f"{result['per_second']:>9.2f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,167 @@
+import asyncio
+import time
+import uuid
+
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple, TypeVar
+
+import httpx
+
+import app.schemas as schemas
+
+from app import crud
+from app.benchmarks.corpus import ANIMATED_FORMATS, CorpusImage
+from app.benchmarks.report import Result, summarize
+from app.core.config import settings
+from app.core.storage import get_storage, temp_path
+from app.db.session import AsyncSessionLocal
+from app.main import app
+
+
+T = TypeVar("T")
+
+
+async def measure(
+    operation: Callable[[T], Awaitable[Any]], items: Sequence[T], concurrency: int
+) -> Result:
+    """Run `operation` on every item, at most `concurrency` at a time."""
+    latencies: List[float] = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def timed(item: T) -> None:
+        async with slots:
+            start = time.perf_counter()
+            await operation(item)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(item) for item in items))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def _store(images: Sequence[CorpusImage]) -> List[str]:
+    """Put the corpus in storage as is, for the benchmarks below the API."""
+    storage = get_storage()
+    keys = []
+    for image in images:
+        path = temp_path()
+        with open(path, "wb") as handler:
+            handler.write(image.content)
+        key = f"benchmark/{uuid.uuid4()}"
+        await storage.put(key, path)
+        keys.append(key)
+    return keys
+
+
+async def _crud_benchmarks(
+    group: str, images: Sequence[CorpusImage], ids: List[str], concurrency: int
+) -> Dict[str, Result]:
+    results = {}
+    keys = await _store(images)
+    results[f"hash_image[{group}]"] = await measure(
+        crud.image.hash_image, keys, concurrency
+    )
+    if group.split("-")[0] in ANIMATED_FORMATS:
+        # Only JPEG and PNG images can be cropped
+        return results
+
+    async with AsyncSessionLocal() as db:
+        stored = await crud.image.get_images(db, [uuid.UUID(i) for i in ids])
+    width, height = images[0].width // 2, images[0].height // 2
+
+    async def crop(image_id: str) -> None:
+        async with AsyncSessionLocal() as db:
+            await crud.image.crop_image(db, stored[image_id], width, height)
+
+    results[f"crop_image[{group}]"] = await measure(crop, ids, concurrency)
+    return results
+
+
+async def _diff_benchmarks(ids: List[str], concurrency: int) -> Dict[str, Result]:
+    results = {}
+    async with AsyncSessionLocal() as db:
+        stored = await crud.image.get_images(db, [uuid.UUID(i) for i in ids])
+    pairs = list(zip(ids, ids[1:] + ids[:1]))
+
+    for method in (
+        schemas.HashMethod.phash,
+        schemas.HashMethod.dhash,
+        schemas.HashMethod.frames,
+    ):
+
+        async def diff(pair: Tuple[str, str]) -> None:
+            async with AsyncSessionLocal() as db:
+                await crud.image.image_diff(
+                    db, stored[pair[0]], stored[pair[1]], method
+                )
+
+        results[f"image_diff[{method.value}]"] = await measure(diff, pairs, concurrency)
+    return results
+
+
+async def _http_benchmarks(
+    client: httpx.AsyncClient,
+    group: str,
+    images: Sequence[CorpusImage],
+    concurrency: int,
+) -> Tuple[Dict[str, Result], List[str]]:
+    results = {}
+    ids: List[str] = []
+
+    async def upload(image: CorpusImage) -> None:
+        response = await client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": image.name, "description": "benchmark"},
+            files={"file": (image.name, image.content)},
+        )
+        response.raise_for_status()
+        ids.append(response.json()["id"])
+
+    async def get(image_id: str) -> None:
+        response = await client.get(f"{settings.API_V1_STR}/images/{image_id}")
+        response.raise_for_status()
+
+    results[f"http_upload[{group}]"] = await measure(upload, images, concurrency)
+    results[f"http_get[{group}]"] = await measure(get, ids, concurrency)
+    return results, ids
+
+
+async def run(corpus: Sequence[CorpusImage], concurrency: int) -> Dict[str, Result]:
+    """Every benchmark over the corpus, keyed `name[group]`.
+
+    Runs against the ASGI app in process, with its lifespan, so nothing but
+    the app itself is measured.
+    """
+    groups: Dict[str, List[CorpusImage]] = defaultdict(list)
+    for image in corpus:
+        groups[image.group].append(image)
+
+    results: Dict[str, Result] = {}
+    all_ids: List[str] = []
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(app=app, base_url="http://benchmark") as client:
+            for group, images in groups.items():
+                http_results, ids = await _http_benchmarks(
+                    client, group, images, concurrency
+                )
+                results.update(http_results)
+                all_ids.extend(ids)
+
+            pairs = list(zip(all_ids, all_ids[1:] + all_ids[:1]))
+
+            async def diff(pair: Tuple[str, str]) -> None:
+                response = await client.get(
+                    f"{settings.API_V1_STR}/images/{pair[0]}/diff/{pair[1]}"
+                )
+                response.raise_for_status()
+
+            results["http_diff"] = await measure(diff, pairs, concurrency)
+
+        results.update(await _diff_benchmarks(all_ids, concurrency))
+        # Crops replace the blobs, keep them last
+        start = 0
+        for group, images in groups.items():
+            ids = all_ids[start : start + len(images)]
+            start += len(images)
+            results.update(await _crud_benchmarks(group, images, ids, concurrency))
+    return results
@@ -0,0 +1,173 @@
+import asyncio
+import time
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Tuple
+
+from app.core import metrics
+from app.core.config import settings
+
+
+# Endpoint classes with their own concurrency limit, wait queue and rate limit
+ENDPOINT_CLASSES = ("ingest", "crop", "read")
+
+
+class Rejected(Exception):
+    def __init__(self, message: str, retry_after: float) -> None:
+        self.message = message
+        self.retry_after = retry_after
+
+
+class Overloaded(Rejected):
+    """Every slot is taken and the queue is full, or the wait timed out."""
+
+
+class RateLimited(Rejected):
+    """The client used up its tokens."""
+
+
+class Limiter:
+    """Let `ADMISSION_CONCURRENCY` requests run, queue `ADMISSION_QUEUE` more.
+
+    Requests are admitted in arrival order. One arriving to a full queue, or
+    still waiting after `ADMISSION_QUEUE_TIMEOUT`, is refused at once rather
+    than piling up: under overload the admitted ones keep their latency and
+    the others learn to retry instead of timing out. Classes without a
+    concurrency limit admit everything.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.running = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self) -> None:
+        limit = settings.ADMISSION_CONCURRENCY.get(self.name)
+        if limit is None or (self.running < limit and not self._waiters):
+            self.running += 1
+            return
+        if len(self._waiters) >= settings.ADMISSION_QUEUE.get(self.name, 0):
+            REJECTIONS.inc(endpoint_class=self.name, reason="queue_full")
+            raise Overloaded(
+                "Too many requests in progress", settings.ADMISSION_RETRY_AFTER
+            )
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        start = time.perf_counter()
+        try:
+            # The slot is handed over by `release`, `running` already counts it
+            await asyncio.wait_for(waiter, settings.ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            REJECTIONS.inc(endpoint_class=self.name, reason="timeout")
+            raise Overloaded(
+                "Timed out waiting for a slot", settings.ADMISSION_RETRY_AFTER
+            )
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            WAIT_SECONDS.observe(time.perf_counter() - start, endpoint_class=self.name)
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+class RateLimiter:
+    """A token bucket per client, refilled at `RATE_LIMITS` tokens a second.
+
+    Buckets hold up to `RATE_LIMIT_BURST` tokens, each request takes one.
+    The least recently seen clients are forgotten past
+    `RATE_LIMIT_MAX_CLIENTS`, which only gives them a full bucket again.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # Tokens left and when they were counted, by client
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def check(self, client: str) -> None:
+        rate = settings.RATE_LIMITS.get(self.name)
+        if not rate:
+            return
+        burst = settings.RATE_LIMIT_BURST.get(self.name, max(rate, 1))
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        self._buckets[client] = (tokens - 1 if allowed else tokens, now)
+        while len(self._buckets) > settings.RATE_LIMIT_MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+        if not allowed:
+            REJECTIONS.inc(endpoint_class=self.name, reason="rate_limited")
+            raise RateLimited("Rate limit exceeded", (1 - tokens) / rate)
+
+
+REJECTIONS: metrics.Counter = metrics.registry.register(
+    metrics.Counter(
+        "admission_rejections_total",
+        "Requests refused by admission control, by reason",
+        ["endpoint_class", "reason"],
+    )
+)
+WAIT_SECONDS: metrics.Histogram = metrics.registry.register(
+    metrics.Histogram(
+        "admission_wait_seconds",
+        "Time requests waited in the admission queue",
+        ["endpoint_class"],
+    )
+)
+
+limiters: Dict[str, Limiter] = {name: Limiter(name) for name in ENDPOINT_CLASSES}
+rate_limiters: Dict[str, RateLimiter] = {
+    name: RateLimiter(name) for name in ENDPOINT_CLASSES
+}
+
+
+def _running() -> Dict[metrics.Labels, float]:
+    return {(name,): limiter.running for name, limiter in limiters.items()}
+
+
+def _queued() -> Dict[metrics.Labels, float]:
+    return {(name,): limiter.queued for name, limiter in limiters.items()}
+
+
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "admission_in_flight",
+        "Requests admitted and running, by endpoint class",
+        "gauge",
+        _running,
+        ["endpoint_class"],
+    )
+)
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "admission_queue_depth",
+        "Requests waiting to be admitted, by endpoint class",
+        "gauge",
+        _queued,
+        ["endpoint_class"],
+    )
+)
@@ -0,0 +1,46 @@
+from typing import NamedTuple
+
+from app.core.executor import run_io
+from app.core.metrics import stage
+from app.core.storage import get_storage, remove
+
+
+class StoredBlob(NamedTuple):
+    digest: str
+    path: str
+    size: int
+
+
+class TempBlob(NamedTuple):
+    """Bytes written to a local temp file, not stored yet."""
+
+    digest: str
+    tmp_path: str
+    size: int
+
+    @property
+    def path(self) -> str:
+        return blob_path(self.digest)
+
+
+def blob_path(digest: str) -> str:
+    """Sharded storage key of a blob, `ab/cd/abcd...`."""
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+async def commit(blob: TempBlob) -> StoredBlob:
+    """Move a fully written temp file to its content address.
+
+    When the blob is already stored the temp file is dropped instead, the
+    bytes are identical by construction. The caller must hold a reference to
+    the blob in an open transaction, or a concurrent release could delete
+    the stored bytes right after they were found.
+    """
+    storage = get_storage()
+    if await storage.exists(blob.path):
+        await run_io(remove, blob.tmp_path)
+    else:
+        with stage("store") as timer:
+            await storage.put(blob.path, blob.tmp_path)
+            timer["size"] = blob.size
+    return StoredBlob(blob.digest, blob.path, blob.size)
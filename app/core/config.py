@@ -1,4 +1,9 @@
-from pydantic import BaseSettings
+import os
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseSettings, validator
+
+from app.core import imaging
 
 
 class Settings(BaseSettings):
@@ -7,9 +12,120 @@ class Settings(BaseSettings):
 
     # Local storage
     IMAGE_UPLOAD_DIR: str = "images"
+    MAX_IMAGE_SIZE: int = 50 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 64 * 1024
+    BATCH_MAX_ITEMS: int = 100
+    LIST_MAX_LIMIT: int = 1000
+    # Ids per bulk lookup or diff matrix, sources and targets together
+    LOOKUP_MAX_ITEMS: int = 1000
+    CONTENT_CACHE_MAX_AGE: int = 24 * 60 * 60
+    # Endpoints whose concurrent identical requests share one execution
+    SINGLE_FLIGHT_GROUPS: List[str] = ["get_image", "get_image_diff", "render"]
+
+    # Admission control, per process and endpoint class ("ingest", "crop" for
+    # crops and renditions, "read"): requests running at once, requests
+    # waiting for a slot and for how long. Past that they get a 503 with
+    # Retry-After
+    ADMISSION_CONCURRENCY: Dict[str, int] = {"ingest": 16, "crop": 8, "read": 256}
+    ADMISSION_QUEUE: Dict[str, int] = {"ingest": 64, "crop": 32, "read": 1024}
+    ADMISSION_QUEUE_TIMEOUT: float = 10.0
+    ADMISSION_RETRY_AFTER: float = 1.0
+    # Requests per second and burst allowed to each client per endpoint
+    # class, unlisted classes are not rate limited; past that a 429. Clients
+    # are told apart by address, or behind RATE_LIMIT_TRUSTED_HOPS proxies by
+    # the address the outermost one appended to RATE_LIMIT_CLIENT_HEADER
+    RATE_LIMITS: Dict[str, float] = {}
+    RATE_LIMIT_BURST: Dict[str, int] = {}
+    RATE_LIMIT_CLIENT_HEADER: Optional[str] = None
+    RATE_LIMIT_TRUSTED_HOPS: int = 1
+    RATE_LIMIT_MAX_CLIENTS: int = 100_000
+
+    # Where image bytes are kept, "local" (IMAGE_UPLOAD_DIR) or "s3". With s3
+    # IMAGE_UPLOAD_DIR only holds temp files, so replicas can share nothing
+    STORAGE_BACKEND: Literal["local", "s3"] = "local"
+    S3_ENDPOINT_URL: str = "http://localhost:9000"
+    S3_BUCKET: str = "images"
+    S3_REGION: str = "us-east-1"
+    S3_ACCESS_KEY_ID: Optional[str] = None
+    S3_SECRET_ACCESS_KEY: Optional[str] = None
+    S3_TIMEOUT: float = 30.0
+    S3_MAX_CONNECTIONS: int = 50
+    S3_MAX_KEEPALIVE: int = 20
+    S3_MULTIPART_THRESHOLD: int = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNK_SIZE: int = 8 * 1024 * 1024
+    S3_UPLOAD_CONCURRENCY: int = 4
+
+    # Image metadata cache, "local" to each process, "redis" to share it
+    # between processes (needs the redis package) or "none"
+    METADATA_CACHE_BACKEND: Literal["local", "redis", "none"] = "local"
+    METADATA_CACHE_MAX_ENTRIES: int = 100_000
+    METADATA_CACHE_TTL: float = 5 * 60
+    METADATA_CACHE_REDIS_URL: str = "redis://localhost:6379/0"
+
+    # Renditions cache
+    RENDER_CACHE_DIR: str = "renders"
+    RENDER_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    RENDER_MAX_DIMENSION: int = 4096
 
-    # Database
+    # Hashes computed on ingest, among imaging.HASH_METHODS (checked at
+    # startup), phash is always included
+    HASH_METHODS: List[str] = ["phash", "dhash", "whash", "colorhash"]
+    # Memory-mapped snapshot of every phash, shared by the processes of a host,
+    # and the number of appended records folded into its sorted part at once
+    HASH_INDEX_PATH: str = "hash_index.bin"
+    HASH_INDEX_JOURNAL_MAX: int = 100_000
+    # Frames of animated GIF and WebP images hashed for sequence diffs:
+    # "keyframes" keeps frames differing from the last one kept by at least
+    # FRAME_KEYFRAME_DISTANCE bits, "interval" one frame every
+    # FRAME_SAMPLE_INTERVAL milliseconds, "all" every frame. Decoding stops
+    # after FRAME_MAX_DECODED frames or FRAME_MAX_SAMPLES hashes, the hashes
+    # are indexed as one string so keep the latter under 128 with Postgres
+    FRAME_SAMPLING: Literal["keyframes", "interval", "all"] = "keyframes"
+    FRAME_SAMPLE_INTERVAL: int = 500
+    FRAME_KEYFRAME_DISTANCE: int = 10
+    FRAME_MAX_DECODED: int = 500
+    FRAME_MAX_SAMPLES: int = 64
+
+    # Remote images
+    FETCH_TIMEOUT: float = 10.0
+    FETCH_CHUNK_SIZE: int = 64 * 1024
+    FETCH_MAX_CONNECTIONS: int = 100
+    FETCH_MAX_KEEPALIVE: int = 20
+    FETCH_MAX_CONNECTIONS_PER_HOST: int = 10
+
+    # Execution pools, CPU_POOL_WORKERS=0 runs CPU-bound work on the I/O threads
+    CPU_POOL_WORKERS: int = os.cpu_count() or 1
+    IO_POOL_WORKERS: int = 32
+
+    # Background jobs, JOB_WORKERS=0 leaves them to `python -m app.worker`
+    JOB_WORKERS: int = 2
+    JOB_POLL_INTERVAL: float = 1.0
+    # Running jobs not refreshed for JOB_LEASE_TIMEOUT are given back to the
+    # queue, checked and refreshed every JOB_HEARTBEAT_INTERVAL
+    JOB_LEASE_TIMEOUT: int = 300
+    JOB_HEARTBEAT_INTERVAL: float = 30.0
+
+    # Database, a sync URL (sqlite:// or postgresql://), requests go through
+    # the matching async driver (aiosqlite, asyncpg)
     SQLALCHEMY_DATABASE_URI = "sqlite:///./sql_app.db"
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE: int = 30 * 60
+    DB_POOL_TIMEOUT: float = 30.0
+    # Apply pending migrations on startup. Turn off when they are run once
+    # per deploy with `python -m app.db.migrations`, replicas then start
+    # without touching the schema
+    RUN_MIGRATIONS: bool = True
+
+    @validator("HASH_METHODS")
+    def check_hash_methods(cls, methods: List[str]) -> List[str]:
+        unknown = set(methods) - imaging.HASH_METHODS
+        if unknown:
+            raise ValueError(
+                f"unknown hash methods {sorted(unknown)}, "
+                f"available: {sorted(imaging.HASH_METHODS)}"
+            )
+        return methods
 
     class Config:
         case_sensitive = True
@@ -0,0 +1,103 @@
+import functools
+
+from typing import TYPE_CHECKING, List, Sequence
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+# The scalar distances are plain Python, numpy is only imported by the first
+# vectorised call
+
+MASK64 = (1 << 64) - 1
+
+
+@functools.cache
+def _popcount8() -> "np.ndarray":
+    """Bits set in every byte value, used when numpy has no native popcount."""
+    import numpy as np
+
+    return np.array([bin(value).count("1") for value in range(256)], np.uint8)
+
+
+def hex_to_int64(value: str) -> int:
+    """Signed 64-bit integer of a 16 digit hex hash, as stored in `hash_int`."""
+    unsigned = int(value, 16)
+    if unsigned > MASK64:
+        raise ValueError(f"Hash {value} does not fit in 64 bits")
+    return unsigned - (1 << 64) if unsigned >> 63 else unsigned
+
+
+def int64_to_hex(value: int) -> str:
+    return f"{value & MASK64:016x}"
+
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & MASK64).bit_count()
+
+
+def hamming_hex(a: str, b: str) -> int:
+    """Distance between two hex hashes of any, but equal, length."""
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def as_uint64(values: "Sequence[int] | np.ndarray") -> "np.ndarray":
+    """Contiguous uint64 view of signed 64-bit hashes, without copying if possible."""
+    import numpy as np
+
+    return np.ascontiguousarray(np.asarray(values, dtype=np.int64)).view(np.uint64)
+
+
+def popcount(values: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.int64)
+    values = np.ascontiguousarray(values)
+    counts = _popcount8()[values.view(np.uint8)].reshape(values.shape + (8,))
+    return counts.sum(axis=-1, dtype=np.int64)
+
+
+def hamming_many(source: int, targets: "Sequence[int] | np.ndarray") -> "np.ndarray":
+    """Distances from one hash to every hash in `targets`."""
+    import numpy as np
+
+    return popcount(as_uint64(targets) ^ np.uint64(source & MASK64))
+
+
+def hamming_matrix(
+    sources: "Sequence[int] | np.ndarray", targets: "Sequence[int] | np.ndarray"
+) -> "np.ndarray":
+    """Pairwise distances, shaped (len(sources), len(targets))."""
+    import numpy as np
+
+    return popcount(as_uint64(sources)[:, np.newaxis] ^ as_uint64(targets))
+
+
+def hex_sequence(value: str) -> List[int]:
+    """Hashes of a sequence stored as concatenated 16 digit hex hashes."""
+    return [int(value[start : start + 16], 16) for start in range(0, len(value), 16)]
+
+
+def sequence_distance(a: Sequence[int], b: Sequence[int]) -> float:
+    """Mean distance between two hash sequences aligned by dynamic time warping.
+
+    Each hash of one sequence is matched to one or more consecutive hashes of
+    the other, so sequences sampled at different rates or with dropped
+    frames still line up. Diagonal steps weigh twice and the total is divided
+    by the length of both sequences, which keeps the result on the scale of
+    `hamming`: a constant distance `d` between all frames gives `d`.
+    """
+    if not a or not b:
+        raise ValueError("Empty hash sequence")
+    inf = float("inf")
+    previous = [0.0] + [inf] * len(b)
+    for x in a:
+        row = [inf]
+        for j, y in enumerate(b, start=1):
+            cost = hamming(x, y)
+            row.append(
+                min(previous[j - 1] + 2 * cost, previous[j] + cost, row[-1] + cost)
+            )
+        previous = row
+    return previous[-1] / (len(a) + len(b))
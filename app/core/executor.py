@@ -0,0 +1,113 @@
+import asyncio
+import functools
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
+from app.core import metrics
+from app.core.config import settings
+
+
+T = TypeVar("T")
+
+_cpu_pool: Executor | None = None
+_io_pool: ThreadPoolExecutor | None = None
+
+# Tasks submitted and not finished yet, queued or running
+_in_flight: Dict[str, int] = {"io": 0, "cpu": 0}
+
+
+def get_io_pool() -> ThreadPoolExecutor:
+    global _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(
+            max_workers=settings.IO_POOL_WORKERS, thread_name_prefix="io"
+        )
+    return _io_pool
+
+
+def get_cpu_pool() -> Executor:
+    global _cpu_pool
+    if _cpu_pool is None:
+        if settings.CPU_POOL_WORKERS > 0:
+            _cpu_pool = ProcessPoolExecutor(max_workers=settings.CPU_POOL_WORKERS)
+        else:
+            # No worker processes configured, share the I/O threads instead
+            return get_io_pool()
+    return _cpu_pool
+
+
+async def run_io(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run blocking I/O (disk, network, database) on the thread pool."""
+    loop = asyncio.get_running_loop()
+    _in_flight["io"] += 1
+    try:
+        return await loop.run_in_executor(
+            get_io_pool(), functools.partial(func, *args, **kwargs)
+        )
+    finally:
+        _in_flight["io"] -= 1
+
+
+async def run_cpu(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run CPU-bound work (decode, hash, crop, encode) on the process pool.
+
+    `func` and its arguments must be picklable, so only pass module level
+    functions and plain values. Stages timed by `func` are recorded here,
+    the worker processes are not scraped.
+    """
+    loop = asyncio.get_running_loop()
+    _in_flight["cpu"] += 1
+    try:
+        result, stages = await loop.run_in_executor(
+            get_cpu_pool(),
+            functools.partial(metrics.collect_stages, func, *args, **kwargs),
+        )
+    finally:
+        _in_flight["cpu"] -= 1
+    metrics.replay_stages(stages)
+    return result
+
+
+def _in_flight_tasks() -> Dict[metrics.Labels, float]:
+    return {(pool,): count for pool, count in _in_flight.items()}
+
+
+def _queue_depths() -> Dict[metrics.Labels, float]:
+    workers = {"io": settings.IO_POOL_WORKERS, "cpu": settings.CPU_POOL_WORKERS}
+    in_flight = dict(_in_flight)
+    if settings.CPU_POOL_WORKERS <= 0:
+        # CPU work waits in the queue of the I/O threads
+        in_flight["io"] += in_flight["cpu"]
+        in_flight["cpu"] = 0
+    return {(pool,): max(0, count - workers[pool]) for pool, count in in_flight.items()}
+
+
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "executor_tasks_in_flight",
+        "Tasks submitted to each execution pool and not finished yet",
+        "gauge",
+        _in_flight_tasks,
+        ["pool"],
+    )
+)
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "executor_queue_depth",
+        "Tasks waiting for a free worker in each execution pool",
+        "gauge",
+        _queue_depths,
+        ["pool"],
+    )
+)
+
+
+def shutdown() -> None:
+    global _cpu_pool, _io_pool
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=True)
+        _cpu_pool = None
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=True)
+        _io_pool = None
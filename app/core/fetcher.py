@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import os
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Set, Tuple
+
+import httpx
+
+from app.core.config import settings
+from app.core.executor import run_io
+
+
+class FetchError(Exception):
+    pass
+
+
+class UnsupportedContentType(FetchError):
+    pass
+
+
+class ContentTooLarge(FetchError):
+    pass
+
+
+class ImageFetcher:
+    """Download remote images over a shared, keep-alive HTTP connection pool.
+
+    Bodies are streamed to disk chunk by chunk, the content type and size are
+    validated as the response arrives so nothing is buffered in memory.
+    """
+
+    def __init__(self) -> None:
+        self._client: httpx.AsyncClient | None = None
+        # Per host semaphore and the number of fetches holding or awaiting it
+        self._host_slots: Dict[str, Tuple[asyncio.Semaphore, int]] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(settings.FETCH_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.FETCH_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.FETCH_MAX_KEEPALIVE,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    @asynccontextmanager
+    async def _host_slot(self, url: httpx.URL) -> AsyncIterator[None]:
+        # httpx only limits the pool as a whole, cap each host on top of it.
+        # Hosts are dropped once no fetch uses them, so only the ones being
+        # fetched from are kept
+        host = url.host
+        slot, users = self._host_slots.get(host, (None, 0))
+        if slot is None:
+            slot = asyncio.Semaphore(settings.FETCH_MAX_CONNECTIONS_PER_HOST)
+        self._host_slots[host] = (slot, users + 1)
+        try:
+            async with slot:
+                yield
+        finally:
+            slot, users = self._host_slots[host]
+            if users > 1:
+                self._host_slots[host] = (slot, users - 1)
+            else:
+                del self._host_slots[host]
+
+    async def fetch(
+        self, url: str, path: str, content_types: Set[str]
+    ) -> Tuple[int, str]:
+        """Stream `url` into `path`, return the size and SHA-256 of the body.
+
+        The body goes to a temp file first, `path` only ever holds a complete
+        download.
+        """
+        tmp_path = f"{path}.tmp"
+        try:
+            request_url = httpx.URL(url)
+            async with self._host_slot(request_url):
+                async with self.client.stream("GET", request_url) as response:
+                    self._check_response(response, content_types)
+                    size, digest = await self._write_body(response, tmp_path)
+            await run_io(os.replace, tmp_path, path)
+            return size, digest
+        except httpx.HTTPError as exc:
+            await run_io(self._remove, tmp_path)
+            raise FetchError(str(exc)) from exc
+        except BaseException:
+            await run_io(self._remove, tmp_path)
+            raise
+
+    def _check_response(
+        self, response: httpx.Response, content_types: Set[str]
+    ) -> None:
+        if response.status_code >= 400:
+            raise FetchError(f"Unexpected status code {response.status_code}")
+
+        content_type = response.headers.get("content-type", "")
+        if content_type.split(";")[0].strip().lower() not in content_types:
+            raise UnsupportedContentType(content_type)
+
+        content_length = response.headers.get("content-length")
+        if content_length:
+            try:
+                length = int(content_length)
+            except ValueError:
+                raise FetchError(f"Invalid Content-Length {content_length!r}")
+            if length > settings.MAX_IMAGE_SIZE:
+                raise ContentTooLarge(content_length)
+
+    async def _write_body(self, response: httpx.Response, path: str) -> Tuple[int, str]:
+        size = 0
+        digest = hashlib.sha256()
+        handler = await run_io(open, path, "wb")
+        try:
+            async for chunk in response.aiter_bytes(settings.FETCH_CHUNK_SIZE):
+                size += len(chunk)
+                if size > settings.MAX_IMAGE_SIZE:
+                    raise ContentTooLarge(str(size))
+                digest.update(chunk)
+                await run_io(handler.write, chunk)
+        finally:
+            await run_io(handler.close)
+        return size, digest.hexdigest()
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+fetcher = ImageFetcher()
@@ -0,0 +1,330 @@
+import fcntl
+import functools
+import mmap
+import os
+import struct
+import threading
+import uuid
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from app.core.config import settings
+from app.core.distance import as_uint64, hamming_many, popcount
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+ImageId = str
+
+# Magic, format version and number of records in the sorted section
+HEADER = struct.Struct("<4sIQ")
+MAGIC = b"PHIX"
+VERSION = 2
+
+# Multi-index hashing: the 64-bit hash is cut into 4 substrings of 16 bits.
+# Two hashes within `d` bits agree within `d // 4` bits on at least one of
+# them, so a search only looks at the buckets of nearby substring values
+SUBSTRINGS = 4
+SUBSTRING_BITS = 16
+BUCKETS = 1 << SUBSTRING_BITS
+# Past this many buckets probed per substring (distances from 24 bits on)
+# the buckets hold about half of the hashes, a plain scan is cheaper
+MAX_PROBES = BUCKETS // 8
+
+# Hashes compared per numpy call, bounds the temporaries of a scan
+SCAN_CHUNK = 1 << 20
+
+
+def _record_dtype() -> "np.dtype":
+    import numpy as np
+
+    # 16 byte UUID and the phash as a signed 64-bit integer, 24 bytes
+    return np.dtype([("id", "S16"), ("hash", "<i8")])
+
+
+def _tables_size(count: int) -> int:
+    # Bucket offsets then record positions sorted by substring, uint32
+    return 4 * SUBSTRINGS * (BUCKETS + 1 + count)
+
+
+def _latest(records: "np.ndarray") -> "np.ndarray":
+    """Last record of each id, sorted by id."""
+    import numpy as np
+
+    # unique keeps the first occurrence, look at the records backwards
+    _, first = np.unique(records["id"][::-1], return_index=True)
+    return records[::-1][first]
+
+
+def _substrings(hashes: "np.ndarray") -> List["np.ndarray"]:
+    import numpy as np
+
+    values = as_uint64(hashes)
+    return [
+        ((values >> np.uint64(SUBSTRING_BITS * k)) & np.uint64(BUCKETS - 1)).astype(
+            np.uint16
+        )
+        for k in range(SUBSTRINGS)
+    ]
+
+
+@functools.cache
+def _nearby(max_distance: int) -> "np.ndarray":
+    """Every substring value within `max_distance` bits of 0."""
+    import numpy as np
+
+    values = np.arange(BUCKETS, dtype=np.uint64)
+    return values[popcount(values) <= max_distance]
+
+
+def _image_id(raw: bytes) -> ImageId:
+    # S16 drops trailing NUL bytes
+    return str(uuid.UUID(bytes=raw.ljust(16, b"\0")))
+
+
+class _Snapshot(NamedTuple):
+    records: "np.ndarray"
+    # Per substring, where each bucket starts in `positions`
+    offsets: "np.ndarray"
+    # Per substring, the record positions ordered by substring value
+    positions: "np.ndarray"
+    journal: "np.ndarray"
+    # Where the last whole journal record ends, and the file size
+    end: int
+    size: int
+
+
+class HashIndex:
+    """Perceptual hashes of every image, in a memory-mapped snapshot file.
+
+    The file is a header, fixed-width (id, phash) records sorted by id,
+    multi-index hashing tables over them, then a journal appended to by
+    `add`, where a later record of an id replaces the earlier ones. Every
+    process maps the same file, so opening it is instant and the page cache
+    holds one copy however many workers there are.
+
+    A search probes the buckets of the substrings near the query and only
+    compares the hashes found there, a few thousand out of millions for the
+    usual distances. The journal is scanned.
+
+    Writers take an flock on `<path>.lock`. The journal is folded into the
+    sorted section by `load` and once it outgrows `HASH_INDEX_JOURNAL_MAX`.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        # Path, inode and size of the mapped file, remapped when one changes
+        self._mapped: Tuple[str, int, int, mmap.mmap] | None = None
+
+    @property
+    def path(self) -> str:
+        return self._path or settings.HASH_INDEX_PATH
+
+    def __len__(self) -> int:
+        import numpy as np
+
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return 0
+        if len(snapshot.journal):
+            return len(_latest(np.concatenate([snapshot.records, snapshot.journal])))
+        return len(snapshot.records)
+
+    def load(self) -> Optional[int]:
+        """Open the snapshot with its journal folded in, return its size.
+
+        None when there is no usable snapshot.
+        """
+        import numpy as np
+
+        try:
+            with self._write_lock():
+                snapshot = self._snapshot()
+                if snapshot is None:
+                    return None
+                if len(snapshot.journal):
+                    return self._write(
+                        np.concatenate([snapshot.records, snapshot.journal])
+                    )
+                self._truncate(snapshot)
+                return len(snapshot.records)
+        except ValueError:
+            return None
+
+    def build(self, items: Iterable[Tuple[ImageId, int]]) -> None:
+        """Replace the snapshot with `items`."""
+        records = self._to_records(items)
+        with self._write_lock():
+            self._write(records)
+
+    def add(self, image_id: ImageId, image_hash: int) -> None:
+        self.add_many([(image_id, image_hash)])
+
+    def add_many(self, items: Iterable[Tuple[ImageId, int]]) -> None:
+        """Add or replace the hash of each image."""
+        import numpy as np
+
+        records = self._to_records(items)
+        with self._write_lock():
+            snapshot = self._snapshot()
+            if snapshot is None:
+                self._write(records)
+                return
+            journal_size = len(snapshot.journal) + len(records)
+            if journal_size > settings.HASH_INDEX_JOURNAL_MAX:
+                self._write(
+                    np.concatenate([snapshot.records, snapshot.journal, records])
+                )
+                return
+            # A writer that died mid-append leaves part of a record behind
+            self._truncate(snapshot)
+            with open(self.path, "ab") as handler:
+                handler.write(records.tobytes())
+
+    def search(
+        self, image_hash: int, max_distance: int, limit: int
+    ) -> List[Tuple[ImageId, int]]:
+        """Return up to `limit` (image id, distance) pairs, closest first."""
+        import numpy as np
+
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return []
+        journal = _latest(snapshot.journal)
+
+        ids, distances = [], []
+        for chunk in self._candidates(snapshot, image_hash, max_distance):
+            chunk_distances = hamming_many(image_hash, chunk["hash"])
+            hits = np.flatnonzero(chunk_distances <= max_distance)
+            # The journal holds the current hash of these ids
+            hits = hits[~np.isin(chunk["id"][hits], journal["id"])]
+            ids.append(chunk["id"][hits])
+            distances.append(chunk_distances[hits])
+
+        journal_distances = hamming_many(image_hash, journal["hash"])
+        hits = np.flatnonzero(journal_distances <= max_distance)
+        ids.append(journal["id"][hits])
+        distances.append(journal_distances[hits])
+
+        all_ids, all_distances = np.concatenate(ids), np.concatenate(distances)
+        # UUID bytes sort like their hex string
+        order = np.lexsort((all_ids, all_distances))[:limit]
+        return [(_image_id(all_ids[i]), int(all_distances[i])) for i in order]
+
+    def _candidates(
+        self, snapshot: _Snapshot, image_hash: int, max_distance: int
+    ) -> Iterator["np.ndarray"]:
+        """Sorted records that may be within `max_distance`, in chunks."""
+        import numpy as np
+
+        records = snapshot.records
+        nearby = _nearby(max_distance // SUBSTRINGS)
+        if len(nearby) > MAX_PROBES:
+            for start in range(0, len(records), SCAN_CHUNK):
+                yield records[start : start + SCAN_CHUNK]
+            return
+
+        found = []
+        for k, value in enumerate(_substrings(np.array([image_hash]))):
+            buckets = (nearby ^ np.uint64(value[0])).astype(np.int64)
+            starts = snapshot.offsets[k][buckets].astype(np.int64)
+            lengths = snapshot.offsets[k][buckets + 1].astype(np.int64) - starts
+            # Positions of every probed bucket, concatenated
+            steps = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            found.append(snapshot.positions[k][steps + np.arange(len(steps))])
+        yield records[np.unique(np.concatenate(found))]
+
+    @staticmethod
+    def _to_records(items: Iterable[Tuple[ImageId, int]]) -> "np.ndarray":
+        import numpy as np
+
+        pairs = [
+            (uuid.UUID(image_id).bytes, image_hash) for image_id, image_hash in items
+        ]
+        return np.array(pairs, dtype=_record_dtype())
+
+    def _snapshot(self) -> Optional[_Snapshot]:
+        """The sections of the current file, None when there is none."""
+        import numpy as np
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            key = (self.path, stat.st_ino, stat.st_size)
+            if self._mapped is None or self._mapped[:3] != key:
+                if stat.st_size < HEADER.size:
+                    raise ValueError(f"{self.path} is not a hash index")
+                with open(self.path, "rb") as handler:
+                    mapping = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+                # Arrays of a previous search may still use the old mapping, it
+                # is unmapped once they are gone
+                self._mapped = (*key, mapping)
+            mapping = self._mapped[3]
+
+        magic, version, count = HEADER.unpack_from(mapping)
+        if (magic, version) != (MAGIC, VERSION):
+            raise ValueError(f"{self.path} is not a version {VERSION} hash index")
+        dtype = _record_dtype()
+        tables_start = HEADER.size + count * dtype.itemsize
+        journal_start = tables_start + _tables_size(count)
+        if len(mapping) < journal_start:
+            raise ValueError(f"{self.path} is truncated")
+
+        tables = np.frombuffer(
+            mapping, np.uint32, _tables_size(count) // 4, tables_start
+        )
+        journal_count = (len(mapping) - journal_start) // dtype.itemsize
+        return _Snapshot(
+            records=np.frombuffer(mapping, dtype, count, HEADER.size),
+            offsets=tables[: SUBSTRINGS * (BUCKETS + 1)].reshape(SUBSTRINGS, -1),
+            positions=tables[SUBSTRINGS * (BUCKETS + 1) :].reshape(SUBSTRINGS, -1),
+            journal=np.frombuffer(mapping, dtype, journal_count, journal_start),
+            end=journal_start + journal_count * dtype.itemsize,
+            size=len(mapping),
+        )
+
+    def _truncate(self, snapshot: _Snapshot) -> None:
+        if snapshot.size != snapshot.end:
+            os.truncate(self.path, snapshot.end)
+
+    def _write(self, records: "np.ndarray") -> int:
+        """Write the latest record of each id as a new, fully sorted file."""
+        import numpy as np
+
+        latest = _latest(records)
+        offsets = np.zeros((SUBSTRINGS, BUCKETS + 1), np.uint32)
+        positions = np.empty((SUBSTRINGS, len(latest)), np.uint32)
+        for k, values in enumerate(_substrings(latest["hash"])):
+            positions[k] = np.argsort(values, kind="stable")
+            offsets[k, 1:] = np.cumsum(np.bincount(values, minlength=BUCKETS))
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as handler:
+            handler.write(HEADER.pack(MAGIC, VERSION, len(latest)))
+            handler.write(latest.tobytes())
+            handler.write(offsets.tobytes())
+            handler.write(positions.tobytes())
+        # Readers keep the old file mapped until they notice the new inode
+        os.replace(tmp_path, self.path)
+        return len(latest)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.lock", "a") as handler:
+            fcntl.flock(handler, fcntl.LOCK_EX)
+            yield
+
+
+index = HashIndex()
@@ -0,0 +1,344 @@
+import hashlib
+import shutil
+import subprocess
+import time
+
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from app.core.metrics import record_stage, stage
+
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
+
+# Everything in this module runs inside the CPU worker processes, keep it to
+# plain functions taking and returning picklable values. PIL and imagehash
+# (numpy, scipy, pywavelets) are imported by the functions that need them, so
+# processes that only import the constants here start fast.
+
+ImageHashes = Dict[str, str]
+
+PRIMARY_HASH_METHOD = "phash"
+
+# Hashes computed from the grayscale image, by imagehash function name,
+# colorhash needs the colors
+GRAYSCALE_HASH_METHODS = {"phash", "dhash", "whash", "average_hash"}
+HASH_METHODS = {*GRAYSCALE_HASH_METHODS, "colorhash"}
+
+# Leading bytes of every format we store or render, mapped to its media type
+MAGIC_NUMBERS = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+
+
+def sniff_media_type(header: bytes) -> Optional[str]:
+    """Media type from the first bytes of a file, None when not recognised."""
+    for magic, media_type in MAGIC_NUMBERS.items():
+        if header.startswith(magic):
+            return media_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+# Smallest side the hashing path decodes images to. Every hash looks at 32x32
+# pixels or less, from this size on the result stays within 2 bits of the
+# one computed from the full image for every method (colorhash is exact)
+HASH_DECODE_SIZE = 256
+
+
+def open_for_hashing(path: str, color: bool = True) -> "PILImage.Image":
+    """Decode the image at `path` reduced to about `HASH_DECODE_SIZE`.
+
+    JPEG is decoded at 1/2, 1/4 or 1/8 scale by libjpeg (DCT scaling) and,
+    unless `color` is needed, straight to grayscale. Other formats are
+    decoded in full and box reduced by an integer factor. Images smaller
+    than twice the size are left alone.
+    """
+    from PIL import Image as PILImage
+
+    img = PILImage.open(path)
+    if img.format == "JPEG":
+        img.draft("RGB" if color else "L", (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    with stage("decode"):
+        img.load()
+        factor = min(img.size) // HASH_DECODE_SIZE
+        if factor > 1:
+            if img.mode in ("1", "P", "I;16"):
+                # No reduce for these, hashing converts them anyway
+                img = img.convert("RGBA" if color else "L")
+            img = img.reduce(factor)
+    return img
+
+
+def hash_image(img: "PILImage.Image", methods: Iterable[str]) -> ImageHashes:
+    """Hash an already decoded image with every method in `methods`.
+
+    The image is converted to grayscale once and shared by all methods, the
+    primary hash is always included.
+    """
+    import imagehash
+
+    img.load()
+    with stage("hash"):
+        gray = img if img.mode == "L" else img.convert("L")
+        hashes = {}
+        for method in {PRIMARY_HASH_METHOD, *methods}:
+            if method == "colorhash":
+                hashes[method] = str(imagehash.colorhash(img))
+            else:
+                hashes[method] = str(getattr(imagehash, method)(gray))
+    return hashes
+
+
+# Pseudo hash method of animated images, the phashes of the sampled frames
+# as one string of 16 digit hex hashes
+FRAME_HASH_METHOD = "frames"
+
+# Display time of frames without a delay, what browsers show them for
+DEFAULT_FRAME_DURATION = 100
+
+
+class FrameSampling(NamedTuple):
+    """Which frames of an animated image are hashed, see `hash_frames`."""
+
+    # "keyframes", "interval" or "all"
+    strategy: str
+    # Milliseconds of display time between frames with "interval"
+    interval: int
+    # Bits a frame differs from the last one kept by with "keyframes"
+    keyframe_distance: int
+    max_frames: int
+    max_samples: int
+
+
+def hash_frames(path: str, sampling: FrameSampling) -> Optional[str]:
+    """phashes of frames sampled from an animated image, None for stills.
+
+    Frames are decoded one at a time, memory does not grow with their
+    number, and decoding stops after `max_frames` frames or once
+    `max_samples` frames are hashed. `keyframes` keeps the frames differing
+    from the last one kept by at least `keyframe_distance` bits, `interval`
+    one frame every `interval` milliseconds of display time, `all` every
+    frame.
+    """
+    import imagehash
+
+    from PIL import Image as PILImage, ImageSequence
+
+    with PILImage.open(path) as img:
+        if not getattr(img, "is_animated", False):
+            return None
+
+        hashes: List[int] = []
+        decode_seconds = hash_seconds = 0.0
+        elapsed = next_sample = 0
+        for position, frame in enumerate(ImageSequence.Iterator(img)):
+            if position == sampling.max_frames or len(hashes) == sampling.max_samples:
+                break
+            duration = frame.info.get("duration") or DEFAULT_FRAME_DURATION
+            elapsed += duration
+            if sampling.strategy == "interval":
+                if elapsed - duration < next_sample:
+                    continue
+                next_sample += sampling.interval
+
+            start = time.perf_counter()
+            frame.load()
+            gray = frame.convert("L")
+            factor = min(gray.size) // HASH_DECODE_SIZE
+            if factor > 1:
+                gray = gray.reduce(factor)
+            decoded = time.perf_counter()
+            frame_hash = int(str(imagehash.phash(gray)), 16)
+            hash_seconds += time.perf_counter() - decoded
+            decode_seconds += decoded - start
+
+            if (
+                sampling.strategy == "keyframes"
+                and hashes
+                and (frame_hash ^ hashes[-1]).bit_count() < sampling.keyframe_distance
+            ):
+                continue
+            hashes.append(frame_hash)
+
+    record_stage("decode", decode_seconds)
+    record_stage("hash", hash_seconds)
+    return "".join(f"{frame_hash:016x}" for frame_hash in hashes)
+
+
+def hash_file(
+    path: str, methods: Iterable[str], sampling: Optional[FrameSampling] = None
+) -> ImageHashes:
+    """Hash the image at `path`, its first frame when animated.
+
+    With `sampling` the frames of animated images are hashed as well, under
+    `FRAME_HASH_METHOD`.
+    """
+    methods = set(methods)
+    with open_for_hashing(path, color="colorhash" in methods) as img:
+        hashes = hash_image(img, methods)
+    if sampling is not None:
+        frame_hashes = hash_frames(path, sampling)
+        if frame_hashes is not None:
+            hashes[FRAME_HASH_METHOD] = frame_hashes
+    return hashes
+
+
+def digest_file(path: str) -> Tuple[str, int]:
+    """SHA-256 hex digest and size of the file at `path`."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as handler:
+        while chunk := handler.read(1024 * 1024):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+# Lossless JPEG crops need jpegtran (libjpeg-turbo-progs), without it JPEG
+# crops are re-encoded with the source quantization tables
+JPEGTRAN = shutil.which("jpegtran")
+
+# JPEG MCU width and height by chroma subsampling, as given by get_sampling
+JPEG_MCU_SIZES = {0: (8, 8), 1: (16, 8), 2: (16, 16)}
+
+Box = Tuple[int, int, int, int]
+
+
+def center_box(size: Tuple[int, int], width: int, height: int) -> Box:
+    left = (size[0] - width) // 2
+    top = (size[1] - height) // 2
+    return left, top, left + width, top + height
+
+
+def can_crop_losslessly(img: "PILImage.Image", box: Box) -> bool:
+    """Whether jpegtran can cut `box` out of `img` without decoding it.
+
+    The box has to start on an MCU boundary and lie within the image, the
+    right and bottom edges can fall anywhere.
+    """
+    from PIL import JpegImagePlugin
+
+    if JPEGTRAN is None or img.format != "JPEG":
+        return False
+    mcu_size = (
+        (8, 8)
+        if img.mode == "L"
+        else JPEG_MCU_SIZES.get(JpegImagePlugin.get_sampling(img))
+    )
+    if mcu_size is None:
+        return False
+    left, top, right, bottom = box
+    return (
+        left >= 0
+        and top >= 0
+        and right <= img.width
+        and bottom <= img.height
+        and left % mcu_size[0] == 0
+        and top % mcu_size[1] == 0
+    )
+
+
+def jpeg_save_options(img: "PILImage.Image") -> Dict[str, Any]:
+    """Encoder options reproducing the quantization and subsampling of `img`.
+
+    Re-encoding with the source tables rather than the default quality keeps
+    repeated crops from losing a generation of quality each time.
+    """
+    from PIL import JpegImagePlugin
+
+    options: Dict[str, Any] = {
+        "qtables": img.quantization,
+        "progressive": bool(img.info.get("progressive")),
+    }
+    sampling = JpegImagePlugin.get_sampling(img)
+    if sampling != -1:
+        options["subsampling"] = sampling
+    for key in ("exif", "icc_profile"):
+        if img.info.get(key):
+            options[key] = img.info[key]
+    return options
+
+
+def crop_file(
+    source_path: str,
+    target_path: str,
+    width: int,
+    height: int,
+    methods: Iterable[str],
+) -> Tuple[ImageHashes, str, int]:
+    """Center crop the source image into `target_path`.
+
+    JPEG crops aligned on the MCU grid are done by jpegtran on the DCT
+    coefficients, without decoding or quality loss. Other JPEG crops are
+    decoded and re-encoded once with the source tables.
+
+    Returns the hashes, digest and size of the cropped file.
+    """
+    from PIL import Image as PILImage
+
+    with PILImage.open(source_path, formats=["JPEG", "PNG"]) as img:
+        box = center_box(img.size, width, height)
+        if can_crop_losslessly(img, box):
+            with stage("crop"):
+                subprocess.run(
+                    [
+                        str(JPEGTRAN),
+                        "-copy",
+                        "all",
+                        "-crop",
+                        f"{width}x{height}+{box[0]}+{box[1]}",
+                        "-outfile",
+                        target_path,
+                        source_path,
+                    ],
+                    check=True,
+                    capture_output=True,
+                )
+        else:
+            with stage("decode"):
+                img.load()
+            with stage("crop"):
+                new_img = img.crop(box)
+            options = jpeg_save_options(img) if img.format == "JPEG" else {}
+            with stage("encode"):
+                new_img.save(target_path, format=img.format, **options)
+
+    return (hash_file(target_path, methods), *digest_file(target_path))
+
+
+def render_file(
+    source_path: str,
+    target_path: str,
+    width: int,
+    height: int,
+    mode: str,
+    image_format: Optional[str],
+) -> None:
+    """Write a `width` x `height` rendition of the source image to `target_path`.
+
+    `crop` fills the whole box and cuts off what overflows, `fit` keeps the
+    whole image inside the box. The source format is kept unless given.
+    """
+    from PIL import Image as PILImage, ImageOps
+
+    with PILImage.open(source_path) as img:
+        image_format = image_format or img.format
+        # Let JPEG decode at a reduced scale that is still at least the box
+        img.draft(img.mode, (width, height))
+        with stage("decode"):
+            img.load()
+        with stage("resize"):
+            if mode == "crop":
+                rendered = ImageOps.fit(img, (width, height))
+            else:
+                rendered = ImageOps.contain(img, (width, height))
+
+        with stage("encode"):
+            if image_format == "JPEG" and rendered.mode not in ("RGB", "L"):
+                rendered = rendered.convert("RGB")
+            rendered.save(target_path, format=image_format)
@@ -0,0 +1,152 @@
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import app.schemas as schemas
+
+from app.core import metrics
+from app.core.config import settings
+
+
+class CacheBackend(ABC):
+    """Byte values with a time to live, keyed by string."""
+
+    @abstractmethod
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        ...
+
+    @abstractmethod
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalCacheBackend(CacheBackend):
+    """Per-process LRU bounded to `max_entries`, entries expire after the TTL."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        now = time.monotonic()
+        values: List[Optional[bytes]] = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or entry[0] < now:
+                    self._entries.pop(key, None)
+                    values.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    values.append(entry[1])
+        return values
+
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        expires = time.monotonic() + ttl
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared by every API and worker process through Redis.
+
+    `client` is a `redis.asyncio.Redis` or anything with the same mget and
+    pipeline methods.
+    """
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisCacheBackend":
+        # Optional dependency, only needed with METADATA_CACHE_BACKEND=redis
+        import redis.asyncio  # type: ignore
+
+        return cls(redis.asyncio.Redis.from_url(url))
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return list(await self.client.mget(keys))
+
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        # One round trip however many keys, a lookup can miss a thousand
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(key, value, px=int(ttl * 1000))
+            await pipe.execute()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class MetadataCache:
+    """Serialized image metadata in front of the database.
+
+    Writers refresh the entry after they commit (write-through), so readers
+    of the same backend see the change right away. A reader racing a writer
+    can still put back the old row, the TTL bounds how long it lives. With
+    the local backend other processes keep their copy until then, readers
+    finding its blob gone read the row again.
+    """
+
+    prefix = "image:"
+
+    def __init__(self, backend: Optional[CacheBackend] = None) -> None:
+        self._backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self) -> Optional[CacheBackend]:
+        if self._backend is None:
+            if settings.METADATA_CACHE_BACKEND == "redis":
+                self._backend = RedisCacheBackend.from_url(
+                    settings.METADATA_CACHE_REDIS_URL
+                )
+            elif settings.METADATA_CACHE_BACKEND == "local":
+                self._backend = LocalCacheBackend(settings.METADATA_CACHE_MAX_ENTRIES)
+        return self._backend
+
+    async def get_many(self, image_ids: List[str]) -> Dict[str, schemas.ImageInDB]:
+        if self.backend is None or not image_ids:
+            self.misses += len(image_ids)
+            return {}
+
+        values = await self.backend.get_many(
+            [self.prefix + image_id for image_id in image_ids]
+        )
+        images = {
+            image_id: schemas.ImageInDB.parse_raw(value)
+            for image_id, value in zip(image_ids, values)
+            if value is not None
+        }
+        self.hits += len(images)
+        self.misses += len(image_ids) - len(images)
+        return images
+
+    async def get(self, image_id: str) -> Optional[schemas.ImageInDB]:
+        return (await self.get_many([image_id])).get(image_id)
+
+    async def set_many(self, images: Iterable[schemas.ImageInDB]) -> None:
+        items = {self.prefix + str(image.id): image.json().encode() for image in images}
+        if self.backend is not None and items:
+            await self.backend.set_many(items, settings.METADATA_CACHE_TTL)
+
+    async def close(self) -> None:
+        if self._backend is not None:
+            await self._backend.close()
+            self._backend = None
+
+
+metadata_cache = MetadataCache()
+metrics.cache_metrics("metadata", metadata_cache)
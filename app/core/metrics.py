@@ -0,0 +1,287 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+
+# Prometheus metrics kept in process and rendered in the text exposition
+# format, no client library needed. Metrics owned by a module (pools, caches)
+# are registered next to it as callbacks read at scrape time.
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Iterable[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Labels) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Iterable[str] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, self._labels(key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*sorted(buckets), float("inf"))
+        # Per label set, the count of each bucket (not cumulative) and the sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * len(self.buckets), [0.0])
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], [0.0]))
+        return sum(counts)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total[0]))
+                for key, (counts, total) in self._values.items()
+            )
+
+        samples: List[Sample] = []
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        {**labels, "le": _format_value(bound)},
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """Values read from `collect` on every scrape, keyed by label values."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        type: str,
+        collect: Callable[[], Dict[Labels, float]],
+        labelnames: Iterable[str] = (),
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.collect = collect
+
+    def samples(self) -> List[Sample]:
+        return [
+            (self.name, self._labels(key), value)
+            for key, value in sorted(self.collect().items())
+        ]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Any:
+        # Modules reloaded by tests register the same name again, keep the
+        # latest definition
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "".join(
+            metric.render() + "\n" for metric in list(self._metrics.values())
+        )
+
+
+registry = Registry()
+
+REQUEST_SECONDS: Histogram = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time spent handling HTTP requests by route",
+        ["method", "route", "status"],
+    )
+)
+STAGE_SECONDS: Histogram = registry.register(
+    Histogram(
+        "image_stage_duration_seconds",
+        "Time spent in each stage of the image pipeline",
+        ["stage"],
+    )
+)
+STAGE_BYTES: Counter = registry.register(
+    Counter(
+        "image_stage_bytes_total",
+        "Bytes moved through each stage of the image pipeline",
+        ["stage"],
+    )
+)
+
+
+def cache_metrics(name: str, cache: Any) -> None:
+    """Export the `hits`/`misses` counters of `cache` as `<name>_cache_*`."""
+    documentation = {
+        "hits": f"Lookups answered from the {name} cache",
+        "misses": f"Lookups that missed the {name} cache",
+    }
+
+    def read(kind: str) -> Callable[[], Dict[Labels, float]]:
+        return lambda: {(): getattr(cache, kind)}
+
+    for kind in ("hits", "misses"):
+        registry.register(
+            CallbackMetric(
+                f"{name}_cache_{kind}_total", documentation[kind], "counter", read(kind)
+            )
+        )
+
+    def hit_ratio() -> Dict[Labels, float]:
+        lookups = cache.hits + cache.misses
+        return {(): cache.hits / lookups if lookups else 0.0}
+
+    registry.register(
+        CallbackMetric(
+            f"{name}_cache_hit_ratio",
+            f"Share of {name} cache lookups that were hits",
+            "gauge",
+            hit_ratio,
+        )
+    )
+
+
+# Set while a CPU task runs, stages are then handed back to the caller
+# instead of going to the registry of a worker process nobody scrapes
+_local = threading.local()
+
+
+def record_stage(name: str, seconds: float, size: int | None = None) -> None:
+    records = getattr(_local, "records", None)
+    if records is not None:
+        records.append((name, seconds, size))
+        return
+
+    STAGE_SECONDS.observe(seconds, stage=name)
+    if size is not None:
+        STAGE_BYTES.inc(size, stage=name)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Dict[str, int]]:
+    """Time the enclosed block as pipeline stage `name`.
+
+    Set `size` on the yielded dict to count the bytes the stage handled::
+
+        with stage("write") as timer:
+            timer["size"] = write(...)
+    """
+    timer: Dict[str, int] = {}
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        record_stage(name, time.perf_counter() - start, timer.get("size"))
+
+
+def collect_stages(
+    func: Callable[..., Any], *args: Any, **kwargs: Any
+) -> Tuple[Any, List[Tuple[str, float, int | None]]]:
+    """Call `func`, return its result and the stages it recorded."""
+    _local.records = []
+    try:
+        return func(*args, **kwargs), _local.records
+    finally:
+        del _local.records
+
+
+def replay_stages(records: Iterable[Tuple[str, float, int | None]]) -> None:
+    for name, seconds, size in records:
+        record_stage(name, seconds, size)
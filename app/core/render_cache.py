@@ -0,0 +1,111 @@
+import hashlib
+import os
+import threading
+import uuid
+
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.executor import run_io
+from app.core.single_flight import SingleFlight
+
+
+class RenderCache:
+    """Content addressed, size bounded on-disk cache of image renditions.
+
+    Entries are keyed by the digest of whatever identifies a rendition and
+    evicted least recently used first once `RENDER_CACHE_MAX_BYTES` is
+    exceeded. Concurrent requests for the same missing entry share a single
+    render through the `render` single-flight group.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] | None = None
+        self._size = 0
+        self._flight = SingleFlight("render")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts: object) -> str:
+        return hashlib.sha256("/".join(map(str, parts)).encode()).hexdigest()
+
+    @staticmethod
+    def path(key: str) -> str:
+        return f"{settings.RENDER_CACHE_DIR}/{key[:2]}/{key}"
+
+    async def get(self, key: str, render: Callable[[str], Awaitable[None]]) -> str:
+        """Return the cached file for `key`, calling `render(path)` on a miss."""
+        if await run_io(self._touch, key):
+            self.hits += 1
+            return self.path(key)
+        return await self._flight.run(key, lambda: self._render(key, render))
+
+    async def _render(self, key: str, render: Callable[[str], Awaitable[None]]) -> str:
+        self.misses += 1
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        await run_io(os.makedirs, os.path.dirname(path), exist_ok=True)
+        try:
+            await render(tmp_path)
+            await run_io(os.replace, tmp_path, path)
+        finally:
+            await run_io(self._discard, tmp_path)
+        await run_io(self._add, key, path)
+        return path
+
+    def _load(self) -> OrderedDict[str, int]:
+        if self._entries is None:
+            files = []
+            for root, _, names in os.walk(settings.RENDER_CACHE_DIR):
+                for name in names:
+                    if not name.endswith(".tmp"):
+                        stat = os.stat(os.path.join(root, name))
+                        files.append((stat.st_mtime, name, stat.st_size))
+            files.sort()
+            self._entries = OrderedDict((name, size) for _, name, size in files)
+            self._size = sum(size for _, _, size in files)
+        return self._entries
+
+    def _touch(self, key: str) -> bool:
+        with self._lock:
+            entries = self._load()
+            if key not in entries:
+                return False
+            if not os.path.exists(self.path(key)):
+                # Evicted by another process sharing the directory
+                self._size -= entries.pop(key)
+                return False
+            entries.move_to_end(key)
+            return True
+
+    def _add(self, key: str, path: str) -> None:
+        size = os.path.getsize(path)
+        with self._lock:
+            entries = self._load()
+            self._size += size - entries.pop(key, 0)
+            entries[key] = size
+            while self._size > settings.RENDER_CACHE_MAX_BYTES and len(entries) > 1:
+                evicted, evicted_size = entries.popitem(last=False)
+                self._size -= evicted_size
+                self._discard(self.path(evicted))
+
+    @staticmethod
+    def _discard(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def reset(self) -> None:
+        """Forget the in-memory state, the directory is scanned again on use."""
+        with self._lock:
+            self._entries = None
+            self._size = 0
+
+
+render_cache = RenderCache()
+metrics.cache_metrics("render", render_cache)
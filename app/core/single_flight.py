@@ -0,0 +1,89 @@
+import asyncio
+
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from app.core import metrics
+from app.core.config import settings
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Share one execution between concurrent calls with the same key.
+
+    The first caller (the leader) runs the function, callers arriving while
+    it is in flight wait for its result or exception instead of running
+    their own. Nothing is kept once it completes, so the next call always
+    starts afresh and there is nothing to go stale. When the leader is
+    cancelled the followers start over, one of them taking its place.
+
+    A group is enabled by listing its name in `SINGLE_FLIGHT_GROUPS`.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.coalesced = 0
+        _groups[name] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.name in settings.SINGLE_FLIGHT_GROUPS
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        if not self.enabled:
+            self.executed += 1
+            return await func()
+
+        while (in_flight := self._in_flight.get(key)) is not None:
+            try:
+                result: T = await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if in_flight.cancelled():
+                    continue
+                raise
+            self.coalesced += 1
+            return result
+
+        self.executed += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Only the followers care, don't warn about an unretrieved exception
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+
+_groups: Dict[str, SingleFlight] = {}
+
+
+def _calls() -> Dict[metrics.Labels, float]:
+    calls: Dict[metrics.Labels, float] = {}
+    for name, group in _groups.items():
+        calls[(name, "executed")] = group.executed
+        calls[(name, "coalesced")] = group.coalesced
+    return calls
+
+
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "single_flight_calls_total",
+        "Calls of each single-flight group, executed or coalesced into another",
+        "counter",
+        _calls,
+        ["group", "result"],
+    )
+)
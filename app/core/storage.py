@@ -0,0 +1,426 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import os
+import uuid
+
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import AsyncContextManager, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import quote
+from xml.etree import ElementTree
+
+import httpx
+
+from app.core.config import settings
+from app.core.executor import run_io
+
+
+class StorageError(Exception):
+    pass
+
+
+class Storage(ABC):
+    """Where image bytes live, addressed by a relative key like `ab/cd/abcd...`.
+
+    Byte ranges are inclusive, as in HTTP range headers. Missing keys raise
+    FileNotFoundError whatever the backend.
+    """
+
+    @abstractmethod
+    async def put(self, key: str, source_path: str) -> None:
+        """Store a complete local file under `key`, the file is consumed."""
+
+    @abstractmethod
+    async def get(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        ...
+
+    @abstractmethod
+    def stream(
+        self, key: str, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """Remove `key`, a missing key is not an error."""
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def size(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def local_copy(self, key: str) -> AsyncContextManager[str]:
+        """Context manager yielding a local path with the bytes of `key`.
+
+        Decoding happens in worker processes that only understand paths.
+        """
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Path the server can send straight from, when the backend has one."""
+        return None
+
+    async def close(self) -> None:
+        pass
+
+
+def temp_path() -> str:
+    """Scratch file in the local upload dir, where blobs are staged."""
+    return f"{settings.IMAGE_UPLOAD_DIR}/{uuid.uuid4()}.tmp"
+
+
+def remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class LocalStorage(Storage):
+    """Keys are files below IMAGE_UPLOAD_DIR, temp files share its filesystem
+    so storing one is an atomic rename."""
+
+    chunk_size = 64 * 1024
+
+    def path(self, key: str) -> str:
+        return f"{settings.IMAGE_UPLOAD_DIR}/{key}"
+
+    @staticmethod
+    def _move(source_path: str, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    async def put(self, key: str, source_path: str) -> None:
+        await run_io(self._move, source_path, self.path(key))
+
+    @staticmethod
+    def _read(path: str, start: int, end: Optional[int]) -> bytes:
+        with open(path, "rb") as handler:
+            handler.seek(start)
+            return handler.read(-1 if end is None else end - start + 1)
+
+    async def get(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        return await run_io(self._read, self.path(key), start, end)
+
+    async def stream(
+        self, key: str, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        handler = await run_io(open, self.path(key), "rb")
+        try:
+            offset = start
+            while end is None or offset <= end:
+                count = self.chunk_size
+                if end is not None:
+                    count = min(count, end - offset + 1)
+                chunk = await run_io(os.pread, handler.fileno(), count, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+        finally:
+            await run_io(handler.close)
+
+    async def delete(self, key: str) -> None:
+        await run_io(remove, self.path(key))
+
+    async def exists(self, key: str) -> bool:
+        return await run_io(os.path.exists, self.path(key))
+
+    async def size(self, key: str) -> int:
+        return await run_io(os.path.getsize, self.path(key))
+
+    @asynccontextmanager
+    async def local_copy(self, key: str) -> AsyncIterator[str]:
+        yield self.path(key)
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self.path(key)
+
+
+_S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+_UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def sign_request(
+    request: httpx.Request,
+    access_key_id: str,
+    secret_access_key: str,
+    region: str,
+    now: Optional[datetime.datetime] = None,
+) -> None:
+    """Add AWS Signature Version 4 headers to `request`.
+
+    The payload is not hashed, S3 and compatible servers accept
+    UNSIGNED-PAYLOAD and part bodies are not read twice.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+    request.headers["x-amz-date"] = amz_date
+    request.headers["x-amz-content-sha256"] = _UNSIGNED_PAYLOAD
+
+    signed = sorted(["host", "x-amz-content-sha256", "x-amz-date"])
+    query = sorted(
+        (quote(key, safe="-_.~"), quote(value, safe="-_.~"))
+        for key, value in request.url.params.multi_items()
+    )
+    canonical_request = "\n".join(
+        [
+            request.method,
+            quote(request.url.path, safe="/-_.~"),
+            "&".join(f"{key}={value}" for key, value in query),
+            "".join(f"{name}:{request.headers[name].strip()}\n" for name in signed),
+            ";".join(signed),
+            _UNSIGNED_PAYLOAD,
+        ]
+    )
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = f"AWS4{secret_access_key}".encode()
+    for part in (amz_date[:8], region, "s3", "aws4_request"):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    request.headers["authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key_id}/{scope}, "
+        f"SignedHeaders={';'.join(signed)}, Signature={signature}"
+    )
+
+
+class S3Storage(Storage):
+    """Objects in an S3-compatible bucket, addressed path-style so MinIO and
+    other stand-ins work without DNS tricks.
+
+    Requests share one keep-alive connection pool. Files above the multipart
+    threshold are uploaded in parts, several at a time, and the upload is
+    aborted if any part fails.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        bucket: str,
+        region: str = "us-east-1",
+        access_key_id: Optional[str] = None,
+        secret_access_key: Optional[str] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ) -> None:
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.bucket = bucket
+        self.region = region
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(settings.S3_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.S3_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.S3_MAX_KEEPALIVE,
+                ),
+                transport=self._transport,
+            )
+        return self._client
+
+    def _request(
+        self,
+        method: str,
+        key: str,
+        params: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        content: Optional[bytes] = None,
+    ) -> httpx.Request:
+        request = self.client.build_request(
+            method,
+            f"{self.endpoint_url}/{self.bucket}/{quote(key)}",
+            params=params,
+            headers=headers,
+            content=content,
+        )
+        if self.access_key_id and self.secret_access_key:
+            sign_request(
+                request, self.access_key_id, self.secret_access_key, self.region
+            )
+        return request
+
+    @staticmethod
+    def _check(response: httpx.Response, key: str) -> None:
+        if response.status_code == 404:
+            raise FileNotFoundError(key)
+        if response.status_code >= 400:
+            raise StorageError(f"Unexpected status code {response.status_code}")
+
+    async def _send(self, request: httpx.Request, key: str) -> httpx.Response:
+        try:
+            response = await self.client.send(request)
+        except httpx.HTTPError as exc:
+            raise StorageError(str(exc)) from exc
+        self._check(response, key)
+        return response
+
+    @staticmethod
+    def _range(start: int, end: Optional[int]) -> Dict[str, str]:
+        if start == 0 and end is None:
+            return {}
+        return {"range": f"bytes={start}-{'' if end is None else end}"}
+
+    async def put(self, key: str, source_path: str) -> None:
+        size = await run_io(os.path.getsize, source_path)
+        if size <= settings.S3_MULTIPART_THRESHOLD:
+            content = await run_io(LocalStorage._read, source_path, 0, None)
+            await self._send(self._request("PUT", key, content=content), key)
+        else:
+            await self._put_multipart(key, source_path, size)
+        await run_io(remove, source_path)
+
+    async def _put_multipart(self, key: str, source_path: str, size: int) -> None:
+        response = await self._send(
+            self._request("POST", key, params={"uploads": ""}), key
+        )
+        upload_id = ElementTree.fromstring(response.content).findtext(
+            f"{_S3_NAMESPACE}UploadId", ""
+        )
+        if not upload_id:
+            raise StorageError("Missing upload id")
+
+        part_size = settings.S3_MULTIPART_CHUNK_SIZE
+        slots = asyncio.Semaphore(settings.S3_UPLOAD_CONCURRENCY)
+
+        async def upload_part(number: int) -> Tuple[int, str]:
+            async with slots:
+                start = (number - 1) * part_size
+                end = min(start + part_size, size) - 1
+                content = await run_io(LocalStorage._read, source_path, start, end)
+                params = {"partNumber": str(number), "uploadId": upload_id}
+                response = await self._send(
+                    self._request("PUT", key, params=params, content=content), key
+                )
+                return number, response.headers["etag"]
+
+        try:
+            count = (size + part_size - 1) // part_size
+            parts: List[Tuple[int, str]] = await asyncio.gather(
+                *(upload_part(number) for number in range(1, count + 1))
+            )
+            body = "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                for number, etag in parts
+            )
+            await self._send(
+                self._request(
+                    "POST",
+                    key,
+                    params={"uploadId": upload_id},
+                    content=(
+                        "<CompleteMultipartUpload>"
+                        f"{body}</CompleteMultipartUpload>".encode()
+                    ),
+                ),
+                key,
+            )
+        except BaseException:
+            await self.client.send(
+                self._request("DELETE", key, params={"uploadId": upload_id})
+            )
+            raise
+
+    async def get(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        request = self._request("GET", key, headers=self._range(start, end))
+        return (await self._send(request, key)).content
+
+    async def stream(
+        self, key: str, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        request = self._request("GET", key, headers=self._range(start, end))
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError as exc:
+            raise StorageError(str(exc)) from exc
+        try:
+            self._check(response, key)
+            async for chunk in response.aiter_bytes():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    async def delete(self, key: str) -> None:
+        try:
+            await self._send(self._request("DELETE", key), key)
+        except FileNotFoundError:
+            pass
+
+    async def _head(self, key: str) -> httpx.Response:
+        return await self._send(self._request("HEAD", key), key)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await self._head(key)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def size(self, key: str) -> int:
+        return int((await self._head(key)).headers["content-length"])
+
+    @asynccontextmanager
+    async def local_copy(self, key: str) -> AsyncIterator[str]:
+        path = temp_path()
+        try:
+            handler = await run_io(open, path, "wb")
+            try:
+                async for chunk in self.stream(key):
+                    await run_io(handler.write, chunk)
+            finally:
+                await run_io(handler.close)
+            yield path
+        finally:
+            await run_io(remove, path)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_storage: Storage | None = None
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        if settings.STORAGE_BACKEND == "s3":
+            _storage = S3Storage(
+                settings.S3_ENDPOINT_URL,
+                settings.S3_BUCKET,
+                region=settings.S3_REGION,
+                access_key_id=settings.S3_ACCESS_KEY_ID,
+                secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+            )
+        else:
+            _storage = LocalStorage()
+    return _storage
+
+
+async def close() -> None:
+    global _storage
+    if _storage is not None:
+        await _storage.close()
+        _storage = None
@@ -1,2 +1,3 @@
-from .crud_image import image  # noqa: F401
+from .crud_image import image, BatchResult  # noqa: F401
+from .crud_job import job  # noqa: F401
 from .exceptions import CRUDBadRequestError, CRUDInternalError  # noqa: F401
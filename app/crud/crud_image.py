@@ -1,148 +1,912 @@
-import imagehash
-import requests
+import asyncio
+import base64
+import hashlib
+import json
+import sys
 import uuid
 
-from typing import Set, Tuple, Optional
-
-from PIL import Image as PILImage
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Set, Tuple, Optional
 
 
+from sqlalchemy import delete, func, insert, literal, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 import app.models as models
 import app.schemas as schemas
 
 from fastapi import UploadFile
+from app.core import admission, blob_store, imaging
+from app.core.blob_store import StoredBlob, TempBlob
 from app.core.config import settings
+from app.core.distance import (
+    hamming,
+    hamming_hex,
+    hamming_matrix,
+    hex_sequence,
+    hex_to_int64,
+    sequence_distance,
+)
+from app.core.executor import run_cpu, run_io
+from app.core.fetcher import ContentTooLarge, FetchError, UnsupportedContentType
+from app.core.fetcher import fetcher
+from app.core.storage import get_storage, remove, temp_path
+from app.core.hash_index import index
+from app.core.metadata_cache import metadata_cache
+from app.core.metrics import stage
+from app.core.render_cache import render_cache
 
 from .exceptions import CRUDBadRequestError, CRUDInternalError
 
+if TYPE_CHECKING:
+    import numpy as np
+
 
 ImagePath = str
+BatchResult = models.Image | CRUDBadRequestError | CRUDInternalError
 
 
 class CRUDImage:
-    SUPPORTED_IMAGE_FORMAT: Set[str] = {"image/jpeg", "image/png"}
+    SUPPORTED_IMAGE_FORMAT: Set[str] = {
+        "image/jpeg",
+        "image/png",
+        "image/gif",
+        "image/webp",
+    }
+    # Animated formats are hashed frame by frame but cannot be cropped
+    CROP_IMAGE_FORMAT: Set[str] = {"image/jpeg", "image/png"}
 
-    def store_image(
+    async def stage_image(
         self,
         image_url: Optional[schemas.ImageUrl],
         image_upload: Optional[schemas.ImageUpload],
-    ) -> models.Image:
+    ) -> TempBlob:
+        """Write the image bytes to a temp file, neither stored nor hashed yet."""
         if image_url:
-            image_id, image_path = self._store_url_image(image_url.url)
-            return models.Image(
-                id=str(image_id),
-                name=image_url.name,
-                description=image_url.description,
-                path=image_path,
-                hash=self.hash_image(image_path),
-            )
+            return await self._store_url_image(image_url.url)
         elif image_upload:
-            image_id, image_path = self._store_binary_image(image_upload.file)
-            return models.Image(
-                id=str(image_id),
-                name=image_upload.name,
-                description=image_upload.description,
-                path=image_path,
-                hash=self.hash_image(image_path),
-            )
+            return await self._store_upload(image_upload.file)
         else:
             raise ValueError("Image type not supported")
 
-    def hash_image(self, path: ImagePath) -> str:
-        return str(imagehash.phash(PILImage.open(path)))
+    @staticmethod
+    def _frame_sampling() -> imaging.FrameSampling:
+        return imaging.FrameSampling(
+            strategy=settings.FRAME_SAMPLING,
+            interval=settings.FRAME_SAMPLE_INTERVAL,
+            keyframe_distance=settings.FRAME_KEYFRAME_DISTANCE,
+            max_frames=settings.FRAME_MAX_DECODED,
+            max_samples=settings.FRAME_MAX_SAMPLES,
+        )
 
-    def _create_image_metadata(self) -> Tuple[uuid.UUID, ImagePath]:
-        image_id = uuid.uuid4()
-        image_path = f"{settings.IMAGE_UPLOAD_DIR}/{str(image_id)}"
+    async def _hash_file(
+        self, local_path: str, known: Optional[imaging.ImageHashes] = None
+    ) -> imaging.ImageHashes:
+        """Hash a local file, only computing the methods `known` lacks."""
+        if known is None:
+            return await run_cpu(
+                imaging.hash_file,
+                local_path,
+                settings.HASH_METHODS,
+                self._frame_sampling(),
+            )
+        # Hashed before HASH_METHODS gained a method, frames are kept as is
+        missing = sorted(set(settings.HASH_METHODS) - known.keys())
+        hashes = await run_cpu(imaging.hash_file, local_path, missing)
+        return {**hashes, **known}
 
-        return image_id, image_path
+    async def hash_image(self, path: ImagePath) -> imaging.ImageHashes:
+        async with get_storage().local_copy(path) as local_path:
+            return await self._hash_file(local_path)
 
-    def _store_url_image(self, image_url: str) -> Tuple[uuid.UUID, ImagePath]:
-        image_id, image_path = self._create_image_metadata()
-        try:
-            response = requests.head(image_url)
-            if (
-                response.headers["content-type"].lower()
-                not in self.SUPPORTED_IMAGE_FORMAT
-            ):
-                raise CRUDBadRequestError("Image format not supported")
+    async def _hash_blob(
+        self, blob: StoredBlob | TempBlob, known: Optional[imaging.ImageHashes]
+    ) -> imaging.ImageHashes:
+        # New bytes are hashed before they are stored, so that they are not
+        # downloaded back from S3 and corrupt files are never uploaded
+        if isinstance(blob, TempBlob):
+            return await self._hash_file(blob.tmp_path, known)
+        async with get_storage().local_copy(blob.path) as local_path:
+            return await self._hash_file(local_path, known)
+
+    def _known_hashes(
+        self, db: Session, digests: Set[str]
+    ) -> Dict[str, imaging.ImageHashes]:
+        rows = db.query(models.Blob.digest, models.Blob.hashes).filter(
+            models.Blob.digest.in_(digests)
+        )
+        # Blobs staged by `stage_upload` have no hashes until their job runs
+        return {str(digest): dict(hashes) for digest, hashes in rows if hashes}
+
+    async def _hash_blobs(
+        self, db: AsyncSession, blobs: List[StoredBlob | TempBlob]
+    ) -> Dict[str, imaging.ImageHashes | Exception]:
+        """Hashes of every blob, only decoding the ones never seen before.
+
+        Known hashes are reused when they cover every configured method.
+        """
+        digests = {blob.digest for blob in blobs}
+        known = await db.run_sync(self._known_hashes, digests)
+        required = {imaging.PRIMARY_HASH_METHOD, *settings.HASH_METHODS}
+        hashes: Dict[str, imaging.ImageHashes | Exception] = {
+            digest: blob_hashes
+            for digest, blob_hashes in known.items()
+            if required <= blob_hashes.keys()
+        }
+
+        pending = {blob.digest: blob for blob in blobs}
+        missing = [digest for digest in pending if digest not in hashes]
+        results = await asyncio.gather(
+            *(
+                self._hash_blob(pending[digest], known.get(digest))
+                for digest in missing
+            ),
+            return_exceptions=True,
+        )
+        for digest, result in zip(missing, results):
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+            hashes[digest] = result
+        return hashes
+
+    def _set_hashes(
+        self, db_image: models.Image, hashes: imaging.ImageHashes
+    ) -> List[models.ImageHash]:
+        """Set the primary hash on the image, return rows for the other ones."""
+        primary_hash = hashes[imaging.PRIMARY_HASH_METHOD]
+        db_image.hash = primary_hash  # type: ignore
+        db_image.hash_int = hex_to_int64(primary_hash)  # type: ignore
+        return [
+            models.ImageHash(image_id=db_image.id, method=method, hash=image_hash)
+            for method, image_hash in sorted(hashes.items())
+            if method != imaging.PRIMARY_HASH_METHOD
+        ]
+
+    def _build_image(
+        self,
+        blob: StoredBlob | TempBlob,
+        hashes: imaging.ImageHashes,
+        name: str,
+        description: Optional[str],
+    ) -> models.Image:
+        db_image = models.Image(
+            id=str(uuid.uuid4()),
+            name=name,
+            description=description,
+            path=blob.path,
+            blob_digest=blob.digest,
+        )
+        db_image.hashes = self._set_hashes(db_image, hashes)
+        return db_image
 
-            img_data = requests.get(image_url, timeout=0.1).content
-            with open(image_path, "wb") as handler:
-                handler.write(img_data)
-        except requests.exceptions.RequestException:
+    async def _store_url_image(self, image_url: str) -> TempBlob:
+        tmp_path = temp_path()
+        try:
+            with stage("fetch") as timer:
+                size, digest = await fetcher.fetch(
+                    image_url, tmp_path, self.SUPPORTED_IMAGE_FORMAT
+                )
+                timer["size"] = size
+            return TempBlob(digest, tmp_path, size)
+        except UnsupportedContentType:
+            raise CRUDBadRequestError("Image format not supported")
+        except ContentTooLarge:
+            raise CRUDBadRequestError("Image too large")
+        except FetchError:
             raise CRUDBadRequestError("Error while downloading image")
+        except Exception:
+            await run_io(remove, tmp_path)
+            raise CRUDInternalError("Error while saving image")
+
+    async def _store_upload(self, image: UploadFile) -> TempBlob:
+        return await run_io(self._store_binary_image, image)
+
+    def _store_binary_image(self, image: UploadFile) -> TempBlob:
+        """Stream the upload to a temp file.
+
+        Memory use is bounded by the chunk size, the format is taken from the
+        magic bytes of the first chunk rather than the declared content type
+        and the digest is computed as the bytes go by.
+        """
+        tmp_path = temp_path()
+        try:
+            digest = hashlib.sha256()
+            with stage("write") as timer, open(tmp_path, "wb") as handler:
+                chunk = image.file.read(settings.UPLOAD_CHUNK_SIZE)
+                if imaging.sniff_media_type(chunk) not in self.SUPPORTED_IMAGE_FORMAT:
+                    raise CRUDBadRequestError("Image format not supported")
+
+                size = 0
+                while chunk:
+                    size += len(chunk)
+                    if size > settings.MAX_IMAGE_SIZE:
+                        raise CRUDBadRequestError("Image too large")
+                    digest.update(chunk)
+                    handler.write(chunk)
+                    chunk = image.file.read(settings.UPLOAD_CHUNK_SIZE)
+                timer["size"] = size
+            return TempBlob(digest.hexdigest(), tmp_path, size)
         except CRUDBadRequestError:
+            remove(tmp_path)
             raise
         except Exception:
+            remove(tmp_path)
             raise CRUDInternalError("Error while saving image")
 
-        return image_id, image_path
+    def _acquire_blob(
+        self,
+        db: Session,
+        digest: str,
+        count: int,
+        size: int,
+        hashes: imaging.ImageHashes,
+    ) -> None:
+        """Take references to a blob, creating its row the first time it is seen."""
+        updated = db.execute(
+            update(models.Blob)
+            .where(models.Blob.digest == digest)
+            .values(refcount=models.Blob.refcount + count)
+        )
+        if updated.rowcount == 0:  # type: ignore
+            db.add(models.Blob(digest=digest, size=size, refcount=count, hashes=hashes))
+        elif hashes:
+            blob = db.get(models.Blob, digest, populate_existing=True)
+            if blob is not None and not hashes.keys() <= blob.hashes.keys():
+                blob.hashes = {**hashes, **blob.hashes}  # type: ignore
+        db.flush()
 
-    def _store_binary_image(self, image: UploadFile) -> Tuple[uuid.UUID, ImagePath]:
-        image_id, image_path = self._create_image_metadata()
+    def _release_blob(self, db: Session, digest: str) -> bool:
+        """Drop one reference to a blob, True when its row went with the last one.
 
-        content_type = image.content_type
-        if (
-            content_type
-            and content_type.strip().lower() not in self.SUPPORTED_IMAGE_FORMAT
-        ):
-            raise CRUDBadRequestError("Image format not supported")
+        Only the transaction whose DELETE removed the row may delete the bytes:
+        a concurrent ingest of the same bytes either bumped the refcount first
+        or inserts the row again and stores the bytes anew.
+        """
+        db.execute(
+            update(models.Blob)
+            .where(models.Blob.digest == digest)
+            .values(refcount=models.Blob.refcount - 1)
+        )
+        deleted = db.execute(
+            delete(models.Blob).where(
+                models.Blob.digest == digest, models.Blob.refcount <= 0
+            )
+        )
+        return deleted.rowcount == 1  # type: ignore
+
+    async def _commit_blobs(
+        self,
+        db: AsyncSession,
+        new_blobs: Iterable[TempBlob],
+        stale_paths: Iterable[str] = (),
+    ) -> None:
+        """Store the new blobs and delete the stale ones, then commit.
 
+        The transaction holds the references to the new blobs and has deleted
+        the rows of the stale ones, so a concurrent release cannot delete the
+        bytes kept here, nor a concurrent ingest count on the bytes deleted.
+        """
+        storage = get_storage()
         try:
-            with open(image_path, "wb") as handler:
-                handler.write(image.file.read())
+            await asyncio.gather(*map(blob_store.commit, new_blobs))
+            for path in stale_paths:
+                await storage.delete(path)
+            await db.commit()
         except Exception:
-            raise CRUDInternalError("Error while saving image")
+            await db.rollback()
+            raise
+
+    def _pin_blob(self, db: Session, blob: TempBlob) -> None:
+        # Same race as in `_save_all` when the bytes are new
+        for attempt in range(2):
+            try:
+                self._acquire_blob(db, blob.digest, 1, blob.size, {})
+                return
+            except IntegrityError:
+                db.rollback()
+                if attempt:
+                    raise
+            except Exception:
+                db.rollback()
+                raise
 
-        return image_id, image_path
+    async def _unpin_blob(self, db: AsyncSession, blob: StoredBlob) -> None:
+        try:
+            released = await db.run_sync(self._release_blob, blob.digest)
+        except Exception:
+            await db.rollback()
+            raise
+        await self._commit_blobs(db, (), [blob.path] if released else [])
 
-    def create_image(
+    def _save_all(
+        self, db: Session, db_images: List[models.Image], sizes: Dict[str, int]
+    ) -> None:
+        """Insert the images and take their blob references, left uncommitted."""
+        columns = models.Image.__table__.columns.keys()
+        hash_columns = models.ImageHash.__table__.columns.keys()
+        image_hashes = [image_hash for img in db_images for image_hash in img.hashes]
+        blobs: Dict[str, Tuple[int, imaging.ImageHashes]] = {}
+        for img in db_images:
+            count, blob_hashes = blobs.get(str(img.blob_digest), (0, {}))
+            if not count:
+                blob_hashes = {imaging.PRIMARY_HASH_METHOD: str(img.hash)}
+                blob_hashes.update({str(h.method): str(h.hash) for h in img.hashes})
+            blobs[str(img.blob_digest)] = (count + 1, blob_hashes)
+        # A concurrent ingest of the same new bytes can win the blob insert,
+        # the second attempt then finds the blob and only bumps its refcount.
+        for attempt in range(2):
+            try:
+                for digest, (count, blob_hashes) in blobs.items():
+                    self._acquire_blob(db, digest, count, sizes[digest], blob_hashes)
+                db.execute(
+                    insert(models.Image),
+                    [{key: getattr(img, key) for key in columns} for img in db_images],
+                )
+                if image_hashes:
+                    db.execute(
+                        insert(models.ImageHash),
+                        [
+                            {key: getattr(image_hash, key) for key in hash_columns}
+                            for image_hash in image_hashes
+                        ],
+                    )
+                db.flush()
+                return
+            except IntegrityError:
+                db.rollback()
+                if attempt:
+                    raise
+            except Exception:
+                db.rollback()
+                raise
+
+    async def _create(
+        self,
+        db: AsyncSession,
+        items: List[Tuple[StoredBlob | TempBlob | Exception, str, Optional[str]]],
+    ) -> List[BatchResult]:
+        """Hash the staged blobs and insert their images in one transaction."""
+        blobs = [
+            blob for blob, _, _ in items if isinstance(blob, (StoredBlob, TempBlob))
+        ]
+        try:
+            return await self._hash_and_save(db, items, blobs)
+        finally:
+            # Only the temp files of images that failed are still there
+            for blob in blobs:
+                if isinstance(blob, TempBlob):
+                    await run_io(remove, blob.tmp_path)
+
+    async def _hash_and_save(
+        self,
+        db: AsyncSession,
+        items: List[Tuple[StoredBlob | TempBlob | Exception, str, Optional[str]]],
+        blobs: List[StoredBlob | TempBlob],
+    ) -> List[BatchResult]:
+        hashes = await self._hash_blobs(db, blobs) if blobs else {}
+
+        results: List[BatchResult] = []
+        for blob, name, description in items:
+            if isinstance(blob, (StoredBlob, TempBlob)):
+                blob_hashes = hashes[blob.digest]
+                if isinstance(blob_hashes, Exception):
+                    results.append(CRUDInternalError("Error while processing image"))
+                else:
+                    results.append(
+                        self._build_image(blob, blob_hashes, name, description)
+                    )
+            elif isinstance(blob, (CRUDBadRequestError, CRUDInternalError)):
+                results.append(blob)
+            else:
+                results.append(CRUDInternalError("Error while processing image"))
+
+        db_images = [res for res in results if isinstance(res, models.Image)]
+        if db_images:
+            sizes = {blob.digest: blob.size for blob in blobs}
+            digests = {str(db_image.blob_digest) for db_image in db_images}
+            temps = {
+                blob.digest: blob
+                for blob in blobs
+                if isinstance(blob, TempBlob) and blob.digest in digests
+            }
+            try:
+                await db.run_sync(self._save_all, db_images, sizes)
+                await self._commit_blobs(db, temps.values())
+            except Exception:
+                error = CRUDInternalError("Error while saving images")
+                results = [error if isinstance(r, models.Image) else r for r in results]
+                db_images = []
+
+        await run_io(
+            index.add_many,
+            [(str(db_image.id), int(db_image.hash_int)) for db_image in db_images],
+        )
+        await metadata_cache.set_many(map(schemas.ImageInDB.from_orm, db_images))
+        return results
+
+    async def _stage_item(
         self,
-        db: Session,
+        image_url: Optional[schemas.ImageUrl],
+        image_upload: Optional[schemas.ImageUpload],
+    ) -> TempBlob | Exception:
+        try:
+            return await self.stage_image(image_url, image_upload)
+        except Exception as exc:
+            return exc
+
+    async def create_image(
+        self,
+        db: AsyncSession,
         image_url: Optional[schemas.ImageUrl],
         image_upload: Optional[schemas.ImageUpload],
     ) -> models.Image:
-        db_image = self.store_image(image_url, image_upload)
+        image_info = image_url or image_upload
+        if not image_info:
+            raise ValueError("Image type not supported")
 
-        db.add(db_image)
-        db.commit()
-        db.refresh(db_image)
-        return db_image
+        blob = await self.stage_image(image_url, image_upload)
+        (result,) = await self._create(
+            db, [(blob, image_info.name, image_info.description)]
+        )
+        if isinstance(result, (CRUDBadRequestError, CRUDInternalError)):
+            raise result
+        return result
+
+    async def stage_upload(
+        self, db: AsyncSession, image_upload: schemas.ImageUpload
+    ) -> StoredBlob:
+        """Only store the uploaded bytes, hashing is left to `create_staged_image`.
+
+        The staged blob holds a reference until then, so that removing the
+        last image sharing its bytes does not delete them in the meantime.
+        """
+        blob = await self._store_upload(image_upload.file)
+        try:
+            await db.run_sync(self._pin_blob, blob)
+            await self._commit_blobs(db, [blob])
+        except Exception:
+            raise CRUDInternalError("Error while saving image")
+        finally:
+            await run_io(remove, blob.tmp_path)
+        return StoredBlob(blob.digest, blob.path, blob.size)
+
+    async def unstage_upload(self, db: AsyncSession, blob: StoredBlob) -> None:
+        """Drop the reference of a `stage_upload` blob whose job was not queued."""
+        # The failed job insert may have left the transaction to roll back
+        await db.rollback()
+        await self._unpin_blob(db, blob)
+
+    async def create_staged_image(
+        self,
+        db: AsyncSession,
+        blob: StoredBlob,
+        name: str,
+        description: Optional[str],
+    ) -> models.Image:
+        """Hash and insert a blob from `stage_upload`, dropping its reference."""
+        try:
+            (result,) = await self._create(db, [(blob, name, description)])
+        finally:
+            await self._unpin_blob(db, blob)
+        if isinstance(result, (CRUDBadRequestError, CRUDInternalError)):
+            raise result
+        return result
 
-    def get_image(self, db: Session, image_id: uuid.UUID) -> models.Image | None:
+    async def create_images(
+        self,
+        db: AsyncSession,
+        image_urls: Optional[List[schemas.ImageUrl]],
+        image_uploads: Optional[List[schemas.ImageUpload]],
+    ) -> List[BatchResult]:
+        """Store and hash every image concurrently, insert them in one transaction.
+
+        Failures are returned in place of the image so callers can report them
+        per item.
+        """
+        items: List[Tuple[Optional[schemas.ImageUrl], Optional[schemas.ImageUpload]]]
+        items = [(url, None) for url in image_urls or []]
+        items += [(None, upload) for upload in image_uploads or []]
+        if len(items) > settings.BATCH_MAX_ITEMS:
+            raise CRUDBadRequestError(
+                f"Too many images in batch (max {settings.BATCH_MAX_ITEMS})"
+            )
+
+        blobs = await asyncio.gather(
+            *(self._stage_item(url, upload) for url, upload in items)
+        )
+        return await self._create(
+            db,
+            [
+                (blob, info.name, info.description)
+                for blob, info in zip(blobs, (url or upload for url, upload in items))
+                if info
+            ],
+        )
+
+    def _get_image(self, db: Session, image_id: uuid.UUID) -> models.Image | None:
         return db.query(models.Image).filter(models.Image.id == str(image_id)).first()
 
-    def image_diff(
-        self, source_image: models.Image, target_image: models.Image
+    def _get_images(self, db: Session, image_ids: List[str]) -> List[models.Image]:
+        return db.query(models.Image).filter(models.Image.id.in_(image_ids)).all()
+
+    async def get_images(
+        self, db: AsyncSession, image_ids: List[uuid.UUID]
+    ) -> Dict[str, schemas.ImageInDB]:
+        """Images found by id, from the metadata cache or else in one query."""
+        ids = list(dict.fromkeys(map(str, image_ids)))
+        images = await metadata_cache.get_many(ids)
+        missing = [image_id for image_id in ids if image_id not in images]
+        if missing:
+            rows = await db.run_sync(self._get_images, missing)
+            loaded = [schemas.ImageInDB.from_orm(row) for row in rows]
+            await metadata_cache.set_many(loaded)
+            images.update((str(image.id), image) for image in loaded)
+        return images
+
+    async def get_image(
+        self, db: AsyncSession, image_id: uuid.UUID
+    ) -> schemas.ImageInDB | None:
+        return (await self.get_images(db, [image_id])).get(str(image_id))
+
+    def _get_hashes(
+        self, db: Session, image_ids: List[str], method: str
+    ) -> Dict[str, str]:
+        rows = db.query(models.ImageHash.image_id, models.ImageHash.hash).filter(
+            models.ImageHash.image_id.in_(image_ids),
+            models.ImageHash.method == method,
+        )
+        return {str(image_id): str(image_hash) for image_id, image_hash in rows}
+
+    async def image_diff(
+        self,
+        db: AsyncSession,
+        source_image: schemas.ImageInDB,
+        target_image: schemas.ImageInDB,
+        method: schemas.HashMethod = schemas.HashMethod.phash,
     ) -> float:
-        source_image_hash = imagehash.hex_to_hash(str(source_image.hash))
-        target_image_hash = imagehash.hex_to_hash(str(target_image.hash))
+        if method.value == imaging.PRIMARY_HASH_METHOD:
+            return hamming(int(source_image.hash_int), int(target_image.hash_int))
+        if method.value == imaging.FRAME_HASH_METHOD:
+            return await self._sequence_diff(db, source_image, target_image)
 
-        return source_image_hash - target_image_hash
+        source_id, target_id = str(source_image.id), str(target_image.id)
+        hashes = await db.run_sync(
+            self._get_hashes, [source_id, target_id], method.value
+        )
+        if source_id not in hashes or target_id not in hashes:
+            raise CRUDBadRequestError(f"Hash method {method.value} not available")
+        return hamming_hex(hashes[source_id], hashes[target_id])
 
-    def crop_image(
-        self, db: Session, image: models.Image, width: int, height: int
-    ) -> models.Image:
+    async def _sequence_diff(
+        self,
+        db: AsyncSession,
+        source_image: schemas.ImageInDB,
+        target_image: schemas.ImageInDB,
+    ) -> float:
+        """Distance between the frame sequences, stills being one frame long."""
+        images = [source_image, target_image]
+        hashes = await db.run_sync(
+            self._get_hashes,
+            [str(image.id) for image in images],
+            imaging.FRAME_HASH_METHOD,
+        )
+        source, target = (
+            hex_sequence(hashes[str(image.id)])
+            if str(image.id) in hashes
+            else [int(image.hash_int)]
+            for image in images
+        )
+        # At most FRAME_MAX_SAMPLES squared steps, cheap enough to run inline
+        return sequence_distance(source, target)
+
+    @staticmethod
+    def _encode_cursor(sort: str, values: List[str]) -> str:
+        return base64.urlsafe_b64encode(json.dumps([sort, *values]).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str, sort: str, size: int) -> List[str]:
         try:
-            img = PILImage.open(image.path, formats=["JPEG", "PNG"])
-            img_width, img_height = img.size
-            left = (img_width - width) / 2
-            top = (img_height - height) / 2
-            right = (img_width + width) / 2
-            bottom = (img_height + height) / 2
-            new_img = img.crop((left, top, right, bottom))
-            new_img.save(image.path, format=img.format)
-
-            image.hash = self.hash_image(str(image.path))  # type: ignore
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            raise CRUDBadRequestError("Invalid cursor")
+        if not isinstance(values, list) or values[:1] != [sort]:
+            raise CRUDBadRequestError("Invalid cursor")
+        if len(values) != size + 1 or not all(isinstance(v, str) for v in values):
+            raise CRUDBadRequestError("Invalid cursor")
+        return values[1:]
+
+    @staticmethod
+    def _prefix_filter(column: Any, prefix: str) -> List[Any]:
+        # A range instead of LIKE, so the index is used whatever the collation
+        conditions = [column >= prefix]
+        if ord(prefix[-1]) < sys.maxunicode:
+            conditions.append(column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return conditions
+
+    def _list_images(
+        self,
+        db: Session,
+        keys: List[Any],
+        conditions: List[Any],
+        after: Optional[List[str]],
+        limit: int,
+    ) -> List[models.Image]:
+        query = db.query(models.Image).filter(*conditions)
+        if after is not None:
+            query = query.filter(tuple_(*keys) > tuple_(*map(literal, after)))
+        return query.order_by(*keys).limit(limit).all()
+
+    async def list_images(
+        self,
+        db: AsyncSession,
+        limit: int,
+        cursor: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        image_hash: Optional[str] = None,
+        hash_prefix: Optional[str] = None,
+    ) -> Tuple[List[models.Image], Optional[str]]:
+        """One page of images and the cursor of the next one.
+
+        Pages are ordered by an indexed (column, id) pair and resume after the
+        last row of the previous page, so every page costs the same however
+        deep it is. The column is the most selective filter given.
+        """
+        sort, conditions = "id", []
+        if name_prefix:
+            sort = "name"
+            conditions += self._prefix_filter(models.Image.name, name_prefix)
+        if hash_prefix:
+            sort = "hash"
+            conditions += self._prefix_filter(models.Image.hash, hash_prefix.lower())
+        if image_hash:
+            sort = "hash"
+            conditions.append(models.Image.hash == image_hash.lower())
+
+        keys = [models.Image.id]
+        if sort != "id":
+            keys.insert(0, getattr(models.Image, sort))
+        after = self._decode_cursor(cursor, sort, len(keys)) if cursor else None
+
+        rows = await db.run_sync(self._list_images, keys, conditions, after, limit + 1)
+        if len(rows) <= limit:
+            return rows, None
+        last = rows[limit - 1]
+        values = [str(getattr(last, key.key)) for key in keys]
+        return rows[:limit], self._encode_cursor(sort, values)
+
+    async def lookup_images(
+        self, db: AsyncSession, image_ids: List[uuid.UUID]
+    ) -> Tuple[List[schemas.ImageInDB], List[uuid.UUID]]:
+        """Images found, in request order, and the ids that were not found."""
+        if len(image_ids) > settings.LOOKUP_MAX_ITEMS:
+            raise CRUDBadRequestError(
+                f"Too many images in lookup (max {settings.LOOKUP_MAX_ITEMS})"
+            )
+        images = await self.get_images(db, image_ids)
+        found = [images[str(id)] for id in image_ids if str(id) in images]
+        missing = [id for id in image_ids if str(id) not in images]
+        return found, missing
+
+    async def diff_matrix(
+        self,
+        db: AsyncSession,
+        source_images: List[schemas.ImageInDB],
+        target_images: List[schemas.ImageInDB],
+        method: schemas.HashMethod = schemas.HashMethod.phash,
+    ) -> "np.ndarray":
+        """Pairwise distances, one row per source and one column per target."""
+        if method.value == imaging.FRAME_HASH_METHOD:
+            raise CRUDBadRequestError(
+                f"Hash method {method.value} not available for diff matrices"
+            )
+        if method.value == imaging.PRIMARY_HASH_METHOD:
+            return hamming_matrix(
+                [image.hash_int for image in source_images],
+                [image.hash_int for image in target_images],
+            )
+
+        ids = {str(image.id) for image in source_images + target_images}
+        hashes = await db.run_sync(self._get_hashes, list(ids), method.value)
+        if not ids <= hashes.keys():
+            raise CRUDBadRequestError(f"Hash method {method.value} not available")
+        return hamming_matrix(
+            [hex_to_int64(hashes[str(image.id)]) for image in source_images],
+            [hex_to_int64(hashes[str(image.id)]) for image in target_images],
+        )
+
+    def _replace_blob(
+        self,
+        db: Session,
+        image: models.Image,
+        image_hashes: List[models.ImageHash],
+        blob: TempBlob,
+        hashes: imaging.ImageHashes,
+        old_digest: Optional[str],
+    ) -> bool:
+        """Point the image to a new blob, True when the old one is unused now.
+
+        Left uncommitted, the new blob is stored before the commit.
+        """
+        try:
+            self._acquire_blob(db, blob.digest, 1, blob.size, hashes)
+            released = self._release_blob(db, old_digest) if old_digest else True
+            db.query(models.ImageHash).filter(
+                models.ImageHash.image_id == image.id
+            ).delete()
+            db.add_all(image_hashes)
             db.add(image)
-            db.commit()
-            db.refresh(image)
+            db.flush()
+        except Exception:
+            db.rollback()
+            raise
+        return released
+
+    async def crop_image(
+        self, db: AsyncSession, image: schemas.ImageInDB, width: int, height: int
+    ) -> schemas.ImageInDB:
+        """Crop into a new blob, the original bytes may be shared with others."""
+        storage = get_storage()
+        tmp_path = temp_path()
+        try:
+            # Writes start from the row, never from a cached copy of it
+            db_image = await db.run_sync(self._get_image, image.id)
+            if db_image is None:
+                raise ValueError("Image not found")
+            old_path, old_digest = str(db_image.path), db_image.blob_digest
+            header = await storage.get(old_path, 0, 15)
+            if imaging.sniff_media_type(header) not in self.CROP_IMAGE_FORMAT:
+                raise CRUDBadRequestError("Image format not supported")
+            async with storage.local_copy(old_path) as source_path:
+                hashes, digest, size = await run_cpu(
+                    imaging.crop_file,
+                    source_path,
+                    tmp_path,
+                    width,
+                    height,
+                    settings.HASH_METHODS,
+                )
+            blob = TempBlob(digest, tmp_path, size)
+
+            db_image.path = blob.path  # type: ignore
+            db_image.blob_digest = blob.digest  # type: ignore
+            image_hashes = self._set_hashes(db_image, hashes)
+            released = await db.run_sync(
+                self._replace_blob, db_image, image_hashes, blob, hashes, old_digest
+            )
+            stale = [old_path] if released and old_path != blob.path else []
+            await self._commit_blobs(db, [blob], stale)
+        except CRUDBadRequestError:
+            raise
         except Exception as e:
-            raise CRUDInternalError(f"Error while cropping image {str(e)}")
-        return image
+            await run_io(remove, tmp_path)
+            # Other errors may name storage paths
+            if isinstance(e, ValueError):
+                raise CRUDInternalError(f"Error while cropping image {str(e)}")
+            raise CRUDInternalError("Error while cropping image")
+
+        image_hash = int(db_image.hash_int)  # type: ignore
+        await run_io(index.add, str(db_image.id), image_hash)
+        cropped = schemas.ImageInDB.from_orm(db_image)
+        await metadata_cache.set_many([cropped])
+        return cropped
+
+    def build_index(self, db: Session) -> None:
+        """Open the hash snapshot, rebuilt from the table when out of date.
+
+        Only the number of images is compared, a snapshot missing changes
+        made on another host with as many images goes unnoticed.
+        """
+        count = db.query(func.count(models.Image.id)).scalar()
+        if index.load() == count:
+            return
+        rows = db.query(models.Image.id, models.Image.hash_int).yield_per(10_000)
+        index.build((str(image_id), int(image_hash)) for image_id, image_hash in rows)
+
+    async def similar_images(
+        self, image: schemas.ImageInDB, max_distance: int, limit: int
+    ) -> List[Tuple[str, int]]:
+        matches = await run_io(
+            index.search, int(image.hash_int), max_distance, limit + 1
+        )
+        return [match for match in matches if match[0] != str(image.id)][:limit]
+
+    async def _reload_image(
+        self, db: AsyncSession, image: schemas.ImageInDB
+    ) -> schemas.ImageInDB:
+        """Read the image row again, replacing its cached copy.
+
+        A crop in another process deletes the blob a cached copy may still
+        point to, until the TTL expires.
+        """
+        db_image = await db.run_sync(self._get_image, image.id)
+        if db_image is None:
+            raise CRUDInternalError("Image not found")
+        fresh = schemas.ImageInDB.from_orm(db_image)
+        await metadata_cache.set_many([fresh])
+        return fresh
+
+    async def _render(
+        self,
+        image: schemas.ImageInDB,
+        width: int,
+        height: int,
+        mode: schemas.RenderMode,
+        format_name: Optional[str],
+    ) -> ImagePath:
+        # Renditions are shared by every image with the same bytes
+        source = image.blob_digest or f"{image.id}/{image.hash}"
+        key = render_cache.key(source, width, height, mode.value, format_name)
+
+        async def render(target_path: str) -> None:
+            # Only a miss does CPU work, so only a miss takes a crop slot
+            async with admission.limiters["crop"].slot(), get_storage().local_copy(
+                str(image.path)
+            ) as source_path:
+                await run_cpu(
+                    imaging.render_file,
+                    source_path,
+                    target_path,
+                    width,
+                    height,
+                    mode.value,
+                    format_name,
+                )
+
+        return await render_cache.get(key, render)
+
+    async def render_image(
+        self,
+        db: AsyncSession,
+        image: schemas.ImageInDB,
+        width: int,
+        height: int,
+        mode: schemas.RenderMode,
+        image_format: Optional[schemas.RenderFormat],
+    ) -> Tuple[ImagePath, str]:
+        """Path and media type of a cached rendition, rendered on first use."""
+        format_name = image_format.value.upper() if image_format else None
+        try:
+            try:
+                path = await self._render(image, width, height, mode, format_name)
+            except FileNotFoundError:
+                image = await self._reload_image(db, image)
+                path = await self._render(image, width, height, mode, format_name)
+            header = await run_io(self._read_header, path)
+        except admission.Rejected:
+            raise
+        except Exception:
+            raise CRUDInternalError("Error while rendering image")
+        return path, imaging.sniff_media_type(header) or "application/octet-stream"
+
+    async def _content(self, image: schemas.ImageInDB) -> Tuple[str, int, str]:
+        storage = get_storage()
+        size, header = await asyncio.gather(
+            storage.size(str(image.path)), storage.get(str(image.path), 0, 15)
+        )
+        media_type = imaging.sniff_media_type(header) or "application/octet-stream"
+        return str(image.path), size, media_type
+
+    async def get_content(
+        self, db: AsyncSession, image: schemas.ImageInDB
+    ) -> Tuple[schemas.ImageInDB, str, int, str]:
+        """Storage key, size and media type of the stored image bytes.
+
+        Also returns the image, read again when its cached copy was stale.
+        """
+        try:
+            try:
+                return (image, *await self._content(image))
+            except FileNotFoundError:
+                image = await self._reload_image(db, image)
+                return (image, *await self._content(image))
+        except Exception:
+            raise CRUDInternalError("Error while reading image")
+
+    @staticmethod
+    def _read_header(path: ImagePath) -> bytes:
+        with open(path, "rb") as handler:
+            return handler.read(16)
 
 
 image = CRUDImage()
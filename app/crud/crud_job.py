@@ -0,0 +1,144 @@
+import uuid
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import app.models as models
+import app.schemas as schemas
+
+
+class CRUDJob:
+    def _create_job(
+        self,
+        db: Session,
+        kind: schemas.JobKind,
+        payload: Dict[str, Any],
+        image_id: Optional[str],
+    ) -> models.Job:
+        job = models.Job(
+            id=str(uuid.uuid4()),
+            kind=kind.value,
+            status=schemas.JobStatus.pending.value,
+            payload=payload,
+            image_id=image_id,
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        return job
+
+    async def create_job(
+        self,
+        db: AsyncSession,
+        kind: schemas.JobKind,
+        payload: Dict[str, Any],
+        image_id: Optional[str] = None,
+    ) -> models.Job:
+        return await db.run_sync(self._create_job, kind, payload, image_id)
+
+    def _get_job(self, db: Session, job_id: uuid.UUID) -> models.Job | None:
+        return db.query(models.Job).filter(models.Job.id == str(job_id)).first()
+
+    async def get_job(self, db: AsyncSession, job_id: uuid.UUID) -> models.Job | None:
+        return await db.run_sync(self._get_job, job_id)
+
+    def _claim_job(self, db: Session) -> models.Job | None:
+        # Several workers, possibly in other processes, race for the same rows:
+        # only the one whose conditional update hits the row owns the job.
+        while True:
+            job_id = (
+                db.query(models.Job.id)
+                .filter(models.Job.status == schemas.JobStatus.pending.value)
+                .order_by(models.Job.created_at)
+                .limit(1)
+                .scalar()
+            )
+            if job_id is None:
+                return None
+
+            claimed = db.execute(
+                update(models.Job)
+                .where(
+                    models.Job.id == job_id,
+                    models.Job.status == schemas.JobStatus.pending.value,
+                )
+                .values(
+                    status=schemas.JobStatus.running.value,
+                    updated_at=datetime.utcnow(),
+                )
+            )
+            db.commit()
+            if claimed.rowcount == 1:  # type: ignore
+                return self._get_job(db, job_id)
+
+    async def claim_job(self, db: AsyncSession) -> models.Job | None:
+        """Mark the oldest pending job as running and return it."""
+        return await db.run_sync(self._claim_job)
+
+    def _finish_job(
+        self,
+        db: Session,
+        job: models.Job,
+        status: schemas.JobStatus,
+        image_id: Optional[str],
+        error: Optional[str],
+    ) -> models.Job:
+        job.status = status.value  # type: ignore
+        job.image_id = image_id or job.image_id  # type: ignore
+        job.error = error  # type: ignore
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        return job
+
+    async def complete_job(
+        self, db: AsyncSession, job: models.Job, image_id: str
+    ) -> models.Job:
+        return await db.run_sync(
+            self._finish_job, job, schemas.JobStatus.succeeded, image_id, None
+        )
+
+    async def fail_job(
+        self, db: AsyncSession, job: models.Job, error: str
+    ) -> models.Job:
+        return await db.run_sync(
+            self._finish_job, job, schemas.JobStatus.failed, None, error
+        )
+
+    def _refresh_job(self, db: Session, job_id: str) -> None:
+        db.execute(
+            update(models.Job)
+            .where(
+                models.Job.id == job_id,
+                models.Job.status == schemas.JobStatus.running.value,
+            )
+            .values(updated_at=datetime.utcnow())
+        )
+        db.commit()
+
+    async def refresh_job(self, db: AsyncSession, job_id: str) -> None:
+        """Extend the lease of a running job."""
+        await db.run_sync(self._refresh_job, job_id)
+
+    def _requeue_stale_jobs(self, db: Session, lease: timedelta) -> int:
+        requeued = db.execute(
+            update(models.Job)
+            .where(
+                models.Job.status == schemas.JobStatus.running.value,
+                models.Job.updated_at < datetime.utcnow() - lease,
+            )
+            .values(status=schemas.JobStatus.pending.value)
+        )
+        db.commit()
+        return requeued.rowcount  # type: ignore
+
+    async def requeue_stale_jobs(self, db: AsyncSession, lease: timedelta) -> int:
+        """Give back jobs left running by a worker that died mid-job."""
+        return await db.run_sync(self._requeue_stale_jobs, lease)
+
+
+job = CRUDJob()
@@ -0,0 +1,103 @@
+from typing import Callable, List
+
+from sqlalchemy import Connection, Engine, inspect, text
+
+import app.models  # noqa: F401
+
+from app.core.config import settings
+from app.core.distance import hex_to_int64
+from app.db import Base
+
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _add_image_hash_int(conn: Connection) -> None:
+    columns = {column["name"] for column in inspect(conn).get_columns("images")}
+    if "hash_int" not in columns:
+        conn.execute(text("ALTER TABLE images ADD COLUMN hash_int BIGINT"))
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_images_hash_int ON images (hash_int)")
+    )
+
+    while True:
+        rows = conn.execute(
+            text("SELECT id, hash FROM images WHERE hash_int IS NULL LIMIT :limit"),
+            {"limit": BACKFILL_BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE images SET hash_int = :hash_int WHERE id = :id"),
+            [{"id": row.id, "hash_int": hex_to_int64(row.hash)} for row in rows],
+        )
+
+
+def _add_image_blob_digest(conn: Connection) -> None:
+    columns = {column["name"] for column in inspect(conn).get_columns("images")}
+    if "blob_digest" not in columns:
+        conn.execute(
+            text(
+                "ALTER TABLE images ADD COLUMN blob_digest VARCHAR "
+                "REFERENCES blobs (digest)"
+            )
+        )
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_images_blob_digest ON images (blob_digest)")
+    )
+
+
+def _make_image_paths_relative(conn: Connection) -> None:
+    # Paths become storage keys, relative to the upload dir
+    prefix = f"{settings.IMAGE_UPLOAD_DIR}/"
+    conn.execute(
+        text(
+            "UPDATE images SET path = substr(path, :start) "
+            "WHERE substr(path, 1, :length) = :prefix"
+        ),
+        {"start": len(prefix) + 1, "length": len(prefix), "prefix": prefix},
+    )
+
+
+def _add_image_listing_indexes(conn: Connection) -> None:
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_images_name_id ON images (name, id)")
+    )
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_images_hash_id ON images (hash, id)")
+    )
+
+
+# Applied in order, each one exactly once, the version is the list position
+MIGRATIONS: List[Callable[[Connection], None]] = [
+    _add_image_hash_int,
+    _add_image_blob_digest,
+    _make_image_paths_relative,
+    _add_image_listing_indexes,
+]
+
+
+def run_migrations(engine: Engine) -> None:
+    """Create missing tables and bring existing ones up to the latest version."""
+    with engine.begin() as conn:
+        Base.metadata.create_all(bind=conn)
+        conn.execute(
+            text("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER)")
+        )
+        current = conn.execute(
+            text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        ).scalar_one()
+
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version > current:
+                migration(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                    {"version": version},
+                )
+
+
+if __name__ == "__main__":
+    from app.db.session import engine
+
+    run_migrations(engine)
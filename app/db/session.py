@@ -1,8 +1,100 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
 
+from typing import Any, Dict
+
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.core import metrics
 from app.core.config import settings
 
 
-engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True)
+# Async drivers used by the request path for each sync URL scheme
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def async_url(url: URL) -> URL:
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def engine_options(url: URL, is_async: bool = False) -> Dict[str, Any]:
+    options: Dict[str, Any] = {"pool_pre_ping": True}
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        if is_async and url.get_backend_name() == "sqlite":
+            # aiosqlite opens a new connection per checkout by default
+            options["poolclass"] = AsyncAdaptedQueuePool
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+        )
+    return options
+
+
+def _set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    # WAL lets readers run while a write is in progress, NORMAL only syncs at
+    # checkpoints which is still safe against corruption in WAL mode
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def _start_commit(session: Session) -> None:
+    session.info["commit_started"] = time.perf_counter()
+
+
+def _end_commit(session: Session) -> None:
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        metrics.record_stage("db_commit", time.perf_counter() - started)
+
+
+def _pool_connections() -> Dict[metrics.Labels, float]:
+    connections: Dict[metrics.Labels, float] = {}
+    for name, pool in (("sync", engine.pool), ("async", async_engine.pool)):
+        if isinstance(pool, QueuePool):
+            connections[(name, "checked_out")] = pool.checkedout()
+            connections[(name, "idle")] = pool.checkedin()
+            connections[(name, "overflow")] = max(0, pool.overflow())
+    return connections
+
+
+url = make_url(settings.SQLALCHEMY_DATABASE_URI)
+
+# Sync engine for migrations, index builds and scripts
+engine = create_engine(url, **engine_options(url))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine for request handlers and job workers
+async_engine = create_async_engine(async_url(url), **engine_options(url, is_async=True))
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+if url.get_backend_name() == "sqlite":
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+# Every commit is timed, whichever code path makes it
+event.listen(Session, "before_commit", _start_commit)
+event.listen(Session, "after_commit", _end_commit)
+event.listen(Session, "after_rollback", _end_commit)
+
+metrics.registry.register(
+    metrics.CallbackMetric(
+        "db_pool_connections",
+        "Connections of each database pool by state",
+        "gauge",
+        _pool_connections,
+        ["engine", "state"],
+    )
+)
@@ -1,17 +1,49 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
 from fastapi import FastAPI
 
+from app import crud
+from app.api import admission, metrics
 from app.api.api_v1.api import api_router
+from app.core import executor, storage
 from app.core.config import settings
+from app.core.fetcher import fetcher
+from app.core.metadata_cache import metadata_cache
+from app.core.render_cache import render_cache
 
-from app.db.session import engine
-from app.db import Base
+from app.db.migrations import run_migrations
+from app.db.session import SessionLocal, async_engine, engine
+from app.worker import worker
 
 
-Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    if settings.RUN_MIGRATIONS:
+        await executor.run_io(run_migrations, engine)
+    with SessionLocal() as db:
+        await executor.run_io(crud.image.build_index, db)
+    if settings.JOB_WORKERS > 0:
+        await worker.start(settings.JOB_WORKERS)
+    yield
+    await worker.stop()
+    await fetcher.close()
+    await storage.close()
+    await async_engine.dispose()
+    render_cache.reset()
+    await metadata_cache.close()
+    executor.shutdown()
 
 
 app = FastAPI(
-    title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    title=settings.PROJECT_NAME,
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    lifespan=lifespan,
 )
 
+# Added last runs first, rejected requests are measured too
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
 app.include_router(api_router, prefix=settings.API_V1_STR)
+app.include_router(metrics.router)
@@ -1 +1,4 @@
+from .blob import Blob  # noqa: F401
 from .image import Image  # noqa: F401
+from .image_hash import ImageHash  # noqa: F401
+from .job import Job  # noqa: F401
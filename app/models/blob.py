@@ -0,0 +1,20 @@
+from sqlalchemy import JSON, BigInteger, Column, Integer, String
+
+from app.db import Base
+
+
+class Blob(Base):
+    """Stored image bytes, addressed by their SHA-256 digest.
+
+    Every image referencing the blob holds one reference, as does a pending
+    upload job staging it, the file is removed with the last one. The hashes
+    are kept so re-uploads skip hashing, they are empty until the blob is
+    first hashed.
+    """
+
+    __tablename__ = "blobs"
+
+    digest = Column(String, primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    hashes = Column(JSON, nullable=False)
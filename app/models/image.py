@@ -1,13 +1,33 @@
-from sqlalchemy import Column, String
+from typing import List, TYPE_CHECKING
+
+from sqlalchemy import BigInteger, Column, ForeignKey, Index, String
+from sqlalchemy.orm import Mapped, relationship
 
 from app.db import Base
 
+if TYPE_CHECKING:
+    from .image_hash import ImageHash
+
 
 class Image(Base):
     __tablename__ = "images"
+    # Keyset pagination orders by (column, id), see CRUDImage.list_images
+    __table_args__ = (
+        Index("ix_images_name_id", "name", "id"),
+        Index("ix_images_hash_id", "hash", "id"),
+    )
 
     id = Column(String, index=True, primary_key=True)
     name = Column(String, nullable=False)
     description = Column(String, nullable=True)
     hash = Column(String, index=True, nullable=False)
+    # Same phash as a signed 64-bit integer, for XOR/popcount distances
+    hash_int = Column(BigInteger, index=True, nullable=True)
     path = Column(String, nullable=False)
+    # Content address of the bytes, NULL for images stored before blobs
+    blob_digest = Column(String, ForeignKey("blobs.digest"), index=True, nullable=True)
+
+    # Only written through the ORM, always queried explicitly
+    hashes: Mapped[List["ImageHash"]] = relationship(
+        "ImageHash", cascade="all, delete-orphan", lazy="raise_on_sql"
+    )
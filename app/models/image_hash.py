@@ -0,0 +1,18 @@
+from sqlalchemy import Column, ForeignKey, String
+
+from app.db import Base
+
+
+class ImageHash(Base):
+    """Additional hashes of an image, one row per hashing method.
+
+    The primary phash stays on `images.hash` and is not repeated here.
+    """
+
+    __tablename__ = "image_hashes"
+
+    image_id = Column(
+        String, ForeignKey("images.id", ondelete="CASCADE"), primary_key=True
+    )
+    method = Column(String, primary_key=True)
+    hash = Column(String, index=True, nullable=False)
@@ -0,0 +1,20 @@
+from datetime import datetime
+
+from sqlalchemy import JSON, Column, DateTime, String
+
+from app.db import Base
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, index=True, nullable=False)
+    payload = Column(JSON, nullable=False)
+    image_id = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
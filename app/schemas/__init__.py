@@ -1 +1,19 @@
 from .image import Image, ImageUrl, ImageUpload, ImageDiff, ImageCrop  # noqa: F401
+from .image import (  # noqa: F401
+    HashMethod,
+    ImageMatch,
+    ImageSimilar,
+    ImageUrlBatch,
+    ImageBatch,
+    ImageBatchItem,
+    ImageBatchStatus,
+    ImageDiffMatrix,
+    ImageDiffMatrixQuery,
+    ImageInDB,
+    ImageLookup,
+    ImageLookupResult,
+    ImagePage,
+    RenderFormat,
+    RenderMode,
+)
+from .job import Job, JobKind, JobStatus  # noqa: F401
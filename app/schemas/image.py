@@ -1,5 +1,6 @@
 import uuid
 from enum import Enum
+from typing import List
 
 from fastapi import UploadFile
 
@@ -11,6 +12,27 @@ class ImageType(str, Enum):
     upload = "upload"
 
 
+class HashMethod(str, Enum):
+    phash = "phash"
+    dhash = "dhash"
+    whash = "whash"
+    average_hash = "average_hash"
+    colorhash = "colorhash"
+    # Sequence of frame phashes, stills count as a single frame
+    frames = "frames"
+
+
+class RenderMode(str, Enum):
+    crop = "crop"
+    fit = "fit"
+
+
+class RenderFormat(str, Enum):
+    jpeg = "jpeg"
+    png = "png"
+    webp = "webp"
+
+
 # Shared properties
 class ImageBase(BaseModel):
     name: str = Field(..., title="The name of the item", max_length=100)
@@ -46,7 +68,8 @@ class Image(ImageInDBBase):
 
 # Properties properties stored in DB
 class ImageInDB(ImageInDBBase):
-    pass
+    hash_int: int
+    blob_digest: str | None = None
 
 
 # Image Diff
@@ -56,7 +79,68 @@ class ImageDiff(BaseModel):
     diff: float
 
 
+# Listing, `next_cursor` is None on the last page
+class ImagePage(BaseModel):
+    images: List[Image]
+    next_cursor: str | None = None
+
+
+# Bulk lookup and diff
+class ImageLookup(BaseModel):
+    ids: List[uuid.UUID] = Field(..., min_items=1, title="The images to look up")
+
+
+class ImageLookupResult(BaseModel):
+    images: List[Image]
+    missing: List[uuid.UUID]
+
+
+class ImageDiffMatrixQuery(BaseModel):
+    source_ids: List[uuid.UUID] = Field(..., min_items=1)
+    target_ids: List[uuid.UUID] = Field(..., min_items=1)
+    method: HashMethod = HashMethod.phash
+
+
+class ImageDiffMatrix(BaseModel):
+    source_ids: List[uuid.UUID]
+    target_ids: List[uuid.UUID]
+    # One row per source, one column per target
+    diffs: List[List[float]]
+
+
+# Image similarity
+class ImageMatch(BaseModel):
+    image_id: uuid.UUID
+    diff: float
+
+
+class ImageSimilar(BaseModel):
+    source_image_id: uuid.UUID
+    images: List[ImageMatch]
+
+
 # Image Crop
 class ImageCrop(BaseModel):
     width: int
     height: int
+
+
+# Batch ingestion
+class ImageUrlBatch(BaseModel):
+    images: List[ImageUrl] = Field(..., min_items=1, title="The images to create")
+
+
+class ImageBatchStatus(str, Enum):
+    created = "created"
+    failed = "failed"
+
+
+class ImageBatchItem(BaseModel):
+    index: int
+    status: ImageBatchStatus
+    image: Image | None = None
+    detail: str | None = None
+
+
+class ImageBatch(BaseModel):
+    items: List[ImageBatchItem]
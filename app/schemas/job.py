@@ -0,0 +1,32 @@
+import uuid
+from datetime import datetime
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class JobKind(str, Enum):
+    upload = "upload"
+    url = "url"
+    crop = "crop"
+
+
+class JobStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+# Properties to return to client
+class Job(BaseModel):
+    id: uuid.UUID
+    kind: JobKind
+    status: JobStatus
+    image_id: uuid.UUID | None
+    error: str | None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        orm_mode = True
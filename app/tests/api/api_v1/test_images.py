@@ -1,12 +1,27 @@
-from PIL import Image
+from PIL import Image, ImageSequence
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
+import asyncio
+import glob
+import hashlib
+import io
+import os
+import time
+import uuid
 import numpy as np
 
 import pytest
 
 from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
 
+from app import crud, models
+from app.core import storage
 from app.core.config import settings
+from app.core.storage import S3Storage
+from app.core.metadata_cache import metadata_cache
+from app.core.render_cache import render_cache
+from app.tests.conftest import FakeS3
 
 
 def test_create_image_correct_url(
@@ -32,9 +47,7 @@ def test_create_image_correct_binary(client: TestClient, test_image_path: str) -
     assert response.status_code == 200
 
 
-def test_create_image_url_unsupported_image_format(
-    client: TestClient, gif_url: str
-) -> None:
+def test_create_image_url_animated(client: TestClient, gif_url: str) -> None:
     response = client.post(
         f"{settings.API_V1_STR}/images",
         json={
@@ -44,14 +57,13 @@ def test_create_image_url_unsupported_image_format(
         },
     )
 
-    assert response.status_code == 400
-    assert response.json() == {"detail": "Image format not supported"}
+    assert response.status_code == 200
 
 
 def test_create_image_binary_unsupported_image_format(
     client: TestClient, test_image_path: str
 ) -> None:
-    with open(f"{test_image_path}/cerebellum.gif", "rb") as file:
+    with open(f"{test_image_path}/black_white.bmp", "rb") as file:
         response = client.post(
             f"{settings.API_V1_STR}/images/upload",
             data={
@@ -64,6 +76,81 @@ def test_create_image_binary_unsupported_image_format(
     assert response.json() == {"detail": "Image format not supported"}
 
 
+def test_create_image_local_url(
+    client: TestClient, image_server_url: str, test_image_path: str
+) -> None:
+    response_source = client.post(
+        f"{settings.API_V1_STR}/images",
+        json={
+            "name": "test",
+            "description": "test",
+            "url": f"{image_server_url}/wikipedia_logo.png",
+        },
+    )
+    assert response_source.status_code == 200
+
+    with open(f"{test_image_path}/wikipedia_logo.png", "rb") as file:
+        response_target = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={
+                "name": "test",
+                "description": "test",
+            },
+            files={"file": file},
+        )
+    assert response_target.status_code == 200
+    assert response_source.json()["hash"] == response_target.json()["hash"]
+
+
+def test_create_image_local_url_unsupported_image_format(
+    client: TestClient, image_server_url: str
+) -> None:
+    response = client.post(
+        f"{settings.API_V1_STR}/images",
+        json={
+            "name": "test",
+            "description": "test",
+            "url": f"{image_server_url}/black_white.bmp",
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Image format not supported"}
+
+
+def test_create_image_local_url_not_found(
+    client: TestClient, image_server_url: str
+) -> None:
+    response = client.post(
+        f"{settings.API_V1_STR}/images",
+        json={
+            "name": "test",
+            "description": "test",
+            "url": f"{image_server_url}/missing.png",
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Error while downloading image"}
+
+
+def test_create_image_local_url_too_large(
+    client: TestClient, image_server_url: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "MAX_IMAGE_SIZE", 1024)
+    response = client.post(
+        f"{settings.API_V1_STR}/images",
+        json={
+            "name": "test",
+            "description": "test",
+            "url": f"{image_server_url}/image0.jpeg",
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Image too large"}
+
+
 def test_create_image_incorrect_url(
     client: TestClient, valid_url_image: Callable[[], dict]
 ) -> None:
@@ -220,12 +307,12 @@ def test_center_crop(
         )
     assert response.status_code == 200
 
-    img = Image.open(f"{temp_image_path}/{response.json()['id']}")
+    img = Image.open(f"{temp_image_path}/{response.json()['path']}")
     data = np.asarray(img, dtype="int32")
     assert data.sum() != 0
 
     image_id = response.json()["id"]
-    pil_image = Image.open(f"{temp_image_path}/{image_id}")
+    pil_image = Image.open(f"{temp_image_path}/{response.json()['path']}")
     assert pil_image.size != (100, 100)
 
     # update image and check if it has the right size and is completely white
@@ -234,7 +321,8 @@ def test_center_crop(
     )
     assert response.status_code == 204
 
-    pil_image = Image.open(f"{temp_image_path}/{image_id}")
+    response = client.get(f"{settings.API_V1_STR}/images/{image_id}")
+    pil_image = Image.open(f"{temp_image_path}/{response.json()['path']}")
     assert pil_image.size == (100, 100)
 
     data = np.asarray(pil_image, dtype="int32")
@@ -269,3 +357,742 @@ def test_center_crop_invalid(
     assert response.json() == {
         "detail": "Error while cropping image Coordinate 'right' is less than 'left'"
     }
+
+
+def test_center_crop_animated(client: TestClient, test_image_path: str) -> None:
+    with open(f"{test_image_path}/cerebellum.gif", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": file},
+        )
+    assert response.status_code == 200
+
+    response = client.put(
+        f"{settings.API_V1_STR}/images/{response.json()['id']}?width=10&height=10"
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Image format not supported"}
+
+
+def test_create_images_batch(client: TestClient, image_server_url: str) -> None:
+    response = client.post(
+        f"{settings.API_V1_STR}/images/batch",
+        json={
+            "images": [
+                {"name": "first", "url": f"{image_server_url}/image0.jpeg"},
+                {"name": "bmp", "url": f"{image_server_url}/black_white.bmp"},
+                {"name": "second", "url": f"{image_server_url}/image1.jpeg"},
+            ]
+        },
+    )
+    assert response.status_code == 200
+
+    items = response.json()["items"]
+    assert [item["status"] for item in items] == ["created", "failed", "created"]
+    assert items[1]["detail"] == "Image format not supported"
+
+    for item in (items[0], items[2]):
+        response = client.get(f"{settings.API_V1_STR}/images/{item['image']['id']}")
+        assert response.status_code == 200
+        assert response.json() == item["image"]
+
+
+def test_upload_images_batch(client: TestClient, test_image_path: str) -> None:
+    with open(f"{test_image_path}/image0.jpeg", "rb") as jpeg, open(
+        f"{test_image_path}/black_white.bmp", "rb"
+    ) as bmp:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/batch/upload",
+            data={"names": ["jpeg", "bmp"]},
+            files=[("files", jpeg), ("files", bmp)],
+        )
+    assert response.status_code == 200
+
+    items = response.json()["items"]
+    assert [item["status"] for item in items] == ["created", "failed"]
+    assert items[0]["image"]["name"] == "jpeg"
+    assert items[1]["detail"] == "Image format not supported"
+
+
+def test_create_images_batch_too_many(
+    client: TestClient, image_server_url: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "BATCH_MAX_ITEMS", 1)
+    response = client.post(
+        f"{settings.API_V1_STR}/images/batch",
+        json={
+            "images": [
+                {"name": "first", "url": f"{image_server_url}/image0.jpeg"},
+                {"name": "second", "url": f"{image_server_url}/image1.jpeg"},
+            ]
+        },
+    )
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Too many images in batch (max 1)"}
+
+
+def _random_png() -> bytes:
+    data = np.random.randint(0, 255, (64, 64, 3), dtype="uint8")
+    buffer = io.BytesIO()
+    Image.fromarray(data).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _solid_png(color: tuple) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_similar_images(client: TestClient) -> None:
+    content = _random_png()
+    ids = []
+    for _ in range(2):
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": ("random.png", content, "image/png")},
+        )
+        assert response.status_code == 200
+        ids.append(response.json()["id"])
+
+    response = client.get(
+        f"{settings.API_V1_STR}/images/{ids[0]}/similar?max_distance=0&limit=100"
+    )
+    assert response.status_code == 200
+    assert response.json()["source_image_id"] == ids[0]
+    assert {"image_id": ids[1], "diff": 0.0} in response.json()["images"]
+    assert ids[0] not in [match["image_id"] for match in response.json()["images"]]
+
+
+def test_similar_images_not_found(client: TestClient) -> None:
+    response = client.get(
+        f"{settings.API_V1_STR}/images/00000000-0000-0000-0000-000000000000/similar",
+    )
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Image not found"}
+
+
+def _upload(client: TestClient, name: str, content: bytes) -> dict:
+    response = client.post(
+        f"{settings.API_V1_STR}/images/upload",
+        data={"name": "test", "description": "test"},
+        files={"file": (name, content, "image/png")},
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.mark.parametrize("method", ["phash", "dhash", "whash", "colorhash"])
+def test_diff_method(client: TestClient, method: str) -> None:
+    content = _random_png()
+    source = _upload(client, "source.png", content)
+    target = _upload(client, "target.png", content)
+    other = _upload(client, "other.png", _solid_png((255, 0, 0)))
+
+    response = client.get(
+        f"{settings.API_V1_STR}/images/{source['id']}/diff/{target['id']}"
+        f"?method={method}"
+    )
+    assert response.status_code == 200
+    assert response.json()["diff"] == 0.0
+
+    response = client.get(
+        f"{settings.API_V1_STR}/images/{source['id']}/diff/{other['id']}"
+        f"?method={method}"
+    )
+    assert response.status_code == 200
+    assert response.json()["diff"] > 0.0
+
+
+def test_diff_method_not_available(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "HASH_METHODS", ["phash"])
+    source = _upload(client, "source.png", _random_png())
+    target = _upload(client, "target.png", _random_png())
+
+    response = client.get(
+        f"{settings.API_V1_STR}/images/{source['id']}/diff/{target['id']}"
+        "?method=dhash"
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Hash method dhash not available"}
+
+
+def test_diff_frames(client: TestClient, test_image_path: str) -> None:
+    gif = Image.open(f"{test_image_path}/cerebellum.gif")
+    frames = [frame.convert("RGB") for frame in ImageSequence.Iterator(gif)]
+    webp, png = io.BytesIO(), io.BytesIO()
+    # Same animation at half the frame rate
+    frames[0].save(
+        webp, format="WEBP", save_all=True, append_images=frames[2::2], duration=200
+    )
+    frames[0].save(png, format="PNG")
+
+    with open(f"{test_image_path}/cerebellum.gif", "rb") as file:
+        source = _upload(client, "cerebellum.gif", file.read())
+    target = _upload(client, "cerebellum.webp", webp.getvalue())
+    still = _upload(client, "cerebellum.png", png.getvalue())
+
+    diffs = []
+    for other in (target, still):
+        response = client.get(
+            f"{settings.API_V1_STR}/images/{source['id']}/diff/{other['id']}"
+            "?method=frames"
+        )
+        assert response.status_code == 200
+        diffs.append(response.json()["diff"])
+    assert diffs[0] < 4 < diffs[1]
+
+    response = client.post(
+        f"{settings.API_V1_STR}/images/diff-matrix",
+        json={
+            "source_ids": [source["id"]],
+            "target_ids": [target["id"]],
+            "method": "frames",
+        },
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        "detail": "Hash method frames not available for diff matrices"
+    }
+
+
+def test_render_image(client: TestClient, test_image_path: str) -> None:
+    with open(f"{test_image_path}/wikipedia_logo.png", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": file},
+        )
+    assert response.status_code == 200
+    image = response.json()
+    source_size = Image.open(f"{test_image_path}/wikipedia_logo.png").size
+
+    url = f"{settings.API_V1_STR}/images/{image['id']}/render"
+    response = client.get(f"{url}?w=50&h=20&mode=crop")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert Image.open(io.BytesIO(response.content)).size == (50, 20)
+
+    hits = render_cache.hits
+    response = client.get(f"{url}?w=50&h=20&mode=crop")
+    assert response.status_code == 200
+    assert render_cache.hits == hits + 1
+
+    response = client.get(f"{url}?w=50&h=20&mode=fit&format=jpeg")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    rendition = Image.open(io.BytesIO(response.content))
+    assert rendition.format == "JPEG"
+    assert rendition.size[0] <= 50 and rendition.size[1] <= 20
+    assert 20 in rendition.size or 50 in rendition.size
+
+    # renditions never touch the original
+    response = client.get(f"{settings.API_V1_STR}/images/{image['id']}/content")
+    assert Image.open(io.BytesIO(response.content)).size == source_size
+
+
+def test_render_image_invalid(client: TestClient) -> None:
+    image = _upload(client, "random.png", _random_png())
+    url = f"{settings.API_V1_STR}/images/{image['id']}/render"
+
+    assert client.get(f"{url}?w=0&h=10").status_code == 422
+    assert client.get(f"{url}?w=10&h=10&mode=stretch").status_code == 422
+    assert client.get(f"{url}?w=10&h=10&format=bmp").status_code == 422
+
+
+def test_get_image_content(client: TestClient, test_image_path: str) -> None:
+    with open(f"{test_image_path}/image0.jpeg", "rb") as file:
+        content = file.read()
+    image = _upload(client, "image0.jpeg", content)
+    url = f"{settings.API_V1_STR}/images/{image['id']}/content"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["cache-control"].startswith("public, max-age=")
+    etag = response.headers["etag"]
+    assert etag == f'"{hashlib.sha256(content).hexdigest()}"'
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get(url, headers={"If-None-Match": f'"other", W/{etag}'})
+    assert response.status_code == 304
+
+    response = client.get(url, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.content == content[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(content)}"
+
+    response = client.get(url, headers={"Range": "bytes=-5"})
+    assert response.status_code == 206
+    assert response.content == content[-5:]
+
+    response = client.get(url, headers={"Range": f"bytes={len(content)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(content)}"
+
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.content == content
+
+
+def test_get_image_content_revalidated_without_storage(
+    client: TestClient, test_image_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    with open(f"{test_image_path}/image1.jpeg", "rb") as file:
+        image = _upload(client, "image1.jpeg", file.read())
+    url = f"{settings.API_V1_STR}/images/{image['id']}/content"
+    etag = client.get(url).headers["etag"]
+
+    async def no_storage(*args: object) -> None:
+        raise AssertionError("storage read for a revalidation")
+
+    monkeypatch.setattr(crud.image, "get_content", no_storage)
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.headers["cache-control"].startswith("public, max-age=")
+
+
+def test_get_image_content_changes_etag_on_crop(
+    client: TestClient, test_image_path: str
+) -> None:
+    with open(f"{test_image_path}/black_white.png", "rb") as file:
+        image = _upload(client, "black_white.png", file.read())
+    url = f"{settings.API_V1_STR}/images/{image['id']}/content"
+    etag = client.get(url).headers["etag"]
+
+    response = client.put(
+        f"{settings.API_V1_STR}/images/{image['id']}?width=100&height=100"
+    )
+    assert response.status_code == 204
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert Image.open(io.BytesIO(response.content)).size == (100, 100)
+
+
+def test_get_image_content_not_found(client: TestClient) -> None:
+    response = client.get(
+        f"{settings.API_V1_STR}/images/00000000-0000-0000-0000-000000000000/content",
+    )
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Image not found"}
+
+
+def test_create_image_binary_detects_format_from_content(
+    client: TestClient, test_image_path: str
+) -> None:
+    with open(f"{test_image_path}/image0.jpeg", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": ("image0.gif", file, "image/gif")},
+        )
+    assert response.status_code == 200
+
+    with open(f"{test_image_path}/black_white.bmp", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": ("black_white.png", file, "image/png")},
+        )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Image format not supported"}
+
+
+def test_create_image_binary_too_large(
+    client: TestClient,
+    test_image_path: str,
+    temp_image_path: str,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(settings, "MAX_IMAGE_SIZE", 100 * 1024)
+    monkeypatch.setattr(settings, "UPLOAD_CHUNK_SIZE", 16 * 1024)
+    files_before = set(os.listdir(temp_image_path))
+
+    with open(f"{test_image_path}/image0.jpeg", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": file},
+        )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Image too large"}
+    assert set(os.listdir(temp_image_path)) == files_before
+
+
+def test_upload_same_content_shares_blob(
+    client: TestClient, db: Session, temp_image_path: str
+) -> None:
+    content = _random_png()
+    digest = hashlib.sha256(content).hexdigest()
+
+    first = _upload(client, "first.png", content)
+    second = _upload(client, "second.png", content)
+
+    assert first["id"] != second["id"]
+    assert first["path"] == second["path"]
+    assert first["path"] == f"{digest[:2]}/{digest[2:4]}/{digest}"
+    blob = db.get(models.Blob, digest)
+    assert blob is not None
+    assert blob.refcount == 2
+    assert blob.hashes["phash"] == first["hash"]
+
+
+def test_known_blob_hashed_for_new_methods(
+    client: TestClient, db: Session, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    content = _random_png()
+    digest = hashlib.sha256(content).hexdigest()
+    methods = settings.HASH_METHODS
+    monkeypatch.setattr(settings, "HASH_METHODS", ["phash"])
+    _upload(client, "first.png", content)
+
+    monkeypatch.setattr(settings, "HASH_METHODS", methods)
+    second = _upload(client, "second.png", content)
+    other = _upload(client, "other.png", _random_png())
+
+    response = client.get(
+        f"{settings.API_V1_STR}/images/{second['id']}/diff/{other['id']}"
+        "?method=dhash"
+    )
+    assert response.status_code == 200
+    db.expire_all()
+    blob = db.get(models.Blob, digest)
+    assert blob is not None
+    assert {"phash", *methods} <= blob.hashes.keys()
+
+
+def test_upload_corrupt_image_leaves_no_blob(
+    client: TestClient, db: Session, temp_image_path: str
+) -> None:
+    content = _random_png()[:100]
+    digest = hashlib.sha256(content).hexdigest()
+
+    response = client.post(
+        f"{settings.API_V1_STR}/images/upload",
+        data={"name": "test", "description": "test"},
+        files={"file": ("corrupt.png", content, "image/png")},
+    )
+
+    assert response.status_code == 500
+    assert db.get(models.Blob, digest) is None
+    assert not os.path.exists(f"{temp_image_path}/{digest[:2]}/{digest[2:4]}/{digest}")
+
+
+def test_crop_shared_blob_keeps_other_image(
+    client: TestClient, db: Session, temp_image_path: str
+) -> None:
+    content = _random_png()
+    digest = hashlib.sha256(content).hexdigest()
+    first = _upload(client, "first.png", content)
+    second = _upload(client, "second.png", content)
+
+    response = client.put(
+        f"{settings.API_V1_STR}/images/{first['id']}?width=10&height=10"
+    )
+    assert response.status_code == 204
+
+    cropped = client.get(f"{settings.API_V1_STR}/images/{first['id']}").json()
+    assert cropped["path"] != second["path"]
+    assert Image.open(f"{temp_image_path}/{cropped['path']}").size == (10, 10)
+    with open(f"{temp_image_path}/{second['path']}", "rb") as file:
+        assert file.read() == content
+
+    db.expire_all()
+    blob = db.get(models.Blob, digest)
+    assert blob is not None
+    assert blob.refcount == 1
+
+
+def test_crop_during_ingest_of_same_bytes(
+    client: TestClient,
+    db: Session,
+    temp_image_path: str,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    content = _random_png()
+    digest = hashlib.sha256(content).hexdigest()
+    first = _upload(client, "first.png", content)
+    local = storage.get_storage()
+    exists = local.exists
+
+    async def slow_exists(key: str) -> bool:
+        found = await exists(key)
+        if key == first["path"]:
+            # The crop releasing the only other reference runs meanwhile
+            await asyncio.sleep(0.3)
+        return found
+
+    monkeypatch.setattr(local, "exists", slow_exists)
+    with ThreadPoolExecutor(2) as pool:
+        second = pool.submit(_upload, client, "second.png", content)
+        time.sleep(0.1)
+        response = pool.submit(
+            client.put, f"{settings.API_V1_STR}/images/{first['id']}?width=10&height=10"
+        ).result()
+        assert response.status_code == 204
+        image = second.result()
+
+    with open(f"{temp_image_path}/{image['path']}", "rb") as file:
+        assert file.read() == content
+    db.expire_all()
+    blob = db.get(models.Blob, digest)
+    assert blob is not None
+    assert blob.refcount == 1
+
+
+def test_s3_storage_backend(
+    client: TestClient,
+    s3_storage: S3Storage,
+    fake_s3: FakeS3,
+    temp_image_path: str,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(storage, "_storage", s3_storage)
+    content = _random_png()
+    image = _upload(client, "s3.png", content)
+
+    assert fake_s3.objects[f"/images/{image['path']}"] == content
+    assert not os.path.exists(f"{temp_image_path}/{image['path']}")
+    # Hashed from the temp file, not downloaded back
+    assert [request.method for request in fake_s3.requests] == ["HEAD", "PUT"]
+    assert not glob.glob(f"{temp_image_path}/*.tmp")
+
+    response = client.post(
+        f"{settings.API_V1_STR}/images/upload",
+        data={"name": "test", "description": "test"},
+        files={"file": ("corrupt.png", content[:100], "image/png")},
+    )
+    assert response.status_code == 500
+    assert len(fake_s3.requests) == 2
+
+    url = f"{settings.API_V1_STR}/images/{image['id']}/content"
+    response = client.get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.content == content[:10]
+    assert client.get(url).content == content
+
+    response = client.get(
+        f"{settings.API_V1_STR}/images/{image['id']}/render?w=16&h=16"
+    )
+    assert response.status_code == 200
+
+    response = client.put(
+        f"{settings.API_V1_STR}/images/{image['id']}?width=10&height=10"
+    )
+    assert response.status_code == 204
+    response = client.get(url)
+    assert Image.open(io.BytesIO(response.content)).size == (10, 10)
+    assert f"/images/{image['path']}" not in fake_s3.objects
+
+
+def test_get_image_served_from_metadata_cache(
+    client: TestClient, temp_image_path: str
+) -> None:
+    image = _upload(client, "cached.png", _random_png())
+    url = f"{settings.API_V1_STR}/images/{image['id']}"
+    hits = metadata_cache.hits
+
+    for _ in range(3):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.json() == image
+    assert metadata_cache.hits == hits + 3
+
+    response = client.put(f"{url}?width=10&height=10")
+    assert response.status_code == 204
+    response = client.get(url)
+    assert response.json()["path"] != image["path"]
+    assert Image.open(f"{temp_image_path}/{response.json()['path']}").size == (10, 10)
+
+
+def test_stale_metadata_cache_entry_reloaded(
+    client: TestClient, temp_image_path: str
+) -> None:
+    image = _upload(client, "cached.png", _random_png())
+    url = f"{settings.API_V1_STR}/images/{image['id']}"
+    stale = asyncio.run(metadata_cache.get(image["id"]))
+    assert stale is not None
+
+    response = client.put(f"{url}?width=10&height=10")
+    assert response.status_code == 204
+    assert not os.path.exists(f"{temp_image_path}/{image['path']}")
+    # Another process cached the row before the crop
+    asyncio.run(metadata_cache.set_many([stale]))
+
+    response = client.get(f"{url}/content")
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).size == (10, 10)
+    asyncio.run(metadata_cache.set_many([stale]))
+    response = client.get(f"{url}/render?w=5&h=5")
+    assert response.status_code == 200
+    assert client.get(url).json()["path"] != image["path"]
+
+
+def test_cached_render_takes_no_crop_slot(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    image = _upload(client, "render.png", _random_png())
+    url = f"{settings.API_V1_STR}/images/{image['id']}/render"
+    assert client.get(f"{url}?w=8&h=8").status_code == 200
+
+    monkeypatch.setattr(settings, "ADMISSION_CONCURRENCY", {"crop": 0})
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE", {"crop": 0})
+    assert client.get(f"{url}?w=8&h=8").status_code == 200
+    response = client.get(f"{url}?w=9&h=9")
+    assert response.status_code == 503
+    assert "retry-after" in response.headers
+
+
+def test_lookup_images(client: TestClient) -> None:
+    first = _upload(client, "first.png", _random_png())
+    second = _upload(client, "second.png", _random_png())
+    unknown = "00000000-0000-0000-0000-000000000000"
+
+    response = client.post(
+        f"{settings.API_V1_STR}/images/lookup",
+        json={"ids": [second["id"], unknown, first["id"]]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"images": [second, first], "missing": [unknown]}
+
+
+def test_lookup_images_too_many(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "LOOKUP_MAX_ITEMS", 1)
+    ids = ["00000000-0000-0000-0000-000000000000"] * 2
+
+    response = client.post(f"{settings.API_V1_STR}/images/lookup", json={"ids": ids})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Too many images in lookup (max 1)"}
+
+
+@pytest.mark.parametrize("method", ["phash", "dhash"])
+def test_diff_matrix(client: TestClient, method: str) -> None:
+    sources = [_upload(client, "source.png", _random_png()) for _ in range(2)]
+    targets = [_upload(client, "target.png", _random_png()) for _ in range(3)]
+
+    response = client.post(
+        f"{settings.API_V1_STR}/images/diff-matrix",
+        json={
+            "source_ids": [image["id"] for image in sources],
+            "target_ids": [image["id"] for image in targets],
+            "method": method,
+        },
+    )
+    assert response.status_code == 200
+    diffs = response.json()["diffs"]
+    assert len(diffs) == 2 and all(len(row) == 3 for row in diffs)
+    for source, row in zip(sources, diffs):
+        for target, diff in zip(targets, row):
+            response = client.get(
+                f"{settings.API_V1_STR}/images/{source['id']}/diff/{target['id']}"
+                f"?method={method}"
+            )
+            assert response.json()["diff"] == diff
+
+
+def test_diff_matrix_not_found(client: TestClient) -> None:
+    image = _upload(client, "source.png", _random_png())
+
+    response = client.post(
+        f"{settings.API_V1_STR}/images/diff-matrix",
+        json={
+            "source_ids": [image["id"]],
+            "target_ids": ["00000000-0000-0000-0000-000000000000"],
+        },
+    )
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Image not found"}
+
+
+def test_list_images_by_name_prefix(client: TestClient) -> None:
+    prefix = f"list-{uuid.uuid4()}-"
+    created = []
+    for i in range(5):
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": f"{prefix}{i}", "description": "test"},
+            files={"file": ("list.png", _random_png(), "image/png")},
+        )
+        assert response.status_code == 200
+        created.append(response.json())
+    url = f"{settings.API_V1_STR}/images"
+
+    pages, cursor = [], None
+    while True:
+        params = {"name_prefix": prefix, "limit": "2"}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get(url, params=params)
+        assert response.status_code == 200
+        pages.append(response.json()["images"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [image for page in pages for image in page] == created
+
+
+def test_list_images_by_hash(client: TestClient) -> None:
+    image = _upload(client, "hash.png", _random_png())
+    url = f"{settings.API_V1_STR}/images"
+
+    response = client.get(url, params={"hash": image["hash"].upper()})
+    assert response.status_code == 200
+    assert image in response.json()["images"]
+
+    response = client.get(url, params={"hash_prefix": image["hash"][:12]})
+    assert response.status_code == 200
+    assert image in response.json()["images"]
+    assert all(
+        found["hash"].startswith(image["hash"][:12])
+        for found in response.json()["images"]
+    )
+
+
+def test_list_images_invalid_cursor(client: TestClient) -> None:
+    response = client.get(f"{settings.API_V1_STR}/images", params={"cursor": "nope"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid cursor"}
+
+
+def test_concurrent_get_image_coalesced(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    image = _upload(client, "coalesced.png", _random_png())
+    url = f"{settings.API_V1_STR}/images/{image['id']}"
+    get_image = crud.image.get_image
+    calls = 0
+
+    async def slow_get_image(db: object, image_id: uuid.UUID) -> object:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.2)
+        return await get_image(db, image_id)  # type: ignore
+
+    monkeypatch.setattr(crud.image, "get_image", slow_get_image)
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda _: client.get(url), range(8)))
+
+    assert [response.json() for response in responses] == [image] * 8
+    assert calls < 8
+    assert 'single_flight_calls_total{group="get_image",result="coalesced"}' in (
+        client.get("/metrics").text
+    )
@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import io
+import os
+import time
+import uuid
+
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import numpy as np
+import pytest
+
+from PIL import Image
+
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from app import crud, models
+from app.core.config import settings
+from app.worker import worker
+
+
+def _wait_for_job(client: TestClient, job_id: str) -> dict:
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        response = client.get(f"{settings.API_V1_STR}/jobs/{job_id}")
+        assert response.status_code == 200
+        if response.json()["status"] in ("succeeded", "failed"):
+            return response.json()
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def test_upload_image_async(client: TestClient, test_image_path: str) -> None:
+    with open(f"{test_image_path}/image0.jpeg", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload?async=true",
+            data={"name": "test", "description": "test"},
+            files={"file": file},
+        )
+    assert response.status_code == 202
+    assert response.json()["kind"] == "upload"
+    assert response.json()["status"] in ("pending", "running")
+
+    job = _wait_for_job(client, response.json()["id"])
+    assert job["status"] == "succeeded"
+    assert job["error"] is None
+
+    response = client.get(f"{settings.API_V1_STR}/images/{job['image_id']}")
+    assert response.status_code == 200
+    assert response.json()["name"] == "test"
+
+
+def test_create_image_async_failed(client: TestClient, image_server_url: str) -> None:
+    response = client.post(
+        f"{settings.API_V1_STR}/images?async=true",
+        json={"name": "test", "url": f"{image_server_url}/black_white.bmp"},
+    )
+    assert response.status_code == 202
+    assert response.json()["kind"] == "url"
+
+    job = _wait_for_job(client, response.json()["id"])
+    assert job["status"] == "failed"
+    assert job["error"] == "Image format not supported"
+
+
+def test_crop_image_async(
+    client: TestClient, test_image_path: str, temp_image_path: str
+) -> None:
+    with open(f"{test_image_path}/black_white.png", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": file},
+        )
+    assert response.status_code == 200
+    image = response.json()
+
+    response = client.put(
+        f"{settings.API_V1_STR}/images/{image['id']}?width=100&height=100&async=true"
+    )
+    assert response.status_code == 202
+
+    job = _wait_for_job(client, response.json()["id"])
+    assert job["status"] == "succeeded"
+    assert job["image_id"] == image["id"]
+
+    response = client.get(f"{settings.API_V1_STR}/images/{image['id']}")
+    assert Image.open(f"{temp_image_path}/{response.json()['path']}").size == (100, 100)
+
+
+def test_get_job_not_found(client: TestClient) -> None:
+    response = client.get(
+        f"{settings.API_V1_STR}/jobs/00000000-0000-0000-0000-000000000000"
+    )
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Job not found"}
+
+
+def test_upload_async_keeps_shared_blob(
+    client: TestClient, temp_image_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    buffer = io.BytesIO()
+    data = np.random.randint(0, 255, (64, 64, 3), dtype="uint8")
+    Image.fromarray(data).save(buffer, format="PNG")
+    content = buffer.getvalue()
+    response = client.post(
+        f"{settings.API_V1_STR}/images/upload",
+        data={"name": "test", "description": "test"},
+        files={"file": ("image.png", content, "image/png")},
+    )
+    assert response.status_code == 200
+    image = response.json()
+
+    # Hold the job back until the only image using the bytes is cropped
+    async def no_job(db: object) -> Optional[models.Job]:
+        return None
+
+    with monkeypatch.context() as patch:
+        patch.setattr(crud.job, "claim_job", no_job)
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload?async=true",
+            data={"name": "test", "description": "test"},
+            files={"file": ("image.png", content, "image/png")},
+        )
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+        response = client.put(
+            f"{settings.API_V1_STR}/images/{image['id']}?width=10&height=10"
+        )
+        assert response.status_code == 204
+
+    job = _wait_for_job(client, job_id)
+    assert job["status"] == "succeeded"
+    response = client.get(f"{settings.API_V1_STR}/images/{job['image_id']}")
+    with open(f"{temp_image_path}/{response.json()['path']}", "rb") as file:
+        assert file.read() == content
+
+
+def test_upload_async_enqueue_failure_unpins_blob(
+    client: TestClient,
+    db: Session,
+    temp_image_path: str,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.randint(0, 255, (32, 32, 3), dtype="uint8")).save(
+        buffer, format="PNG"
+    )
+    content = buffer.getvalue()
+    digest = hashlib.sha256(content).hexdigest()
+
+    async def failing_create_job(*args: Any, **kwargs: Any) -> models.Job:
+        raise RuntimeError("jobs table unavailable")
+
+    monkeypatch.setattr(crud.job, "create_job", failing_create_job)
+    with pytest.raises(RuntimeError):
+        client.post(
+            f"{settings.API_V1_STR}/images/upload?async=true",
+            data={"name": "test", "description": "test"},
+            files={"file": ("image.png", content, "image/png")},
+        )
+
+    assert db.get(models.Blob, digest) is None
+    assert not os.path.exists(f"{temp_image_path}/{digest[:2]}/{digest[2:4]}/{digest}")
+
+
+def test_stale_job_requeued(
+    client: TestClient,
+    db: Session,
+    image_server_url: str,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(settings, "JOB_HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(settings, "JOB_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(worker, "_next_requeue", 0.0)
+    # Left running by a worker that died
+    job = models.Job(
+        id=str(uuid.uuid4()),
+        kind="url",
+        status="running",
+        payload={"name": "test", "url": f"{image_server_url}/black_white.bmp"},
+        updated_at=datetime.utcnow() - timedelta(hours=1),
+    )
+    db.add(job)
+    db.commit()
+
+    job_json = _wait_for_job(client, str(job.id))
+    assert job_json["status"] == "failed"
+    assert job_json["error"] == "Image format not supported"
+
+
+def test_running_job_keeps_lease(
+    client: TestClient, image_server_url: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "JOB_LEASE_TIMEOUT", 0.3)
+    monkeypatch.setattr(settings, "JOB_HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(settings, "JOB_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(worker, "_next_requeue", 0.0)
+    calls = 0
+    create_image = crud.image.create_image
+
+    async def slow_create_image(*args: Any, **kwargs: Any) -> models.Image:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(1)
+        return await create_image(*args, **kwargs)
+
+    monkeypatch.setattr(crud.image, "create_image", slow_create_image)
+    response = client.post(
+        f"{settings.API_V1_STR}/images?async=true",
+        json={"name": "test", "url": f"{image_server_url}/black_white.bmp"},
+    )
+    assert response.status_code == 202
+
+    job = _wait_for_job(client, response.json()["id"])
+    assert job["status"] == "failed"
+    # Not handed to another worker while it was processed
+    assert calls == 1
@@ -0,0 +1,73 @@
+import uuid
+
+import pytest
+
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+
+
+def test_overloaded_class_rejected(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "ADMISSION_CONCURRENCY", {"read": 0})
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE", {"read": 0})
+    monkeypatch.setattr(settings, "ADMISSION_RETRY_AFTER", 2.5)
+
+    response = client.get(f"{settings.API_V1_STR}/images/{uuid.uuid4()}")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "3"
+    assert response.json() == {"detail": "Too many requests in progress"}
+
+    # Other classes and unlimited endpoints are unaffected
+    response = client.put(f"{settings.API_V1_STR}/images/{uuid.uuid4()}")
+    assert response.status_code == 404
+    assert client.get("/metrics").status_code == 200
+
+
+def test_rate_limited_per_client(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "RATE_LIMITS", {"read": 0.5})
+    monkeypatch.setattr(settings, "RATE_LIMIT_BURST", {"read": 2})
+    monkeypatch.setattr(settings, "RATE_LIMIT_CLIENT_HEADER", "X-Forwarded-For")
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+    url = f"{settings.API_V1_STR}/images/{uuid.uuid4()}"
+
+    for _ in range(2):
+        response = client.get(url, headers={"x-forwarded-for": first})
+        assert response.status_code == 404
+    # Addresses the client made up are not trusted
+    response = client.get(url, headers={"x-forwarded-for": f"{uuid.uuid4()}, {first}"})
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["retry-after"]) <= 2
+    assert response.json() == {"detail": "Rate limit exceeded"}
+
+    response = client.get(url, headers={"x-forwarded-for": second})
+    assert response.status_code == 404
+
+    body = client.get("/metrics").text
+    assert (
+        'admission_rejections_total{endpoint_class="read",reason="rate_limited"}'
+        in body
+    )
+    assert 'admission_queue_depth{endpoint_class="ingest"} 0' in body
+    assert 'admission_in_flight{endpoint_class="read"}' in body
+
+
+def test_rate_limit_trusted_hops(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "RATE_LIMITS", {"read": 0.5})
+    monkeypatch.setattr(settings, "RATE_LIMIT_BURST", {"read": 1})
+    monkeypatch.setattr(settings, "RATE_LIMIT_CLIENT_HEADER", "X-Forwarded-For")
+    monkeypatch.setattr(settings, "RATE_LIMIT_TRUSTED_HOPS", 2)
+    address = str(uuid.uuid4())
+    url = f"{settings.API_V1_STR}/images/{uuid.uuid4()}"
+
+    response = client.get(url, headers={"x-forwarded-for": f"{address}, 10.0.0.1"})
+    assert response.status_code == 404
+    response = client.get(
+        url, headers={"x-forwarded-for": f"{uuid.uuid4()}, {address}, 10.0.0.2"}
+    )
+    assert response.status_code == 429
@@ -0,0 +1,30 @@
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+
+
+def test_metrics(client: TestClient, test_image_path: str) -> None:
+    with open(f"{test_image_path}/image0.jpeg", "rb") as file:
+        response = client.post(
+            f"{settings.API_V1_STR}/images/upload",
+            data={"name": "test", "description": "test"},
+            files={"file": file},
+        )
+    assert response.status_code == 200
+    client.get(f"{settings.API_V1_STR}/images/{response.json()['id']}")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+    body = response.text
+    for stage in ("write", "decode", "hash", "db_commit"):
+        assert f'image_stage_duration_seconds_count{{stage="{stage}"}}' in body
+    assert 'image_stage_bytes_total{stage="write"}' in body
+    assert (
+        'http_request_duration_seconds_count{method="GET",'
+        'route="/api/v1/images/{image_id}",status="200"}'
+    ) in body
+    assert 'executor_queue_depth{pool="io"}' in body
+    assert "metadata_cache_hit_ratio " in body
+    assert "render_cache_hits_total " in body
@@ -0,0 +1,51 @@
+import os
+from pathlib import Path
+from typing import List
+
+import anyio
+import pytest
+
+from app.api.responses import RangeFileResponse, parse_range
+
+
+def test_parse_range() -> None:
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("items=0-1", 100) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
+    with pytest.raises(ValueError):
+        parse_range("bytes=9-1", 100)
+
+
+def test_range_file_response_zero_copy(tmp_path: Path) -> None:
+    path = tmp_path / "file"
+    path.write_bytes(bytes(range(256)))
+    messages: List[dict] = []
+
+    async def send(message: dict) -> None:
+        if message["type"] == "http.response.zerocopysend":
+            # What the server would do with sendfile
+            message = {
+                **message,
+                "body": os.pread(
+                    message["file"].fileno(), message["count"], message["offset"]
+                ),
+            }
+        messages.append(message)
+
+    async def receive() -> dict:
+        return {}
+
+    response = RangeFileResponse(
+        str(path), os.stat(path), "application/octet-stream", "bytes=16-31"
+    )
+    scope = {"type": "http", "extensions": {"http.response.zerocopysend": {}}}
+    anyio.run(response, scope, receive, send)
+
+    assert messages[0]["status"] == 206
+    assert messages[1]["type"] == "http.response.zerocopysend"
+    assert messages[1]["body"] == bytes(range(16, 32))
@@ -0,0 +1,32 @@
+from app.benchmarks import corpus, report
+
+
+def _run(p95_ms: float, per_second: float) -> dict:
+    return {"results": {"bench": {"p95_ms": p95_ms, "per_second": per_second}}}
+
+
+def test_summarize() -> None:
+    result = report.summarize([i / 1000 for i in range(1, 101)], elapsed=2.0)
+    assert result["count"] == 100
+    assert round(result["p50_ms"], 1) == 50.5
+    assert round(result["p99_ms"], 2) == 99.01
+    assert result["per_second"] == 50
+
+
+def test_compare_thresholds() -> None:
+    baseline = _run(100, 50)
+    assert report.compare(baseline, _run(110, 45)) == []
+    assert report.compare(baseline, _run(130, 50)) == ["bench: p95_ms 100.00 -> 130.00"]
+    assert report.compare(baseline, _run(100, 30)) == [
+        "bench: per_second 50.00 -> 30.00"
+    ]
+    assert report.compare(baseline, _run(130, 30), thresholds={"bench": 0.5}) == []
+    assert report.compare(baseline, {"results": {}}) == []
+
+
+def test_corpus_is_reproducible() -> None:
+    first = corpus.generate(2, ["jpeg", "png"], [(64, 48)], seed=1)
+    second = corpus.generate(2, ["jpeg", "png"], [(64, 48)], seed=1)
+    assert [image.content for image in first] == [image.content for image in second]
+    assert [image.group for image in first] == ["jpeg-64x48"] * 2 + ["png-64x48"] * 2
+    assert len({image.content for image in first}) == 4
@@ -1,15 +1,25 @@
-from typing import Generator, Callable
+from typing import Dict, Generator, Callable, List
 
+import functools
 import os
 import pytest
 import random
+import re
 import string
+import threading
+import uuid
+
+import httpx
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 from fastapi.testclient import TestClient
 
+from app.api.responses import parse_range
 from app.db.session import SessionLocal
 from app.main import app
 from app.core.config import settings
+from app.core.storage import S3Storage
 
 
 @pytest.fixture(name="temp_image_path", scope="module")
@@ -18,11 +28,129 @@ def fixture_temp_image_path(tmp_path_factory: Generator) -> str:
     return settings.IMAGE_UPLOAD_DIR
 
 
+@pytest.fixture(name="temp_render_path", scope="module")
+def fixture_temp_render_path(tmp_path_factory: Generator) -> str:
+    settings.RENDER_CACHE_DIR = tmp_path_factory.mktemp("renders")  # type: ignore
+    return settings.RENDER_CACHE_DIR
+
+
+@pytest.fixture(name="temp_hash_index_path", scope="module")
+def fixture_temp_hash_index_path(tmp_path_factory: Generator) -> str:
+    path = tmp_path_factory.mktemp("hash_index") / "hash_index.bin"  # type: ignore
+    settings.HASH_INDEX_PATH = str(path)
+    return settings.HASH_INDEX_PATH
+
+
 @pytest.fixture(name="test_image_path", scope="module")
 def fixture_test_image_path() -> str:
     return os.path.dirname(__file__) + "/images"
 
 
+@pytest.fixture(name="image_server_url", scope="session")
+def fixture_image_server_url() -> Generator:
+    """Local stand-in for remote image hosts, serves the test images."""
+    handler = functools.partial(
+        SimpleHTTPRequestHandler, directory=os.path.dirname(__file__) + "/images"
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+class FakeS3:
+    """In-process stand-in for an S3-compatible server.
+
+    Understands the path-style object and multipart requests `S3Storage`
+    sends, objects live in a dict. Unsigned requests are rejected.
+    """
+
+    def __init__(self) -> None:
+        self.objects: Dict[str, bytes] = {}
+        self.uploads: Dict[str, Dict[int, bytes]] = {}
+        self.requests: List[httpx.Request] = []
+        self.fail_part: int | None = None
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if not request.headers.get("authorization", "").startswith("AWS4-HMAC-SHA256"):
+            return httpx.Response(403)
+
+        key, params, method = request.url.path, request.url.params, request.method
+        if method == "POST" and "uploads" in params:
+            upload_id = str(uuid.uuid4())
+            self.uploads[upload_id] = {}
+            return httpx.Response(
+                200,
+                content=(
+                    '<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/'
+                    f'doc/2006-03-01/"><UploadId>{upload_id}</UploadId>'
+                    "</InitiateMultipartUploadResult>"
+                ),
+            )
+        if "uploadId" in params:
+            return self._multipart(request, key, params["uploadId"])
+
+        if method == "PUT":
+            self.objects[key] = request.content
+            return httpx.Response(200)
+        if key not in self.objects:
+            return httpx.Response(404)
+        if method == "DELETE":
+            del self.objects[key]
+            return httpx.Response(204)
+
+        content = self.objects[key]
+        headers = {"content-length": str(len(content))}
+        if method == "HEAD":
+            return httpx.Response(200, headers=headers)
+        byte_range = parse_range(request.headers.get("range", ""), len(content))
+        if byte_range is None:
+            return httpx.Response(200, content=content)
+        start, end = byte_range
+        return httpx.Response(206, content=content[start : end + 1])
+
+    def _multipart(
+        self, request: httpx.Request, key: str, upload_id: str
+    ) -> httpx.Response:
+        if upload_id not in self.uploads:
+            return httpx.Response(404)
+        if request.method == "DELETE":
+            del self.uploads[upload_id]
+            return httpx.Response(204)
+        if request.method == "PUT":
+            number = int(request.url.params["partNumber"])
+            if number == self.fail_part:
+                return httpx.Response(500)
+            self.uploads[upload_id][number] = request.content
+            return httpx.Response(200, headers={"etag": f'"{number}"'})
+
+        parts = self.uploads.pop(upload_id)
+        numbers = re.findall(
+            r"<PartNumber>(\d+)</PartNumber>", request.content.decode()
+        )
+        self.objects[key] = b"".join(parts[int(number)] for number in numbers)
+        return httpx.Response(200)
+
+
+@pytest.fixture(name="fake_s3")
+def fixture_fake_s3() -> FakeS3:
+    return FakeS3()
+
+
+@pytest.fixture(name="s3_storage")
+def fixture_s3_storage(fake_s3: FakeS3) -> S3Storage:
+    return S3Storage(
+        "http://s3.test",
+        "images",
+        access_key_id="test",
+        secret_access_key="test",
+        transport=httpx.MockTransport(fake_s3),
+    )
+
+
 @pytest.fixture(scope="session")
 def google_logo_url() -> str:
     return "https://www.google.com/images/branding/googlelogo/2x/googlelogo_color_272x92dp.png"
@@ -44,7 +172,11 @@ def db() -> Generator:
 
 
 @pytest.fixture(scope="module")
-def client(temp_image_path: Generator) -> Generator:
+def client(
+    temp_image_path: Generator,
+    temp_render_path: Generator,
+    temp_hash_index_path: Generator,
+) -> Generator:
     with TestClient(app) as c:
         yield c
 
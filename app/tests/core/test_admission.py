@@ -0,0 +1,113 @@
+import asyncio
+
+from typing import List
+
+import anyio
+import pytest
+
+from app.core import admission
+from app.core.admission import Limiter, Overloaded, RateLimited, RateLimiter
+from app.core.config import settings
+
+
+@pytest.fixture(name="limiter")
+def fixture_limiter(monkeypatch: pytest.MonkeyPatch) -> Limiter:
+    monkeypatch.setattr(settings, "ADMISSION_CONCURRENCY", {"read": 2})
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE", {"read": 2})
+    return Limiter("read")
+
+
+def test_limiter_queues_then_rejects(limiter: Limiter) -> None:
+    order: List[int] = []
+    peak = 0
+
+    async def request(index: int) -> None:
+        nonlocal peak
+        async with limiter.slot():
+            order.append(index)
+            peak = max(peak, limiter.running)
+            await asyncio.sleep(0.01)
+
+    async def run() -> List[BaseException | None]:
+        return await asyncio.gather(
+            *(request(index) for index in range(5)), return_exceptions=True
+        )
+
+    results = anyio.run(run)
+
+    assert [type(result) for result in results] == [type(None)] * 4 + [Overloaded]
+    # Admitted in arrival order, never more than two at once
+    assert order == [0, 1, 2, 3]
+    assert peak == 2
+    assert (limiter.running, limiter.queued) == (0, 0)
+
+
+def test_limiter_wait_timeout(
+    limiter: Limiter, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE_TIMEOUT", 0.01)
+    rejected = admission.REJECTIONS.value(endpoint_class="read", reason="timeout")
+
+    async def run() -> None:
+        await limiter.acquire()
+        await limiter.acquire()
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        limiter.release()
+        limiter.release()
+
+    anyio.run(run)
+
+    assert (limiter.running, limiter.queued) == (0, 0)
+    assert (
+        admission.REJECTIONS.value(endpoint_class="read", reason="timeout")
+        == rejected + 1
+    )
+
+
+def test_limiter_cancelled_waiter(limiter: Limiter) -> None:
+    async def run() -> None:
+        await limiter.acquire()
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.queued == 1
+        waiter.cancel()
+        await asyncio.sleep(0)
+        # The slot goes to nobody, it is freed
+        limiter.release()
+        limiter.release()
+
+    anyio.run(run)
+
+    assert (limiter.running, limiter.queued) == (0, 0)
+
+
+def test_rate_limiter(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "RATE_LIMITS", {"ingest": 10})
+    monkeypatch.setattr(settings, "RATE_LIMIT_BURST", {"ingest": 3})
+    monkeypatch.setattr(settings, "RATE_LIMIT_MAX_CLIENTS", 2)
+    now = [0.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    limiter = RateLimiter("ingest")
+
+    for _ in range(3):
+        limiter.check("a")
+    try:
+        limiter.check("a")
+    except RateLimited as exc:
+        assert exc.retry_after == pytest.approx(0.1)
+    else:
+        pytest.fail("Fourth request within the burst was admitted")
+    limiter.check("b")
+
+    now[0] = 0.1
+    limiter.check("a")
+    with pytest.raises(RateLimited):
+        limiter.check("a")
+
+    # Only the two most recently seen clients are remembered
+    limiter.check("c")
+    assert list(limiter._buckets) == ["a", "c"]
+
+    RateLimiter("read").check("a")
@@ -0,0 +1,14 @@
+import pytest
+
+from pydantic import ValidationError
+
+from app.core.config import Settings
+
+
+def test_hash_methods_validated() -> None:
+    assert Settings(HASH_METHODS=["dhash", "average_hash"]).HASH_METHODS == [
+        "dhash",
+        "average_hash",
+    ]
+    with pytest.raises(ValidationError, match="unknown hash methods \\['ahash'\\]"):
+        Settings(HASH_METHODS=["phash", "ahash"])
@@ -0,0 +1,46 @@
+import random
+
+import numpy as np
+import pytest
+
+from app.core.distance import (
+    hamming,
+    hamming_many,
+    hamming_matrix,
+    hex_sequence,
+    hex_to_int64,
+    int64_to_hex,
+    sequence_distance,
+)
+
+
+def test_hex_to_int64_roundtrip() -> None:
+    for value in ("0000000000000000", "7fffffffffffffff", "8000000000000000"):
+        assert int64_to_hex(hex_to_int64(value)) == value
+    assert hex_to_int64("ffffffffffffffff") == -1
+
+
+def test_hamming_vectorized_matches_scalar() -> None:
+    hashes = [hex_to_int64(f"{random.getrandbits(64):016x}") for _ in range(50)]
+
+    many = hamming_many(hashes[0], hashes)
+    matrix = hamming_matrix(hashes[:5], hashes)
+
+    assert many.tolist() == [hamming(hashes[0], other) for other in hashes]
+    assert matrix.shape == (5, 50)
+    assert np.array_equal(matrix[0], many)
+    assert matrix[3, 7] == hamming(hashes[3], hashes[7])
+
+
+def test_sequence_distance() -> None:
+    sequence = [random.getrandbits(64) for _ in range(5)]
+    # Frames shown twice as long line up with the originals
+    resampled = [value for value in sequence for _ in range(2)]
+
+    assert sequence_distance(sequence, sequence) == 0
+    assert sequence_distance(sequence, resampled) == 0
+    assert sequence_distance([0, 0], [0b111] * 3) == 3
+    assert sequence_distance([0], [0b111, 0, 0b111]) == 9 / 4
+    assert hex_sequence("".join(f"{value:016x}" for value in sequence)) == sequence
+    with pytest.raises(ValueError):
+        sequence_distance([], sequence)
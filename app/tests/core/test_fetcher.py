@@ -0,0 +1,48 @@
+import hashlib
+
+from pathlib import Path
+from typing import Callable
+
+import anyio
+import httpx
+import pytest
+
+from app.core.fetcher import FetchError, ImageFetcher
+
+
+def make_fetcher(handler: Callable[[httpx.Request], httpx.Response]) -> ImageFetcher:
+    fetcher = ImageFetcher()
+    fetcher._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return fetcher
+
+
+def test_fetch_forgets_idle_hosts(tmp_path: Path) -> None:
+    fetcher = make_fetcher(
+        lambda request: httpx.Response(
+            200, headers={"content-type": "image/png"}, content=b"png"
+        )
+    )
+
+    for host in ("a.example", "b.example"):
+        path = str(tmp_path / host)
+        size, digest = anyio.run(fetcher.fetch, f"http://{host}/", path, {"image/png"})
+        assert (size, digest) == (3, hashlib.sha256(b"png").hexdigest())
+        assert Path(path).read_bytes() == b"png"
+    assert fetcher._host_slots == {}
+
+
+def test_malformed_content_length(tmp_path: Path) -> None:
+    fetcher = make_fetcher(
+        lambda request: httpx.Response(
+            200,
+            headers={"content-type": "image/png", "content-length": "lots"},
+            content=b"png",
+        )
+    )
+
+    with pytest.raises(FetchError):
+        anyio.run(
+            fetcher.fetch, "http://a.example/", str(tmp_path / "image"), {"image/png"}
+        )
+    assert not (tmp_path / "image.tmp").exists()
+    assert fetcher._host_slots == {}
@@ -0,0 +1,151 @@
+import random
+import uuid
+
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from app.core.config import settings
+from app.core.distance import hamming
+from app.core.hash_index import HashIndex
+
+
+def make_items(count: int) -> List[Tuple[str, int]]:
+    # Hash i is i set bits, so its distance to 0 is i
+    return [(str(uuid.uuid4()), (1 << i) - 1) for i in range(count)]
+
+
+@pytest.fixture(name="path")
+def fixture_path(tmp_path: Path) -> str:
+    return str(tmp_path / "index.bin")
+
+
+def test_search_closest_first(path: str) -> None:
+    items = make_items(10)
+    index = HashIndex(path)
+    index.build(reversed(items))
+
+    assert len(index) == 10
+    assert index.search(0, 3, 10) == [
+        (image_id, i) for i, (image_id, _) in enumerate(items[:4])
+    ]
+    assert index.search(0, 64, 2) == [(items[0][0], 0), (items[1][0], 1)]
+    assert index.search(-1, 5, 10) == []
+
+
+def test_missing_file(path: str) -> None:
+    index = HashIndex(path)
+
+    assert len(index) == 0
+    assert index.load() is None
+    assert index.search(0, 64, 10) == []
+
+
+def test_invalid_file(path: str) -> None:
+    Path(path).write_bytes(b"not an index")
+
+    assert HashIndex(path).load() is None
+
+
+def test_add_replaces_hash(path: str) -> None:
+    items = make_items(3)
+    index = HashIndex(path)
+    index.build(items)
+    index.add(items[0][0], 0b111)
+    index.add(items[0][0], 0b1111)
+
+    assert len(index) == 3
+    assert index.search(0, 3, 10) == [(items[1][0], 1), (items[2][0], 2)]
+    assert index.search(0, 4, 10)[-1] == (items[0][0], 4)
+
+
+def test_add_without_snapshot(path: str) -> None:
+    items = make_items(2)
+    index = HashIndex(path)
+    index.add_many(items)
+
+    assert index.search(0, 1, 10) == [(items[0][0], 0), (items[1][0], 1)]
+
+
+def test_processes_share_the_file(path: str) -> None:
+    items = make_items(4)
+    writer, reader = HashIndex(path), HashIndex(path)
+    writer.build(items[:2])
+    assert reader.load() == 2
+
+    writer.add_many(items[2:])
+    assert len(reader) == 4
+    writer.build(items[3:])
+    assert reader.search(0, 64, 10) == [(items[3][0], 3)]
+
+
+def test_load_folds_journal(path: str) -> None:
+    items = make_items(4)
+    index = HashIndex(path)
+    index.build(items[:2])
+    index.add_many(items[2:])
+    index.add(items[0][0], 0b11111)
+    inode = Path(path).stat().st_ino
+
+    assert HashIndex(path).load() == 4
+    assert Path(path).stat().st_ino != inode
+    assert index.search(0, 64, 1) == [(items[1][0], 1)]
+
+
+def test_journal_compacted(path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "HASH_INDEX_JOURNAL_MAX", 2)
+    items = make_items(4)
+    index = HashIndex(path)
+    index.build(items[:1])
+    index.add(items[1][0], 1)
+    index.add(items[2][0], 3)
+    inode = Path(path).stat().st_ino
+    index.add(items[3][0], 7)
+
+    # Folded into the sorted section, a new file
+    assert Path(path).stat().st_ino != inode
+    assert index.load() == 4
+    assert [distance for _, distance in index.search(0, 64, 10)] == [0, 1, 2, 3]
+
+
+def test_partial_record_truncated(path: str) -> None:
+    items = make_items(3)
+    index = HashIndex(path)
+    index.build(items[:1])
+    index.add(*items[1])
+    # A writer died halfway through a record
+    with open(path, "ab") as handler:
+        handler.write(b"\xff" * 10)
+    index.add(*items[2])
+
+    assert index.search(0, 64, 10) == [
+        (image_id, i) for i, (image_id, _) in enumerate(items)
+    ]
+    assert index.load() == 3
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 4, 9, 16, 23, 30])
+def test_search_matches_scan(path: str, max_distance: int) -> None:
+    generator = random.Random(max_distance)
+    query = generator.getrandbits(64) - (1 << 63)
+    # Hashes at every distance from the query, and random ones
+    hashes = [query ^ generator.getrandbits(64) for _ in range(500)]
+    for distance in range(40):
+        bits = generator.sample(range(64), distance)
+        hashes.append(query ^ sum(1 << bit for bit in bits))
+    items = [
+        (str(uuid.uuid4()), value - (1 << 64) if value >= 1 << 63 else value)
+        for value in (value & ((1 << 64) - 1) for value in hashes)
+    ]
+    index = HashIndex(path)
+    index.build(items)
+
+    expected = sorted(
+        (distance, image_id)
+        for image_id, value in items
+        if (distance := hamming(query, value)) <= max_distance
+    )
+    assert index.search(query, max_distance, len(items)) == [
+        (image_id, distance) for distance, image_id in expected
+    ]
@@ -0,0 +1,181 @@
+import os
+
+from pathlib import Path
+
+import imagehash
+import numpy as np
+import pytest
+
+from PIL import Image, ImageSequence, JpegImagePlugin
+
+from app.benchmarks.corpus import synthetic_image
+from app.core import imaging
+from app.core.distance import hamming, hamming_hex, hex_sequence, sequence_distance
+
+
+IMAGES_DIR = os.path.dirname(os.path.dirname(__file__)) + "/images"
+
+
+# Most bits a hash of the reduced image may differ from the full image one
+HASH_TOLERANCE = 2
+
+
+def _full_hashes(path: str) -> dict:
+    img = Image.open(path)
+    return {
+        "phash": imagehash.phash(img),
+        "dhash": imagehash.dhash(img),
+        "whash": imagehash.whash(img),
+        "average_hash": imagehash.average_hash(img),
+        "colorhash": imagehash.colorhash(img),
+    }
+
+
+@pytest.mark.parametrize("name", ["wikipedia_logo.png", "black_white.png"])
+def test_hash_file_matches_imagehash(name: str) -> None:
+    # Too small to be reduced, hashed as is
+    hashes = imaging.hash_file(f"{IMAGES_DIR}/{name}", ["dhash", "whash", "colorhash"])
+
+    img = Image.open(f"{IMAGES_DIR}/{name}")
+    assert hashes == {
+        "phash": str(imagehash.phash(img)),
+        "dhash": str(imagehash.dhash(img)),
+        "whash": str(imagehash.whash(img)),
+        "colorhash": str(imagehash.colorhash(img)),
+    }
+
+
+@pytest.fixture(name="large_png", scope="module")
+def fixture_large_png(tmp_path_factory: pytest.TempPathFactory) -> str:
+    path = str(tmp_path_factory.mktemp("large") / "large.png")
+    synthetic_image(np.random.default_rng(0), 3000, 2000).save(path)
+    return path
+
+
+@pytest.mark.parametrize(
+    "name", ["image0.jpeg", "image1.jpeg", "image2.jpeg", "image3.jpeg", "large_png"]
+)
+def test_hash_file_reduced_within_tolerance(
+    name: str, request: pytest.FixtureRequest
+) -> None:
+    if name == "large_png":
+        path = request.getfixturevalue("large_png")
+    else:
+        path = f"{IMAGES_DIR}/{name}"
+    methods = ["dhash", "whash", "average_hash", "colorhash"]
+
+    hashes = imaging.hash_file(path, methods)
+
+    for method, expected in _full_hashes(path).items():
+        assert hamming_hex(hashes[method], str(expected)) <= HASH_TOLERANCE, method
+
+
+def test_open_for_hashing_reduces(large_png: str, tmp_path: Path) -> None:
+    with imaging.open_for_hashing(f"{IMAGES_DIR}/image0.jpeg", color=False) as img:
+        # 2850 pixels decoded at 1/8 scale, straight to grayscale
+        assert img.size == (357, 357)
+        assert img.mode == "L"
+
+    with imaging.open_for_hashing(large_png) as img:
+        assert img.size == (3000 // 7 + 1, 2000 // 7 + 1)
+
+    Image.new("P", (600, 600)).save(tmp_path / "palette.png")
+    with imaging.open_for_hashing(str(tmp_path / "palette.png"), color=False) as img:
+        assert (img.size, img.mode) == ((300, 300), "L")
+
+
+def test_crop_file_keeps_jpeg_tables(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(imaging, "JPEGTRAN", None)
+    source = Image.open(f"{IMAGES_DIR}/image0.jpeg")
+    path = f"{IMAGES_DIR}/image0.jpeg"
+
+    for i in range(3):
+        target = str(tmp_path / f"crop{i}.jpeg")
+        imaging.crop_file(path, target, 1001 - i * 100, 999 - i * 100, ["phash"])
+        path = target
+
+    cropped = Image.open(path)
+    assert cropped.size == (801, 799)
+    assert cropped.quantization == source.quantization
+    assert JpegImagePlugin.get_sampling(cropped) == 2
+
+
+def test_can_crop_losslessly(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(imaging, "JPEGTRAN", "/usr/bin/jpegtran")
+    img = Image.open(f"{IMAGES_DIR}/image0.jpeg")  # 2850x2850, 4:2:0
+
+    assert imaging.can_crop_losslessly(img, (16, 32, 1001, 1001))
+    assert not imaging.can_crop_losslessly(img, (8, 32, 1001, 1001))
+    assert not imaging.can_crop_losslessly(img, (-16, 0, 2866, 100))
+    assert not imaging.can_crop_losslessly(
+        Image.open(f"{IMAGES_DIR}/wikipedia_logo.png"), (0, 0, 10, 10)
+    )
+
+    monkeypatch.setattr(imaging, "JPEGTRAN", None)
+    assert not imaging.can_crop_losslessly(img, (16, 32, 1001, 1001))
+
+
+@pytest.mark.skipif(imaging.JPEGTRAN is None, reason="jpegtran not installed")
+def test_crop_file_lossless(tmp_path: Path) -> None:
+    target = str(tmp_path / "crop.jpeg")
+    # 2850 - 1058 = 1792 = 2 * 896, the box starts on the 16 pixel grid
+    imaging.crop_file(f"{IMAGES_DIR}/image0.jpeg", target, 1058, 1058, ["phash"])
+
+    source = Image.open(f"{IMAGES_DIR}/image0.jpeg")
+    cropped = Image.open(target)
+    assert cropped.size == (1058, 1058)
+    assert cropped.quantization == source.quantization
+    # Same coefficients, only chroma upsampling along the new edges differs
+    difference = np.abs(
+        np.asarray(cropped, dtype=int)
+        - np.asarray(source.crop((896, 896, 1954, 1954)), dtype=int)
+    )
+    assert difference[2:-2, 2:-2].max() == 0
+
+
+def _sampling(strategy: str, **options: int) -> imaging.FrameSampling:
+    defaults = dict(interval=500, keyframe_distance=10, max_frames=1000)
+    defaults.update(options)
+    return imaging.FrameSampling(strategy=strategy, max_samples=1000, **defaults)
+
+
+def test_hash_frames_sampling() -> None:
+    # 72 frames of 100 ms
+    path = f"{IMAGES_DIR}/cerebellum.gif"
+    all_frames = hex_sequence(imaging.hash_frames(path, _sampling("all")) or "")
+    keyframes = hex_sequence(imaging.hash_frames(path, _sampling("keyframes")) or "")
+    interval = hex_sequence(imaging.hash_frames(path, _sampling("interval")) or "")
+
+    assert len(all_frames) == 72
+    assert interval == all_frames[::5]
+    assert keyframes[0] == all_frames[0] and set(keyframes) <= set(all_frames)
+    assert all(hamming(a, b) >= 10 for a, b in zip(keyframes, keyframes[1:]))
+    capped = imaging.hash_frames(path, _sampling("all", max_frames=10)) or ""
+    assert hex_sequence(capped) == all_frames[:10]
+
+
+def test_hash_frames_webp(tmp_path: Path) -> None:
+    gif = Image.open(f"{IMAGES_DIR}/cerebellum.gif")
+    frames = [frame.convert("RGB") for frame in ImageSequence.Iterator(gif)]
+    webp = str(tmp_path / "cerebellum.webp")
+    frames[0].save(webp, save_all=True, append_images=frames[1:], duration=100)
+
+    gif_hashes = imaging.hash_frames(f"{IMAGES_DIR}/cerebellum.gif", _sampling("all"))
+    webp_hashes = imaging.hash_frames(webp, _sampling("all"))
+
+    assert gif_hashes and webp_hashes
+    assert sequence_distance(hex_sequence(gif_hashes), hex_sequence(webp_hashes)) < 4
+
+
+def test_hash_file_frames() -> None:
+    sampling = _sampling("keyframes")
+    gif = imaging.hash_file(f"{IMAGES_DIR}/cerebellum.gif", ["phash"], sampling)
+    still = imaging.hash_file(f"{IMAGES_DIR}/black_white.png", ["phash"], sampling)
+
+    assert gif[imaging.FRAME_HASH_METHOD][:16] == gif["phash"]
+    assert imaging.FRAME_HASH_METHOD not in still
+    assert imaging.FRAME_HASH_METHOD not in imaging.hash_file(
+        f"{IMAGES_DIR}/cerebellum.gif", ["phash"]
+    )
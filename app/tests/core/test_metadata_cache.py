@@ -0,0 +1,129 @@
+import uuid
+
+from typing import Dict, List, Optional, Tuple
+
+import anyio
+import pytest
+
+import app.schemas as schemas
+
+from app.core import metadata_cache as cache_module
+from app.core.metadata_cache import (
+    LocalCacheBackend,
+    MetadataCache,
+    RedisCacheBackend,
+)
+
+
+class FakePipeline:
+    def __init__(self, redis: "FakeRedis") -> None:
+        self.redis = redis
+        self.commands: List[Tuple[str, bytes, int]] = []
+
+    async def __aenter__(self) -> "FakePipeline":
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        pass
+
+    def set(self, key: str, value: bytes, px: int) -> "FakePipeline":
+        self.commands.append((key, value, px))
+        return self
+
+    async def execute(self) -> None:
+        self.redis.round_trips += 1
+        for key, value, px in self.commands:
+            self.redis.values[key] = (value, px)
+
+
+class FakeRedis:
+    """Local stand-in for the few `redis.asyncio.Redis` calls the cache makes."""
+
+    def __init__(self) -> None:
+        self.values: Dict[str, Tuple[bytes, int]] = {}
+        self.round_trips = 0
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        self.round_trips += 1
+        return [self.values[key][0] if key in self.values else None for key in keys]
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def close(self) -> None:
+        pass
+
+
+def _image(path: str = "ab/cd/abcd") -> schemas.ImageInDB:
+    return schemas.ImageInDB(
+        id=uuid.uuid4(), name="test", hash="ff" * 8, hash_int=-1, path=path
+    )
+
+
+def test_local_backend_evicts_least_recently_used() -> None:
+    backend = LocalCacheBackend(max_entries=2)
+
+    async def run() -> List[Optional[bytes]]:
+        await backend.set_many({"a": b"1", "b": b"2"}, ttl=60)
+        await backend.get_many(["a"])
+        await backend.set_many({"c": b"3"}, ttl=60)
+        return await backend.get_many(["a", "b", "c"])
+
+    assert anyio.run(run) == [b"1", None, b"3"]
+
+
+def test_local_backend_expires_entries(monkeypatch: pytest.MonkeyPatch) -> None:
+    backend = LocalCacheBackend(max_entries=10)
+    clock = [1000.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: clock[0])
+
+    async def get() -> List[Optional[bytes]]:
+        return await backend.get_many(["a"])
+
+    anyio.run(backend.set_many, {"a": b"1"}, 60)
+    clock[0] += 59
+    assert anyio.run(get) == [b"1"]
+    clock[0] += 2
+    assert anyio.run(get) == [None]
+
+
+def test_metadata_cache_counts_hits_and_misses() -> None:
+    cache = MetadataCache(LocalCacheBackend(max_entries=10))
+    image = _image()
+
+    async def run() -> Dict[str, schemas.ImageInDB]:
+        await cache.set_many([image])
+        return await cache.get_many([str(image.id), str(uuid.uuid4())])
+
+    assert anyio.run(run) == {str(image.id): image}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_metadata_cache_shared_backend_is_coherent() -> None:
+    redis = FakeRedis()
+    writer = MetadataCache(RedisCacheBackend(redis))
+    reader = MetadataCache(RedisCacheBackend(redis))
+    image = _image()
+    cropped = image.copy(update={"path": "ef/01/ef01"})
+
+    async def run() -> List[Optional[schemas.ImageInDB]]:
+        await writer.set_many([image])
+        before = await reader.get(str(image.id))
+        await writer.set_many([cropped])
+        return [before, await reader.get(str(image.id))]
+
+    assert anyio.run(run) == [image, cropped]
+    assert all(px > 0 for _, px in redis.values.values())
+
+
+def test_redis_backend_sets_in_one_round_trip() -> None:
+    redis = FakeRedis()
+    cache = MetadataCache(RedisCacheBackend(redis))
+    images = [_image() for _ in range(100)]
+
+    async def run() -> Dict[str, schemas.ImageInDB]:
+        await cache.set_many(images)
+        return await cache.get_many([str(image.id) for image in images])
+
+    assert anyio.run(run) == {str(image.id): image for image in images}
+    assert redis.round_trips == 2
@@ -0,0 +1,47 @@
+import anyio
+
+from app.core import executor, imaging, metrics
+
+
+def test_histogram_render() -> None:
+    histogram = metrics.Histogram("test_seconds", "Test", ["stage"], buckets=[0.1, 1])
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5, stage="a")
+
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5.55',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+
+def test_stage_records_duration_and_size() -> None:
+    count = metrics.STAGE_SECONDS.count(stage="test")
+    size = metrics.STAGE_BYTES.value(stage="test")
+
+    with metrics.stage("test") as timer:
+        timer["size"] = 10
+
+    assert metrics.STAGE_SECONDS.count(stage="test") == count + 1
+    assert metrics.STAGE_BYTES.value(stage="test") == size + 10
+
+
+def test_cpu_stages_reported_by_caller(test_image_path: str) -> None:
+    decode = metrics.STAGE_SECONDS.count(stage="decode")
+    hashed = metrics.STAGE_SECONDS.count(stage="hash")
+
+    async def run() -> None:
+        await executor.run_cpu(
+            imaging.hash_file, f"{test_image_path}/image0.jpeg", ["phash"]
+        )
+
+    anyio.run(run)
+    executor.shutdown()
+
+    assert metrics.STAGE_SECONDS.count(stage="decode") == decode + 1
+    assert metrics.STAGE_SECONDS.count(stage="hash") == hashed + 1
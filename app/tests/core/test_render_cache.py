@@ -0,0 +1,57 @@
+import asyncio
+
+from pathlib import Path
+from typing import List
+
+import anyio
+import pytest
+
+from app.core.config import settings
+from app.core.render_cache import RenderCache
+
+
+@pytest.fixture(name="cache")
+def fixture_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> RenderCache:
+    monkeypatch.setattr(settings, "RENDER_CACHE_DIR", str(tmp_path))
+    return RenderCache()
+
+
+def test_concurrent_misses_render_once(cache: RenderCache) -> None:
+    renders: List[str] = []
+
+    async def render(path: str) -> None:
+        renders.append(path)
+        await asyncio.sleep(0.01)
+        Path(path).write_bytes(b"rendition")
+
+    async def run() -> List[str]:
+        return await asyncio.gather(*(cache.get("ab12", render) for _ in range(3)))
+
+    paths = anyio.run(run)
+    assert paths == [cache.path("ab12")] * 3
+    assert Path(paths[0]).read_bytes() == b"rendition"
+    assert len(renders) == 1
+    assert anyio.run(cache.get, "ab12", render) == paths[0]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cancelled_render_hands_over(cache: RenderCache) -> None:
+    renders = 0
+
+    async def render(path: str) -> None:
+        nonlocal renders
+        renders += 1
+        await asyncio.sleep(0.05)
+        Path(path).write_bytes(b"rendition")
+
+    async def run() -> str:
+        leader = asyncio.create_task(cache.get("ab12", render))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(cache.get("ab12", render))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    # The follower renders on its own rather than sharing the cancellation
+    assert anyio.run(run) == cache.path("ab12")
+    assert renders == 2
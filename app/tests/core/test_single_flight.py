@@ -0,0 +1,87 @@
+import asyncio
+import functools
+
+from typing import List
+
+import anyio
+import pytest
+
+from app.core.config import settings
+from app.core.single_flight import SingleFlight
+
+
+@pytest.fixture(name="flight")
+def fixture_flight(monkeypatch: pytest.MonkeyPatch) -> SingleFlight:
+    monkeypatch.setattr(settings, "SINGLE_FLIGHT_GROUPS", ["test"])
+    return SingleFlight("test")
+
+
+def test_concurrent_calls_share_one_execution(flight: SingleFlight) -> None:
+    calls: List[str] = []
+
+    async def load(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    async def run() -> List[str]:
+        return await asyncio.gather(
+            *(flight.run(key, functools.partial(load, key)) for key in "aabaa")
+        )
+
+    assert anyio.run(run) == ["A", "A", "B", "A", "A"]
+    assert sorted(calls) == ["a", "b"]
+    assert (flight.executed, flight.coalesced) == (2, 3)
+    # Nothing is kept once the call is done
+    assert anyio.run(run) == ["A", "A", "B", "A", "A"]
+    assert len(calls) == 4
+
+
+def test_exception_shared_with_followers(flight: SingleFlight) -> None:
+    async def fail() -> None:
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run() -> list:
+        return await asyncio.gather(
+            *(flight.run("key", fail) for _ in range(3)), return_exceptions=True
+        )
+
+    results = anyio.run(run)
+    assert [type(result) for result in results] == [ValueError] * 3
+    assert flight.executed == 1
+
+
+def test_cancelled_leader_hands_over(flight: SingleFlight) -> None:
+    calls = 0
+
+    async def load() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return calls
+
+    async def run() -> int:
+        leader = asyncio.ensure_future(flight.run("key", load))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.run("key", load))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert anyio.run(run) == 2
+
+
+def test_disabled_group_runs_every_call(
+    flight: SingleFlight, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "SINGLE_FLIGHT_GROUPS", [])
+
+    async def load() -> None:
+        await asyncio.sleep(0.01)
+
+    async def run() -> None:
+        await asyncio.gather(*(flight.run("key", load) for _ in range(3)))
+
+    anyio.run(run)
+    assert (flight.executed, flight.coalesced) == (3, 0)
@@ -0,0 +1,119 @@
+from pathlib import Path
+from typing import List
+
+import anyio
+import pytest
+
+from app.core.config import settings
+from app.core.storage import LocalStorage, S3Storage, Storage, StorageError
+
+from app.tests.conftest import FakeS3
+
+
+@pytest.fixture(params=["local", "s3"])
+def storage(
+    request: pytest.FixtureRequest,
+    tmp_path: Path,
+    s3_storage: S3Storage,
+    monkeypatch: pytest.MonkeyPatch,
+) -> Storage:
+    monkeypatch.setattr(settings, "IMAGE_UPLOAD_DIR", str(tmp_path))
+    return LocalStorage() if request.param == "local" else s3_storage
+
+
+def _source(content: bytes) -> str:
+    path = f"{settings.IMAGE_UPLOAD_DIR}/source.tmp"
+    with open(path, "wb") as handler:
+        handler.write(content)
+    return path
+
+
+def test_storage_round_trip(storage: Storage) -> None:
+    content = bytes(range(256)) * 4
+    source_path = _source(content)
+
+    async def run() -> None:
+        assert not await storage.exists("ab/cd/key")
+        await storage.put("ab/cd/key", source_path)
+        assert await storage.exists("ab/cd/key")
+        assert await storage.size("ab/cd/key") == len(content)
+        assert await storage.get("ab/cd/key") == content
+        assert await storage.get("ab/cd/key", 16, 31) == content[16:32]
+
+        chunks: List[bytes] = [c async for c in storage.stream("ab/cd/key", 100)]
+        assert b"".join(chunks) == content[100:]
+
+        async with storage.local_copy("ab/cd/key") as path:
+            with open(path, "rb") as handler:
+                assert handler.read() == content
+
+        await storage.delete("ab/cd/key")
+        await storage.delete("ab/cd/key")
+        assert not await storage.exists("ab/cd/key")
+        with pytest.raises(FileNotFoundError):
+            await storage.get("ab/cd/key")
+        await storage.close()
+
+    anyio.run(run)
+    assert not Path(source_path).exists()
+
+
+def test_s3_storage_multipart_upload(
+    s3_storage: S3Storage,
+    fake_s3: FakeS3,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(settings, "IMAGE_UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "S3_MULTIPART_THRESHOLD", 1024)
+    monkeypatch.setattr(settings, "S3_MULTIPART_CHUNK_SIZE", 1000)
+    content = bytes(range(256)) * 20
+    source_path = _source(content)
+
+    async def run() -> None:
+        await s3_storage.put("key", source_path)
+        await s3_storage.close()
+
+    anyio.run(run)
+
+    parts = [r for r in fake_s3.requests if "partNumber" in r.url.params]
+    assert len(parts) == 6
+    assert fake_s3.objects["/images/key"] == content
+    assert not fake_s3.uploads
+
+
+def test_s3_storage_multipart_upload_aborted(
+    s3_storage: S3Storage,
+    fake_s3: FakeS3,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(settings, "IMAGE_UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "S3_MULTIPART_THRESHOLD", 1024)
+    monkeypatch.setattr(settings, "S3_MULTIPART_CHUNK_SIZE", 1000)
+    fake_s3.fail_part = 2
+    source_path = _source(bytes(4096))
+
+    async def run() -> None:
+        with pytest.raises(StorageError):
+            await s3_storage.put("key", source_path)
+        await s3_storage.close()
+
+    anyio.run(run)
+
+    assert not fake_s3.uploads
+    assert "/images/key" not in fake_s3.objects
+
+
+def test_s3_storage_signs_requests(s3_storage: S3Storage, fake_s3: FakeS3) -> None:
+    async def run() -> None:
+        await s3_storage.exists("key")
+        await s3_storage.close()
+
+    anyio.run(run)
+
+    (request,) = fake_s3.requests
+    authorization = request.headers["authorization"]
+    assert authorization.startswith("AWS4-HMAC-SHA256 Credential=test/")
+    assert "/us-east-1/s3/aws4_request" in authorization
+    assert "SignedHeaders=host;x-amz-content-sha256;x-amz-date" in authorization
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import pytest
+
+from sqlalchemy import create_engine, text
+
+from app.core.config import settings
+
+from app.core.distance import hex_to_int64
+from app.db.migrations import MIGRATIONS, run_migrations
+
+
+def test_migrations_backfill_hash_int(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(settings, "IMAGE_UPLOAD_DIR", "images")
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE images (id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, "
+                "description VARCHAR, hash VARCHAR NOT NULL, path VARCHAR NOT NULL)"
+            )
+        )
+        conn.execute(
+            text("INSERT INTO images VALUES (:id, 'test', NULL, :hash, :path)"),
+            [
+                {"id": "low", "hash": "0f0f0f0f0f0f0f0f", "path": "images/low"},
+                {"id": "high", "hash": "f0f0f0f0f0f0f0f0", "path": "other/high"},
+            ],
+        )
+
+    run_migrations(engine)
+    run_migrations(engine)
+
+    with engine.connect() as conn:
+        result = conn.execute(text("SELECT id, hash_int, path FROM images")).all()
+        rows = {row.id: row.hash_int for row in result}
+        paths = {row.id: row.path for row in result}
+        versions = conn.execute(text("SELECT version FROM schema_migrations")).all()
+
+    assert rows == {
+        "low": hex_to_int64("0f0f0f0f0f0f0f0f"),
+        "high": hex_to_int64("f0f0f0f0f0f0f0f0"),
+    }
+    assert rows["high"] < 0
+    assert paths == {"low": "low", "high": "other/high"}
+    assert [version for (version,) in versions] == list(range(1, len(MIGRATIONS) + 1))
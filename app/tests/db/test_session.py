@@ -0,0 +1,37 @@
+from typing import Tuple
+
+import anyio
+
+from sqlalchemy import make_url, text
+
+from app.core.config import settings
+from app.db.session import async_engine, async_url, engine_options
+
+
+def test_async_url() -> None:
+    assert async_url(make_url("sqlite:///./sql_app.db")).drivername == (
+        "sqlite+aiosqlite"
+    )
+    assert async_url(make_url("postgresql://u:p@db/images")).drivername == (
+        "postgresql+asyncpg"
+    )
+
+
+def test_engine_options() -> None:
+    options = engine_options(make_url("postgresql://u:p@db/images"), is_async=True)
+    assert options["pool_size"] == settings.DB_POOL_SIZE
+    assert options["max_overflow"] == settings.DB_MAX_OVERFLOW
+    assert options["pool_recycle"] == settings.DB_POOL_RECYCLE
+    assert "poolclass" not in options
+    assert "pool_size" not in engine_options(make_url("sqlite://"))
+
+
+def test_sqlite_pragmas() -> None:
+    async def run() -> Tuple[str, int]:
+        async with async_engine.connect() as conn:
+            journal_mode = await conn.scalar(text("PRAGMA journal_mode"))
+            synchronous = await conn.scalar(text("PRAGMA synchronous"))
+        await async_engine.dispose()
+        return journal_mode, synchronous
+
+    assert anyio.run(run) == ("wal", 1)
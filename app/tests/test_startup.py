@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+from pathlib import Path
+
+
+# Generous, cold CI runners are slow. Locally `import app.main` takes ~0.8s
+IMPORT_TIME_BUDGET = 3.0
+
+# Only the CPU workers need these, the API process imports them on first use
+HEAVY_MODULES = ["PIL", "imagehash", "numpy", "scipy", "pywt"]
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app.main
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": list(sys.modules)}))
+"""
+
+
+def test_import_budget(tmp_path: Path) -> None:
+    database = tmp_path / "startup.db"
+    env = {
+        **os.environ,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{database}",
+        "PYTHONPATH": str(Path(__file__).parents[2]),
+    }
+
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        env=env,
+        cwd=tmp_path,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+
+    assert [name for name in HEAVY_MODULES if name in result["modules"]] == []
+    assert result["seconds"] < IMPORT_TIME_BUDGET
+    # The schema is left to the lifespan, importing does not even connect
+    assert not database.exists()
@@ -0,0 +1,165 @@
+import asyncio
+import contextlib
+import logging
+import time
+import uuid
+
+from datetime import timedelta
+from typing import Any, AsyncIterator, Dict, List
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import app.models as models
+import app.schemas as schemas
+
+from app import crud
+from app.core import executor, storage
+from app.core.blob_store import StoredBlob
+from app.core.config import settings
+from app.core.fetcher import fetcher
+from app.db.session import AsyncSessionLocal, async_engine
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorker:
+    """Process queued ingest and crop jobs from the persistent `jobs` table.
+
+    Runs inside the API process (`JOB_WORKERS` tasks) or on its own with
+    `python -m app.worker`, any number of workers can share the same table.
+    A job being processed is refreshed every `JOB_HEARTBEAT_INTERVAL`, one
+    left alone for `JOB_LEASE_TIMEOUT` by a worker that died is queued again.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: asyncio.Event | None = None
+        self._next_requeue = 0.0
+
+    async def start(self, concurrency: int) -> None:
+        self._wakeup = asyncio.Event()
+        async with AsyncSessionLocal() as db:
+            await self._requeue_stale_jobs(db)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(concurrency)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+        self._wakeup = None
+
+    async def wait(self) -> None:
+        await asyncio.gather(*self._tasks)
+
+    def notify(self) -> None:
+        """Wake idle workers up right away instead of at the next poll."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    if time.monotonic() >= self._next_requeue:
+                        await self._requeue_stale_jobs(db)
+                    job = await crud.job.claim_job(db)
+                    if job is not None:
+                        await self.process(db, job)
+                        continue
+            except Exception:
+                logger.exception("Error while claiming job")
+
+            assert self._wakeup is not None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=settings.JOB_POLL_INTERVAL
+                )
+            self._wakeup.clear()
+
+    async def _requeue_stale_jobs(self, db: AsyncSession) -> None:
+        # Every worker task shares the schedule
+        self._next_requeue = time.monotonic() + settings.JOB_HEARTBEAT_INTERVAL
+        requeued = await crud.job.requeue_stale_jobs(
+            db, timedelta(seconds=settings.JOB_LEASE_TIMEOUT)
+        )
+        if requeued:
+            logger.warning("Requeued %d stale jobs", requeued)
+
+    @contextlib.asynccontextmanager
+    async def _heartbeat(self, job: models.Job) -> AsyncIterator[None]:
+        task = asyncio.create_task(self._refresh(str(job.id)))
+        try:
+            yield
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def _refresh(self, job_id: str) -> None:
+        # Its own session, the job's one is busy processing it
+        while True:
+            await asyncio.sleep(settings.JOB_HEARTBEAT_INTERVAL)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await crud.job.refresh_job(db, job_id)
+            except Exception:
+                logger.exception("Error while refreshing job %s", job_id)
+
+    async def process(self, db: AsyncSession, job: models.Job) -> None:
+        try:
+            async with self._heartbeat(job):
+                image = await self._process(db, job)
+        except (crud.CRUDBadRequestError, crud.CRUDInternalError) as exc:
+            await crud.job.fail_job(db, job, exc.message)
+        except Exception:
+            logger.exception("Job %s failed", job.id)
+            await crud.job.fail_job(db, job, "Error while processing job")
+        else:
+            await crud.job.complete_job(db, job, str(image.id))
+
+    async def _process(
+        self, db: AsyncSession, job: models.Job
+    ) -> models.Image | schemas.ImageInDB:
+        payload: Dict[str, Any] = job.payload  # type: ignore
+        if job.kind == schemas.JobKind.upload:
+            return await crud.image.create_staged_image(
+                db,
+                blob=StoredBlob(payload["digest"], payload["path"], payload["size"]),
+                name=payload["name"],
+                description=payload["description"],
+            )
+        elif job.kind == schemas.JobKind.url:
+            return await crud.image.create_image(
+                db, image_url=schemas.ImageUrl(**payload), image_upload=None
+            )
+        elif job.kind == schemas.JobKind.crop:
+            image = await crud.image.get_image(db, uuid.UUID(payload["image_id"]))
+            if not image:
+                raise crud.CRUDBadRequestError("Image not found")
+            return await crud.image.crop_image(
+                db, image, payload["width"], payload["height"]
+            )
+        else:
+            raise ValueError(f"Unknown job kind {job.kind}")
+
+
+worker = JobWorker()
+
+
+async def main() -> None:
+    await worker.start(settings.JOB_WORKERS or 1)
+    try:
+        await worker.wait()
+    finally:
+        await fetcher.close()
+        await storage.close()
+        await async_engine.dispose()
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())